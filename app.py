@@ -1,14 +1,50 @@
+import atexit
 import base64
-from flask import Flask, request, render_template, jsonify
+import click
+import concurrent.futures
+import hashlib
+import json
+import secrets
+import tempfile
+from flask import Flask, Request, Response, request, render_template, jsonify, send_file, url_for
 import psycopg2
 import sqlite3
 import os
 import logging
 import uuid
+from datetime import datetime, timezone
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import mimetypes
+from werkzeug.http import is_resource_modified
+from db_pool import ConnectionPool, SQLiteThreadPool, SQLiteWALPool
+from cache import (
+    BackgroundRefresher, CachedImage, CircuitBreaker, ImageCache, LocalCache, PoolQueue, ResilientRedis,
+    SingleFlight, SingleFlightTimeout, entry_size,
+)
+from storage import (
+    UploadStream, insert_image, insert_images, find_image, fetch_images, read_image_data, read_image_range, list_image_sizes,
+    delete_image, collect_garbage, rekey_image_ids, begin_read_snapshot, iter_images, list_images_page,
+    list_nicknames_page,
+)
+from blob_store import FileBlobStore, InlineBlobStore
+from volume_store import VolumeBlobStore
+from migrations import MIGRATIONS, applied_versions, apply_migrations, pending_migrations
+from ids import uuid7
+from write_queue import GroupCommitQueue, WriteQueueFull
+from importer import ImportCheckpoint, Importer
+from export import ARCHIVE_FORMATS, archive_format_for, export_archive
+import mime_sniff
+
+class SpoolingRequest(Request):
+    # Werkzeug keeps small uploads in memory and streams larger ones to disk; bound
+    # the in-memory part explicitly so peak RSS per upload is predictable.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,21 +57,160 @@ DB_USER = "postgres"  # Replace with your PostgreSQL username, if necessary
 DB_PASS = os.getenv("PGPASSWORD", "<none>")  # Ideally should be a complete secret
 SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "/tmp/photo.db")
 
+# SQLite production mode
+SQLITE_MODE = os.getenv("SQLITE_MODE", "simple")  # "simple" (one connection per thread) or "wal"
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", 8))  # Read-only connections per process in "wal" mode
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # OFF, NORMAL, FULL or EXTRA
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # Bytes of the file read through mmap
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -64 * 1024))  # Page cache; negative values are KiB
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))  # Wait this long for another process's lock
+SQLITE_CHECKPOINT_INTERVAL = float(os.getenv("SQLITE_CHECKPOINT_INTERVAL", 1.0))  # Seconds; 0 checkpoints on commit instead
+SQLITE_CHECKPOINT_MODE = os.getenv("SQLITE_CHECKPOINT_MODE", "PASSIVE")  # PASSIVE, FULL, RESTART or TRUNCATE
+
+# Connection pool configuration
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))  # Seconds before surplus idle connections are closed
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # Seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", 10))  # Health check connections idle longer than this
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") != "0"  # Apply pending schema migrations at startup
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))  # PostgreSQL statement_timeout for nickname reads; 0 disables it
+
+# Upload configuration
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 64 * 1024))  # Bytes copied to storage per read
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", 1024 * 1024))  # Larger uploads spill to a temp file
+BATCH_UPLOAD_MAX_FILES = int(os.getenv("BATCH_UPLOAD_MAX_FILES", 200))  # Files accepted by one POST /images/batch
+
+# Bulk import configuration
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 0))  # Processes hashing and sniffing files; 0 uses every CPU
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 500))  # Files committed per transaction
+IMPORT_BATCH_BYTES = int(os.getenv("IMPORT_BATCH_BYTES", 64 * 1024 * 1024))  # Bytes committed per transaction at most
+
+# Export configuration
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1024 * 1024))  # Bytes of an image read and sent at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 500))  # Image rows fetched from the database at a time
+
+# Group commit configuration
+WRITE_QUEUE_ENABLED = os.getenv("WRITE_QUEUE_ENABLED", "0") == "1"  # Commit uploads in shared transactions
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", 64))  # Writes per transaction at most
+WRITE_QUEUE_MAX_DELAY_MS = float(os.getenv("WRITE_QUEUE_MAX_DELAY_MS", 2))  # Wait this long for a batch to fill
+WRITE_QUEUE_MAX_PENDING = int(os.getenv("WRITE_QUEUE_MAX_PENDING", 1024))  # Queued writes before uploads are refused
+WRITE_QUEUE_TIMEOUT = float(os.getenv("WRITE_QUEUE_TIMEOUT", 5))  # Seconds an upload waits for room in a full queue
+WRITE_QUEUE_COMMIT_TIMEOUT = float(os.getenv("WRITE_QUEUE_COMMIT_TIMEOUT", 30))  # Seconds a queued upload waits for the writer to start on it
+
+# Blob storage: "inline" keeps image bytes in the images table, "filesystem" keeps
+# them in a content-addressed directory and "volume" appends them to large volume
+# files; the external stores leave only metadata plus the hash in the table
+BLOB_STORE = os.getenv("BLOB_STORE", "inline")
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "/tmp/photo_blobs")
+BLOB_FSYNC = os.getenv("BLOB_FSYNC", "always")  # "always", "file" or "never"
+BLOB_GC_GRACE = float(os.getenv("BLOB_GC_GRACE", 3600))  # Seconds before an orphaned store entry may be collected
+VOLUME_SIZE = int(os.getenv("VOLUME_SIZE", 1024 ** 3))  # Bytes preallocated per volume file
+VOLUME_CHECKPOINT_INTERVAL = float(os.getenv("VOLUME_CHECKPOINT_INTERVAL", 300))  # Seconds between index checkpoints
+
+# Raw image serving: "wsgi" hands files to the server's wsgi.file_wrapper (sendfile
+# under gunicorn/uwsgi), "x-sendfile" and "x-accel-redirect" delegate to Apache/nginx
+IMAGE_SENDFILE = os.getenv("IMAGE_SENDFILE", "wsgi")
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "/protected-images/")
+
+app.config["USE_X_SENDFILE"] = IMAGE_SENDFILE == "x-sendfile"
+
+# HTTP caching: images never change once stored, so id-addressed URLs can be cached
+# forever; anything addressed by nickname must be revalidated
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Range requests: partial content is streamed in chunks of this size, and requests
+# asking for more ranges than MAX_RANGES get the whole image instead
+RANGE_CHUNK_SIZE = int(os.getenv("RANGE_CHUNK_SIZE", 1024 * 1024))
+MAX_RANGES = int(os.getenv("MAX_RANGES", 16))
+
+# Listing endpoints: items per page when no limit is given, and the largest limit accepted
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", 50))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", 500))
+
+# Nickname JSON lists base64-encode each image this many bytes at a time; a multiple
+# of 3, so only an image's last chunk can need padding
+BASE64_CHUNK_SIZE = 3 * 16 * 1024
+
 # Redis configuration
+REDIS_ENABLED = os.getenv("REDIS_ENABLED", "1") != "0"
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.1))  # Seconds; also used for connecting
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 0.5))  # Seconds to wait for a free pooled connection
+# Circuit breaker: after this many consecutive failures Redis calls fail fast, and a
+# background probe pings it every REDIS_PROBE_INTERVAL seconds until it answers
+REDIS_FAILURE_THRESHOLD = int(os.getenv("REDIS_FAILURE_THRESHOLD", 5))
+REDIS_PROBE_INTERVAL = float(os.getenv("REDIS_PROBE_INTERVAL", 1))
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))  # Seconds a nickname's image list stays cached
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", 60))  # Seconds an unknown nickname stays cached
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", 32 * 1024 * 1024))  # Larger result sets are not cached
+# Storing an entry sends it whole in one socket write, which REDIS_SOCKET_TIMEOUT would
+# cut short; by default the write timeout allows CACHE_MAX_ENTRY_BYTES at 10 MB/s
+REDIS_WRITE_TIMEOUT = float(os.getenv("REDIS_WRITE_TIMEOUT", max(REDIS_SOCKET_TIMEOUT, CACHE_MAX_ENTRY_BYTES / 10e6)))
+# Nicknames whose images add up to more than this are streamed from the database one
+# image at a time instead of being loaded whole and cached; 0 streams every miss
+NICKNAME_STREAM_BYTES = int(os.getenv("NICKNAME_STREAM_BYTES", CACHE_MAX_ENTRY_BYTES))
+# Once an entry stops being fresh it is served immediately while one background
+# refresh runs for CACHE_STALE_WHILE_REVALIDATE seconds, and served only if loading
+# fails for CACHE_STALE_IF_ERROR seconds (the same idea as RFC 5861)
+CACHE_STALE_WHILE_REVALIDATE = float(os.getenv("CACHE_STALE_WHILE_REVALIDATE", 60))
+CACHE_STALE_IF_ERROR = float(os.getenv("CACHE_STALE_IF_ERROR", 86400))
+CACHE_STALE_TTL = max(CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR)
+# In-process cache in front of Redis; keep its TTL short since uploads handled by
+# other processes only invalidate Redis
+L1_CACHE_BYTES = int(os.getenv("L1_CACHE_BYTES", 64 * 1024 * 1024))  # 0 disables the local cache
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", 10))
+L1_CACHE_MAX_OBJECT_BYTES = int(os.getenv("L1_CACHE_MAX_OBJECT_BYTES", 4 * 1024 * 1024))
+local_cache = LocalCache(L1_CACHE_BYTES, L1_CACHE_TTL, L1_CACHE_MAX_OBJECT_BYTES) if L1_CACHE_BYTES > 0 else None
+# Cache-miss coalescing: concurrent misses wait this long for the one loader, and
+# the cross-process fill lock expires after CACHE_FILL_LOCK_TTL if its holder dies
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 5))
+CACHE_FILL_LOCK_TTL = float(os.getenv("CACHE_FILL_LOCK_TTL", 10))
+nickname_loads = SingleFlight()
+stale_refreshes = BackgroundRefresher()
 redis_client = None
-use_redis = False  # Flag indicating if Redis is available
+image_cache = None
+
+def create_redis_client(socket_timeout):
+    return redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        queue_class=PoolQueue,  # A busy pool raises PoolExhaustedError, which the breaker ignores
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        retry=Retry(NoBackoff(), 0),  # The circuit breaker decides when to try again
+    ))
 
-# Try to connect to Redis
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-    redis_client.ping()  # Test if Redis is reachable
-    use_redis = True
-    logging.info("Connected to Redis.")
-except redis.ConnectionError:
-    logging.warning("Redis is not reachable. The application will not use caching.")
+# Connections are made lazily, so Redis may come and go while the app is running;
+# the circuit breaker keeps an outage from costing every request a timeout
+if REDIS_ENABLED:
+    raw_redis_client = create_redis_client(REDIS_SOCKET_TIMEOUT)
+    redis_breaker = CircuitBreaker(
+        raw_redis_client.ping,
+        failure_threshold=REDIS_FAILURE_THRESHOLD,
+        probe_interval=REDIS_PROBE_INTERVAL,
+    )
+    redis_client = ResilientRedis(raw_redis_client, redis_breaker)
+    image_cache = ImageCache(
+        redis_client,
+        ttl=CACHE_TTL,
+        negative_ttl=CACHE_NEGATIVE_TTL,
+        stale_ttl=CACHE_STALE_TTL,
+        max_entry_bytes=CACHE_MAX_ENTRY_BYTES,
+        writer=ResilientRedis(create_redis_client(REDIS_WRITE_TIMEOUT), redis_breaker),
+    )
+    try:
+        redis_client.ping()
+        logging.info("Connected to Redis.")
+    except redis.RedisError:
+        logging.warning("Redis is not reachable yet. Caching will start once it is.")
 
 def get_db_connection():
     try:
@@ -51,38 +226,92 @@ def get_db_connection():
         logging.error(f"Error connecting to the database: {e}")
         raise
 
+def create_db_pool():
+    if DB_TYPE == "postgres":
+        return ConnectionPool(
+            get_db_connection,
+            minsize=DB_POOL_MIN,
+            maxsize=DB_POOL_MAX,
+            max_idle=DB_POOL_MAX_IDLE,
+            timeout=DB_POOL_TIMEOUT,
+            ping_after=DB_POOL_PING_AFTER,
+            name="postgres",
+        )
+    elif DB_TYPE == "sqlite" and SQLITE_MODE == "wal":
+        return SQLiteWALPool(
+            SQLITE_DB_PATH,
+            readers=SQLITE_READERS,
+            min_readers=DB_POOL_MIN,
+            max_idle=DB_POOL_MAX_IDLE,
+            timeout=DB_POOL_TIMEOUT,
+            ping_after=DB_POOL_PING_AFTER,
+            synchronous=SQLITE_SYNCHRONOUS,
+            mmap_size=SQLITE_MMAP_SIZE,
+            cache_size=SQLITE_CACHE_SIZE,
+            busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+            checkpoint_interval=SQLITE_CHECKPOINT_INTERVAL,
+            checkpoint_mode=SQLITE_CHECKPOINT_MODE,
+        )
+    elif DB_TYPE == "sqlite":
+        return SQLiteThreadPool(SQLITE_DB_PATH, max_idle=DB_POOL_MAX_IDLE)
+    raise ValueError("Unsupported DB_TYPE specified")
+
+db_pool = create_db_pool()
+
+def create_blob_store():
+    if BLOB_STORE == "inline":
+        return InlineBlobStore()
+    elif BLOB_STORE == "filesystem":
+        return FileBlobStore(BLOB_STORE_PATH, fsync=BLOB_FSYNC)
+    elif BLOB_STORE == "volume":
+        store = VolumeBlobStore(
+            BLOB_STORE_PATH,
+            volume_size=VOLUME_SIZE,
+            fsync=BLOB_FSYNC,
+            checkpoint_interval=VOLUME_CHECKPOINT_INTERVAL,
+        )
+        # A checkpoint on exit keeps the next startup from rescanning the volumes
+        atexit.register(store.close)
+        return store
+    raise ValueError("Unsupported BLOB_STORE specified")
+
+blob_store = create_blob_store()
+
+def create_write_queue():
+    if not WRITE_QUEUE_ENABLED:
+        return None
+    write_queue = GroupCommitQueue(
+        db_pool,
+        DB_TYPE,
+        max_batch=WRITE_QUEUE_MAX_BATCH,
+        max_delay_ms=WRITE_QUEUE_MAX_DELAY_MS,
+        max_pending=WRITE_QUEUE_MAX_PENDING,
+    )
+    # Uploads already queued are committed before the process exits
+    atexit.register(write_queue.close)
+    return write_queue
+
+write_queue = create_write_queue()
+
 def init_db():
+    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        if DB_TYPE == "sqlite":
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS images (
-                    id TEXT PRIMARY KEY,
-                    image_data BLOB NOT NULL,
-                    nickname TEXT NOT NULL,
-                    mime_type TEXT NOT NULL
-                )
-            """)
-        elif DB_TYPE == "postgres":
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS images (
-                    image_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                    image_data BYTEA NOT NULL,
-                    nickname TEXT NOT NULL,
-                    mime_type TEXT NOT NULL
+        conn = db_pool.getconn()
+        if DB_AUTO_MIGRATE:
+            applied = apply_migrations(conn, DB_TYPE)
+            logging.info(f"Database initialized successfully ({len(applied)} migrations applied).")
+        else:
+            pending = pending_migrations(conn, DB_TYPE)
+            if pending:
+                logging.warning(
+                    f"{len(pending)} schema migrations are pending; run 'flask --app app db upgrade' to apply them."
                 )
-            """)
-        conn.commit()
-        logging.info("Database initialized successfully.")
     except Exception as e:
         logging.error(f"Error initializing the database: {e}")
         raise
     finally:
-        if cur:
-            cur.close()
         if conn:
-            conn.close()
+            db_pool.putconn(conn)
 
 # Initialize the database
 init_db()
@@ -91,20 +320,44 @@ init_db()
 if DB_TYPE == "sqlite":
     logging.info(f"SQLite database file is located at: {SQLITE_DB_PATH}")
 
-def sniff_mime_type(file_storage):
-    # Try to get MIME type from file object
+def sniff_mime_type(file_storage, header=None):
+    # Trust the magic number first; only the leading bytes are ever read
+    if header is None:
+        header = file_storage.stream.read(mime_sniff.HEADER_SIZE)
+        file_storage.stream.seek(0)
+    mime_type = mime_sniff.sniff(header)
+    if mime_type:
+        return mime_type
+    # Fallback: the client-declared type, then the file extension
     mime_type = file_storage.mimetype
     if mime_type and mime_type != 'application/octet-stream':
         return mime_type
-    # Fallback: use imghdr and mimetypes
-    file_bytes = file_storage.read()
-    file_storage.seek(0)
-    ext = imghdr.what(None, h=file_bytes)
-    if ext:
-        guessed = mimetypes.types_map.get(f".{ext}", None)
-        if guessed:
-            return guessed
-    return "application/octet-stream"
+    guessed, _ = mimetypes.guess_type(file_storage.filename or "")
+    return guessed or "application/octet-stream"
+
+def invalidate_nickname(nickname):
+    if local_cache:
+        local_cache.invalidate(nickname)
+    if image_cache:
+        try:
+            image_cache.invalidate(nickname)
+        except redis.RedisError as e:
+            logging.warning(f"Failed to invalidate cache for nickname '{nickname}': {e}")
+
+def submit_write(write):
+    # Raises WriteQueueFull when there is no room, or TimeoutError when the write was
+    # still queued after WRITE_QUEUE_COMMIT_TIMEOUT and has been dropped unrun
+    future = write_queue.submit(write, timeout=WRITE_QUEUE_TIMEOUT)
+    try:
+        return future.result(timeout=WRITE_QUEUE_COMMIT_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        if not future.cancel():
+            # The writer has already started on it: it is reading this request's upload
+            # and may commit, so a 503 would invite a duplicate retry. Wait for the outcome.
+            return future.result()
+        raise concurrent.futures.TimeoutError(
+            f"The {write_queue.name} did not get to this write within {WRITE_QUEUE_COMMIT_TIMEOUT:g}s; nothing was stored"
+        )
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -112,39 +365,98 @@ def index():
         try:
             nickname = request.form["nickname"]
             image_file = request.files["image_data"]
-            image_data = image_file.read()
-            image_file.seek(0)
+            # Stream the upload to storage in chunks, hashing as it goes
+            upload = UploadStream(image_file.stream, chunk_size=UPLOAD_CHUNK_SIZE)
             # Sniff MIME type automatically
-            mime_type = sniff_mime_type(image_file)
-            image_id = str(uuid.uuid4())  # Generate a new UUID for the image
-
-            conn = get_db_connection()
-            cur = conn.cursor()
-            if DB_TYPE == "postgres":
-                cur.execute(
-                    "INSERT INTO images (image_id, image_data, nickname, mime_type) VALUES (%s, %s, %s, %s)",
-                    (image_id, psycopg2.Binary(image_data), nickname, mime_type)
-                )
-            elif DB_TYPE == "sqlite":
-                cur.execute(
-                    "INSERT INTO images (id, image_data, nickname, mime_type) VALUES (?, ?, ?, ?)",
-                    (image_id, sqlite3.Binary(image_data), nickname, mime_type)
+            mime_type = sniff_mime_type(image_file, upload.header(mime_sniff.HEADER_SIZE))
+            image_id = str(uuid7())  # Time-ordered, so new rows append to the right edge of the primary key
+
+            if write_queue:
+                # Acknowledged only once the batch holding this insert has committed
+                duplicate = submit_write(
+                    lambda conn: insert_image(conn, DB_TYPE, image_id, nickname, mime_type, upload, blobs=blob_store)
                 )
-            
-            conn.commit()
-            logging.info(f"Image with nickname '{nickname}' uploaded successfully.")
-            return f"<div class='success-message'>Image '{nickname}' uploaded successfully! (MIME: {mime_type})</div>"
+            else:
+                conn = db_pool.getconn()
+                duplicate = insert_image(conn, DB_TYPE, image_id, nickname, mime_type, upload, blobs=blob_store)
+                conn.commit()
+            invalidate_nickname(nickname)
+            stored = "already stored" if duplicate else f"{upload.size} bytes"
+            logging.info(f"Image with nickname '{nickname}' uploaded successfully ({stored}, sha256 {upload.content_hash}).")
+            return f"<div class='success-message'>Image '{nickname}' uploaded successfully! (ID: <a href='/images/id/{image_id}/raw'>{image_id}</a>, MIME: {mime_type})</div>"
+        except (WriteQueueFull, concurrent.futures.TimeoutError) as e:
+            logging.warning(f"Rejected upload: {e}")
+            return f"<div class='error-message'>Image upload failed: {str(e)}</div>", 503
         except Exception as e:
             logging.error(f"Error during image upload: {e}")
             return f"<div class='error-message'>Image upload failed: {str(e)}</div>", 500
         finally:
-            if 'cur' in locals() and cur:
-                cur.close()
             if 'conn' in locals() and conn:
-                conn.close()
+                db_pool.putconn(conn)
 
     return render_template("index.html")
 
+@app.route("/images/batch", methods=["POST"])
+def upload_batch():
+    image_files = request.files.getlist("image_data")
+    nicknames = request.form.getlist("nickname")
+    if not image_files:
+        return jsonify({"error": "No image_data files in the request"}), 400
+    if len(image_files) > BATCH_UPLOAD_MAX_FILES:
+        return jsonify({"error": f"At most {BATCH_UPLOAD_MAX_FILES} files per batch"}), 413
+    if len(nicknames) == 1:
+        nicknames = nicknames * len(image_files)
+    elif len(nicknames) != len(image_files):
+        return jsonify({"error": "Send one nickname for the whole batch or one per file"}), 400
+
+    results = []
+    entries = []
+    for image_file, nickname in zip(image_files, nicknames):
+        result = {"filename": image_file.filename, "nickname": nickname}
+        results.append(result)
+        upload = UploadStream(image_file.stream, chunk_size=UPLOAD_CHUNK_SIZE)
+        header = upload.header(mime_sniff.HEADER_SIZE)
+        if not nickname or not header:
+            result.update(status="failed", error="Missing nickname" if not nickname else "Empty file")
+            continue
+        image_id = str(uuid7())
+        result.update(id=image_id, mime_type=sniff_mime_type(image_file, header))
+        entries.append((result, (image_id, nickname, result["mime_type"], upload)))
+
+    def write(conn):
+        return insert_images(conn, DB_TYPE, [entry for _, entry in entries], blobs=blob_store)
+
+    try:
+        if not entries:
+            outcomes = []
+        elif write_queue:
+            outcomes = submit_write(write)
+        else:
+            with db_pool.connection() as conn:
+                outcomes = write(conn)
+                conn.commit()
+    except (WriteQueueFull, concurrent.futures.TimeoutError) as e:
+        logging.warning(f"Rejected batch upload: {e}")
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error during batch upload of {len(entries)} files: {e}")
+        return jsonify({"error": "Batch upload failed", "details": str(e)}), 500
+
+    for (result, _), outcome in zip(entries, outcomes):
+        if isinstance(outcome, Exception):
+            logging.warning(f"Failed to store '{result['filename']}' in a batch upload: {outcome}")
+            del result["id"]
+            result.update(status="failed", error=str(outcome))
+        else:
+            content_hash, size, duplicate = outcome
+            result.update(status="duplicate" if duplicate else "stored", size=size, content_hash=content_hash)
+    for nickname in {result["nickname"] for result in results if result["status"] != "failed"}:
+        invalidate_nickname(nickname)
+    counts = {status: sum(1 for result in results if result["status"] == status) for status in ("stored", "duplicate", "failed")}
+    logging.info(f"Batch upload finished: {counts['stored']} stored, {counts['duplicate']} duplicates, {counts['failed']} failed.")
+    # 207 tells clients to look at the per-file statuses
+    return jsonify({**counts, "files": results}), 207 if counts["failed"] else 200
+
 @app.route("/dbtype")
 def dbtype():
     return jsonify({"db_type": DB_TYPE})
@@ -158,60 +470,609 @@ def sniff_mime():
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
+@app.route("/sniff-mime/batch", methods=["POST"])
+def sniff_mime_batch():
+    try:
+        image_files = request.files.getlist("image_data")
+        if not image_files:
+            raise KeyError("image_data")
+        return jsonify([
+            {"filename": image_file.filename, "mime_type": sniff_mime_type(image_file)}
+            for image_file in image_files
+        ])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+def wants_raw_image():
+    # Raw bytes only when the client ranks some image/* type above JSON, so fetch()
+    # with */* keeps the legacy JSON while <img> tags get the image itself
+    image_quality = max(
+        (quality for mime, quality in request.accept_mimetypes if mime.startswith("image/")),
+        default=0,
+    )
+    return image_quality > request.accept_mimetypes["application/json"]
+
+def send_stored_image(image):
+    if image.path:
+        if IMAGE_SENDFILE == "x-accel-redirect":
+            response = Response(mimetype=image.mime_type)
+            response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + image.relative_path
+            return response
+        # send_file emits X-Sendfile when USE_X_SENDFILE is set, otherwise wraps the file
+        return send_file(image.path, mimetype=image.mime_type, conditional=False, etag=False)
+    return Response(image.data, mimetype=image.mime_type, headers={"Content-Length": str(image.size)})
+
+def image_etag(image):
+    # Rows stored before content hashing fall back to the id, which is never reused
+    return image.content_hash or f"id-{image.image_id}"
+
+def listing_etag(image_ids):
+    return hashlib.sha256("\n".join(sorted(image_ids)).encode("utf-8")).hexdigest()
+
+def set_validators(response, etag, last_modified=None, cache_control=REVALIDATE_CACHE_CONTROL, weak=False):
+    response.set_etag(etag, weak=weak)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+def requested_ranges(size, etag, last_modified):
+    # None means "send the whole image", an empty list means "not satisfiable"
+    byte_range = request.range
+    if byte_range is None or byte_range.units != "bytes":
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (last_modified is None or last_modified.replace(microsecond=0) != if_range.date):
+        return None
+    ranges = []
+    for begin, end in byte_range.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            ranges.append((start, stop))
+    # Coalesce overlapping and adjacent ranges so a client cannot multiply the work
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+def iter_image_range(image, start, stop):
+    # Check a connection out per chunk so slow clients never pin one
+    position = start
+    while position < stop:
+        length = min(RANGE_CHUNK_SIZE, stop - position)
+        if image.blobs is not None:
+            chunk = read_image_range(None, DB_TYPE, image, position, length)
+        else:
+            with db_pool.connection(readonly=True) as conn:
+                chunk = read_image_range(conn, DB_TYPE, image, position, length)
+        if not chunk:
+            raise LookupError(f"Image {image.image_id} ended early at byte {position}")
+        yield chunk
+        position += len(chunk)
+
+def partial_image_response(image, ranges):
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(iter_image_range(image, start, stop), status=206, mimetype=image.mime_type)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{image.size}"
+        response.headers["Content-Length"] = str(stop - start)
+        return response
+
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (
+            f"--{boundary}\r\nContent-Type: {image.mime_type}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{image.size}\r\n\r\n"
+        ).encode("latin-1")
+        for start, stop in ranges
+    ]
+    closing = f"--{boundary}--\r\n".encode("latin-1")
+
+    def generate():
+        for header, (start, stop) in zip(part_headers, ranges):
+            yield header
+            yield from iter_image_range(image, start, stop)
+            yield b"\r\n"
+        yield closing
+
+    length = sum(len(header) + (stop - start) + 2 for header, (start, stop) in zip(part_headers, ranges)) + len(closing)
+    response = Response(generate(), status=206, content_type=f"multipart/byteranges; boundary={boundary}")
+    response.headers["Content-Length"] = str(length)
+    return response
+
+def serve_raw_image(image_id=None, nickname=None):
+    cache_control = IMMUTABLE_CACHE_CONTROL if image_id else REVALIDATE_CACHE_CONTROL
+    conn = None
+    try:
+        conn = db_pool.getconn(readonly=True)
+        image = find_image(conn, DB_TYPE, image_id=image_id, nickname=nickname, blobs=blob_store)
+        if image is None:
+            return jsonify({"error": "Image not found"}), 404
+        etag = image_etag(image)
+        # Answer revalidations from the metadata row alone, before reading the blob
+        if not is_resource_modified(request.environ, etag=etag, last_modified=image.created_at):
+            return set_validators(Response(status=304), etag, image.created_at, cache_control)
+        # nginx and Apache apply Range themselves to files they are told to send
+        delegated = image.path and IMAGE_SENDFILE != "wsgi"
+        ranges = None if delegated else requested_ranges(image.size, etag, image.created_at)
+        if ranges == []:
+            response = Response(status=416)
+            response.headers["Content-Range"] = f"bytes */{image.size}"
+            return set_validators(response, etag, image.created_at, cache_control)
+        if ranges:
+            response = partial_image_response(image, ranges)
+        else:
+            if not image.path:
+                read_image_data(conn, DB_TYPE, image)
+            response = send_stored_image(image)
+    except Exception as e:
+        logging.error(f"Error fetching raw image (id={image_id}, nickname={nickname}): {e}")
+        return jsonify({"error": "Error fetching image", "details": str(e)}), 500
+    finally:
+        if conn:
+            db_pool.putconn(conn)
+    response.headers["Accept-Ranges"] = "bytes"
+    return set_validators(response, etag, image.created_at, cache_control)
+
+@app.route("/images/id/<image_id>/raw")
+def get_raw_image(image_id):
+    try:
+        image_id = str(uuid.UUID(image_id))
+    except ValueError:
+        return jsonify({"error": "Image not found"}), 404
+    return serve_raw_image(image_id=image_id)
+
+@app.route("/images/id/<image_id>", methods=["DELETE"])
+def delete_image_by_id(image_id):
+    try:
+        image_id = str(uuid.UUID(image_id))
+    except ValueError:
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        with db_pool.connection() as conn:
+            nickname = delete_image(conn, DB_TYPE, image_id)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error deleting image {image_id}: {e}")
+        return jsonify({"error": "Error deleting image", "details": str(e)}), 500
+    if nickname is None:
+        return jsonify({"error": "Image not found"}), 404
+    invalidate_nickname(nickname)
+    logging.info(f"Deleted image {image_id} (nickname '{nickname}').")
+    return "", 204
+
+def encode_page_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_page_cursor(token):
+    # Raises ValueError for anything encode_page_cursor did not produce
+    return json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+
+def decode_image_cursor(token):
+    key = decode_page_cursor(token)
+    if not (isinstance(key, list) and len(key) == 2 and isinstance(key[1], str)
+            and (key[0] is None or isinstance(key[0], str))):
+        raise ValueError("Malformed cursor")
+    if key[0] is not None:
+        datetime.fromisoformat(key[0])
+    return key[0], str(uuid.UUID(key[1]))
+
+def decode_nickname_cursor(token):
+    key = decode_page_cursor(token)
+    if not isinstance(key, str):
+        raise ValueError("Malformed cursor")
+    return key
+
+def listing_page_args(decode_cursor):
+    # (limit, key to continue after) from the query string; raises ValueError if either is invalid
+    limit = int(request.args.get("limit", LIST_PAGE_SIZE))
+    if not 1 <= limit <= LIST_MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {LIST_MAX_PAGE_SIZE}")
+    cursor = request.args.get("cursor")
+    return limit, decode_cursor(cursor) if cursor else None
+
+def listing_response(key, items, next_key, endpoint, **args):
+    next_cursor = encode_page_cursor(next_key) if next_key is not None else None
+    next_url = url_for(endpoint, cursor=next_cursor, **args) if next_cursor else None
+    response = jsonify({key: items, "next_cursor": next_cursor, "next": next_url})
+    if next_url:
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+    return response
+
+@app.route("/images")
+def list_images():
+    try:
+        limit, after = listing_page_args(decode_image_cursor)
+    except ValueError as e:
+        return jsonify({"error": "Invalid limit or cursor", "details": str(e)}), 400
+    nickname = request.args.get("nickname")
+    try:
+        with db_pool.connection(readonly=True) as conn:
+            images, next_key = list_images_page(conn, DB_TYPE, nickname=nickname, after=after, limit=limit)
+    except Exception as e:
+        logging.error(f"Error listing images: {e}")
+        return jsonify({"error": "Error listing images", "details": str(e)}), 500
+    items = [
+        {
+            "id": image.image_id,
+            "nickname": image.nickname,
+            "mime_type": image.mime_type,
+            "size": image.size,
+            "created_at": image.created_at.isoformat() if image.created_at else None,
+            "urls": {
+                "raw": url_for("get_raw_image", image_id=image.image_id),
+                "nickname": url_for("get_image", nickname=image.nickname),
+            },
+        }
+        for image in images
+    ]
+    return listing_response("images", items, next_key, "list_images", limit=limit, nickname=nickname)
+
+@app.route("/nicknames")
+def list_nicknames():
+    try:
+        limit, after = listing_page_args(decode_nickname_cursor)
+    except ValueError as e:
+        return jsonify({"error": "Invalid limit or cursor", "details": str(e)}), 400
+    try:
+        with db_pool.connection(readonly=True) as conn:
+            nicknames, next_key = list_nicknames_page(conn, DB_TYPE, after=after, limit=limit)
+    except Exception as e:
+        logging.error(f"Error listing nicknames: {e}")
+        return jsonify({"error": "Error listing nicknames", "details": str(e)}), 500
+    items = [
+        {
+            "nickname": nickname,
+            "image_count": count,
+            "urls": {
+                "images": url_for("get_image", nickname=nickname),
+                "listing": url_for("list_images", nickname=nickname),
+            },
+        }
+        for nickname, count in nicknames
+    ]
+    return listing_response("nicknames", items, next_key, "list_nicknames", limit=limit)
+
 @app.route("/images/<nickname>")
 def get_image(nickname):
-    conn = None
-    cur = None
-    try:
-        # Try to fetch image data from Redis cache if Redis is available
-        if use_redis and redis_client:
-            cached_image = redis_client.get(nickname)
-            if cached_image:
-                logging.info(f"Cache hit for nickname '{nickname}'.")
-                image_data, mime_type = cached_image.split(b'|')
-                return jsonify([{
-                    'image_data': base64.b64encode(image_data).decode('utf-8'),
-                    'mime_type': mime_type.decode('utf-8')
-                }])
-
-        # If cache miss or Redis is not used, fetch from database
-        logging.info(f"Cache miss for nickname '{nickname}' or caching is disabled. Fetching from database.")
-        conn = get_db_connection()
+    # Raw bytes and JSON share this URL, so shared caches must key on Accept
+    response = app.make_response(get_image_response(nickname))
+    response.vary.add("Accept")
+    return response
+
+def images_json_response(images, warning=None):
+    etag = listing_etag([image.image_id for image in images])
+    if request.if_none_match.contains_weak(etag):
+        response = set_validators(Response(status=304), etag, weak=True)
+    else:
+        response = Response(iter_images_json(images), mimetype="application/json")
+        response.content_length = images_json_length(images)
+        set_validators(response, etag, weak=True)
+    if warning:
+        response.headers["Warning"] = warning
+    return response
+
+def iter_images_json(images):
+    # The [{"image_data": <base64>, "mime_type": ...}] list, written piece by piece: image
+    # bytes (or zero-copy views of a cache entry) are encoded BASE64_CHUNK_SIZE at a time
+    # straight into the output, so neither a whole image's base64 nor the list is built
+    yield b"["
+    for position, image in enumerate(images):
+        yield b',{"image_data":"' if position else b'{"image_data":"'
+        data = memoryview(image.image_data)
+        for start in range(0, len(data), BASE64_CHUNK_SIZE):
+            yield base64.b64encode(data[start:start + BASE64_CHUNK_SIZE])
+        yield b'","mime_type":' + json.dumps(image.mime_type).encode("utf-8") + b"}"
+    yield b"]\n"
+
+def images_json_length(images):
+    # Exact length of iter_images_json(images)
+    length = len(b"[]\n") + max(len(images) - 1, 0)
+    for image in images:
+        length += len(b'{"image_data":"","mime_type":}') + 4 * ((len(image.image_data) + 2) // 3)
+        length += len(json.dumps(image.mime_type).encode("utf-8"))
+    return length
+
+def limit_statement_time(conn):
+    # Only for the current transaction: migrations, gc, import and export share these
+    # connections and are expected to run far longer than a nickname read
+    if DB_TYPE == "postgres" and DB_STATEMENT_TIMEOUT_MS:
         cur = conn.cursor()
-        if DB_TYPE == "postgres":
-            cur.execute("SELECT image_data, mime_type FROM images WHERE nickname = %s", (nickname,))
-        elif DB_TYPE == "sqlite":
-            cur.execute("SELECT image_data, mime_type FROM images WHERE nickname = ?", (nickname,))
-        rows = cur.fetchall()
-
-        images = []
-        for row in rows:
-            image_data, mime_type = row
-            if hasattr(image_data, 'tobytes'):
-                image_data = image_data.tobytes()
-            base64_encoded_data = base64.b64encode(image_data).decode('utf-8')
-            images.append({'image_data': base64_encoded_data, 'mime_type': mime_type})
-
-        if images:
-            logging.info(f"Fetched images for nickname '{nickname}'.")
-            # Cache the first image found if Redis is available
-            if use_redis and redis_client:
-                to_cache = b'|'.join([image_data, mime_type.encode('utf-8')])
-                redis_client.set(nickname, to_cache)
-        else:
-            logging.info(f"No images found for nickname '{nickname}'.")
+        try:
+            cur.execute("SET LOCAL statement_timeout = %s", (DB_STATEMENT_TIMEOUT_MS,))
+        finally:
+            cur.close()
+
+def open_nickname_stream(nickname):
+    # Yields the nickname's (id, size) listing first, then its images one at a time; all
+    # are read from one snapshot on one read-only connection, so the ETag matches the body
+    with db_pool.connection(readonly=True) as conn:
+        begin_read_snapshot(conn, DB_TYPE)
+        limit_statement_time(conn)
+        yield list_image_sizes(conn, DB_TYPE, nickname)
+        for image in iter_images(conn, DB_TYPE, nickname=nickname, blobs=blob_store):
+            read_image_data(conn, DB_TYPE, image)
+            yield CachedImage(image.image_id, image.mime_type, image.data)
+
+def remember_locally(nickname, images, version):
+    if local_cache:
+        ttl = None if images else min(L1_CACHE_TTL, CACHE_NEGATIVE_TTL)
+        local_cache.set(nickname, images, entry_size(images), ttl=ttl, stale_ttl=CACHE_STALE_TTL, version=version)
+
+def fetch_nickname_images(nickname):
+    logging.info(f"Cache miss for nickname '{nickname}' or caching is disabled. Fetching from database.")
+    with db_pool.connection(readonly=True) as conn:
+        limit_statement_time(conn)
+        stored = fetch_images(conn, DB_TYPE, nickname, blobs=blob_store)
+    images = [CachedImage(image.image_id, image.mime_type, image.data) for image in stored]
+    if images:
+        logging.info(f"Fetched images for nickname '{nickname}'.")
+    else:
+        logging.info(f"No images found for nickname '{nickname}'.")
+    return images
+
+def load_nickname_images(nickname, generation, wait=True):
+    # Runs once per process per nickname; with Redis, once across all processes
+    if generation is not None:
+        try:
+            return image_cache.fill(
+                nickname,
+                generation,
+                lambda: fetch_nickname_images(nickname),
+                lock_ttl=CACHE_FILL_LOCK_TTL,
+                wait_timeout=SINGLE_FLIGHT_TIMEOUT,
+                wait=wait,
+            )
+        except redis.RedisError as e:
+            logging.warning(f"Redis fill coordination failed for nickname '{nickname}': {e}")
+    return fetch_nickname_images(nickname)
+
+def refresh_nickname_images(nickname, local_version):
+    generation = None
+    if image_cache:
+        try:
+            generation = image_cache.generation(nickname)
+        except redis.RedisError as e:
+            logging.warning(f"Redis lookup failed for nickname '{nickname}': {e}")
+    # Another process already refreshing it means there is nothing left to do here. The
+    # key is not the foreground loads' one: their waiters must never get this None
+    images = nickname_loads.do(
+        ("refresh", nickname), lambda: load_nickname_images(nickname, generation, wait=False),
+        timeout=SINGLE_FLIGHT_TIMEOUT,
+    )
+    if images is not None:
+        remember_locally(nickname, images, local_version)
+
+def get_image_response(nickname):
+    if wants_raw_image():
+        return serve_raw_image(nickname=nickname)
+    try:
+        # Check the in-process cache first, then Redis if it is available; remember
+        # the least stale expired copy in case it can still be served
+        stale_images = None
+        stale_for = None
+        local_version = None
+        if local_cache:
+            entry = local_cache.get_entry(nickname)
+            if entry is not None:
+                cached_images, stale_for = entry
+                if not stale_for:
+                    logging.info(f"Local cache hit for nickname '{nickname}'.")
+                    return images_json_response(cached_images)
+                stale_images = cached_images
+            local_version = local_cache.version()
+
+        generation = None
+        if image_cache:
+            try:
+                entry = image_cache.get_entry(nickname)
+                if entry is not None:
+                    cached_images, redis_stale_for = entry
+                    if not redis_stale_for:
+                        logging.info(f"Cache hit for nickname '{nickname}'.")
+                        remember_locally(nickname, cached_images, local_version)
+                        return images_json_response(cached_images)
+                    if stale_images is None or redis_stale_for < stale_for:
+                        stale_images, stale_for = cached_images, redis_stale_for
+                generation = image_cache.generation(nickname)
+            except redis.RedisError as e:
+                logging.warning(f"Redis lookup failed for nickname '{nickname}': {e}")
+
+        # Recently expired: answer from the stale copy and reload behind the scenes
+        if stale_images is not None and stale_for <= CACHE_STALE_WHILE_REVALIDATE:
+            logging.info(f"Serving stale images for nickname '{nickname}' while revalidating.")
+            stale_refreshes.submit(nickname, lambda: refresh_nickname_images(nickname, local_version))
+            return images_json_response(stale_images, warning='110 - "Response is Stale"')
+
+        try:
+            # Revalidation and deciding whether to stream only need ids and sizes, which
+            # never touch the blobs
+            stream = open_nickname_stream(nickname)
+            streaming = False
+            try:
+                listing = next(stream)
+                etag = listing_etag([image_id for image_id, _ in listing])
+                if request.if_none_match.contains_weak(etag):
+                    return set_validators(Response(status=304), etag, weak=True)
+                streaming = sum(size for _, size in listing) > NICKNAME_STREAM_BYTES
+            finally:
+                if not streaming:
+                    stream.close()
+            if streaming:
+                # Too large to cache, so hold only one image in memory at a time
+                logging.info(f"Streaming {len(listing)} images for nickname '{nickname}'.")
+                response = Response(iter_images_json(stream), mimetype="application/json")
+                return set_validators(response, etag, weak=True)
+
+            # Concurrent misses for the same nickname share a single database load
+            images = nickname_loads.do(
+                nickname, lambda: load_nickname_images(nickname, generation), timeout=SINGLE_FLIGHT_TIMEOUT
+            )
+        except Exception as e:
+            if stale_images is not None and stale_for <= CACHE_STALE_IF_ERROR:
+                logging.warning(f"Serving stale images for nickname '{nickname}' after load failure: {e}")
+                return images_json_response(stale_images, warning='111 - "Revalidation Failed"')
+            raise
+        remember_locally(nickname, images, local_version)
+        return images_json_response(images)
 
-        return jsonify(images)
+    except SingleFlightTimeout as e:
+        logging.warning(f"Gave up waiting for images for nickname '{nickname}': {e}")
+        response = jsonify({"error": f"Timed out loading images for nickname '{nickname}'"})
+        response.headers["Retry-After"] = "1"
+        return response, 503
 
     except Exception as e:
         logging.error(f"Error fetching images for nickname '{nickname}': {e}")
         return jsonify({"error": f"Error fetching images for nickname '{nickname}'", "details": str(e)}), 500
 
+def parse_export_time(value):
+    # ISO 8601 date or date-time; times without an offset are taken as UTC
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def stream_export(archive_format, nickname, since, until):
+    # Holds one read-only connection, and the snapshot it reads, until the last byte is sent
+    with db_pool.connection(readonly=True) as conn:
+        yield from export_archive(
+            conn, DB_TYPE, archive_format, nickname=nickname, since=since, until=until, blobs=blob_store,
+            chunk_size=EXPORT_CHUNK_SIZE, batch_size=EXPORT_BATCH_SIZE,
+        )
+
+@app.route("/export")
+def export():
+    archive_format = request.args.get("format", "tar")
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(ARCHIVE_FORMATS)}"}), 400
+    try:
+        since = parse_export_time(request.args.get("since"))
+        until = parse_export_time(request.args.get("until"))
+    except ValueError as e:
+        return jsonify({"error": "since and until must be ISO 8601 dates", "details": str(e)}), 400
+    nickname = request.args.get("nickname") or None
+    filename = f"{nickname or 'images'}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.{archive_format}"
+    response = Response(
+        stream_export(archive_format, nickname, since, until),
+        mimetype="application/x-tar" if archive_format == "tar" else "application/zip",
+    )
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    # Every export is a fresh snapshot, so neither browsers nor proxies should keep it
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+@app.route("/stats")
+def stats():
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "write_queue": write_queue.stats() if write_queue else None,
+        "blob_store": blob_store.stats(),
+        "local_cache": local_cache.stats() if local_cache else None,
+        "single_flight": nickname_loads.stats(),
+        "stale_refreshes": stale_refreshes.stats(),
+        "redis_cache": image_cache.stats() if image_cache else None,
+        "redis_circuit": redis_client.breaker.stats() if redis_client else None,
+    })
+
+@app.cli.command("gc")
+@click.option("--grace", default=BLOB_GC_GRACE, show_default=True,
+              help="Seconds before an unreferenced entry in the blob store may be removed.")
+def gc_command(grace):
+    """Delete blobs that no image references any more."""
+    with db_pool.connection() as conn:
+        rows, entries = collect_garbage(conn, DB_TYPE, blobs=blob_store, grace_seconds=grace)
+    logging.info(f"Garbage collection removed {rows} unreferenced blobs and {entries} orphaned store entries.")
+
+@app.cli.command("import")
+@click.argument("source", type=click.Path(exists=True))
+@click.option("--nickname", default=None, help="Nickname for every image; defaults to each file's directory name.")
+@click.option("--checkpoint", "checkpoint_path", default=None,
+              help="Progress file used to resume; defaults to <source name>.import-checkpoint.json.")
+@click.option("--workers", default=IMPORT_WORKERS, show_default=True, help="Hashing processes; 0 uses every CPU.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True, help="Files per transaction.")
+@click.option("--batch-bytes", default=IMPORT_BATCH_BYTES, show_default=True, help="Bytes per transaction at most.")
+def import_command(source, nickname, checkpoint_path, workers, batch_size, batch_bytes):
+    """Bulk-import the images in a directory tree or a (compressed) tar archive."""
+    checkpoint_path = checkpoint_path or f"{os.path.basename(os.path.normpath(source))}.import-checkpoint.json"
+    importer = Importer(db_pool, DB_TYPE, blobs=blob_store, nickname=nickname, workers=workers or None,
+                        batch_size=batch_size, batch_bytes=batch_bytes)
+    try:
+        counters = importer.run(source, ImportCheckpoint(checkpoint_path, source))
     finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        # Cached listings of the nicknames that gained images are stale now
+        for nickname in importer.nicknames:
+            invalidate_nickname(nickname)
+    click.echo(f"Imported {counters['imported']} images ({counters['duplicates']} duplicates), "
+               f"skipped {counters['skipped']}, failed {counters['failed']}.")
+
+@app.cli.command("export")
+@click.argument("output", type=click.File("wb"))
+@click.option("--format", "archive_format", type=click.Choice(ARCHIVE_FORMATS), default=None,
+              help="Archive format; defaults to OUTPUT's extension, or tar.")
+@click.option("--nickname", default=None, help="Only export images stored under this nickname.")
+@click.option("--since", default=None, help="Only export images created at or after this ISO 8601 time.")
+@click.option("--until", default=None, help="Only export images created before this ISO 8601 time.")
+def export_command(output, archive_format, nickname, since, until):
+    """Stream images into a tar or zip archive with a manifest of their hashes ("-" writes to stdout)."""
+    try:
+        since, until = parse_export_time(since), parse_export_time(until)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--since/--until")
+    archive_format = archive_format or archive_format_for(output.name) or "tar"
+    for chunk in stream_export(archive_format, nickname, since, until):
+        output.write(chunk)
+
+@app.cli.group("db")
+def db_command():
+    """Inspect and apply schema migrations."""
+
+@db_command.command("status")
+def db_status_command():
+    """List migrations and whether each has been applied."""
+    with db_pool.connection() as conn:
+        applied = set(applied_versions(conn, DB_TYPE))
+    for migration in MIGRATIONS:
+        state = "applied" if migration.version in applied else "pending"
+        click.echo(f"{migration.version:4d}  {state:8s}  {migration.name}")
+
+@db_command.command("upgrade")
+@click.option("--to", "target", type=int, default=None, help="Stop after this version instead of the latest.")
+def db_upgrade_command(target):
+    """Apply pending migrations in order."""
+    with db_pool.connection() as conn:
+        applied = apply_migrations(conn, DB_TYPE, target=target)
+    click.echo(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
+
+@db_command.command("rekey-ids")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows renamed per transaction.")
+@click.option("--mapping", type=click.File("w"), default=None, help="Write an old_id,new_id CSV here.")
+@click.confirmation_option(prompt="Existing image URLs will stop working. Rewrite every non-UUIDv7 id?")
+def db_rekey_ids_command(batch_size, mapping):
+    """Give images stored with random uuid4 ids time-ordered UUIDv7 ids."""
+    renamed = 0
+    nicknames = set()
+    with db_pool.connection() as conn:
+        for old_id, new_id, nickname in rekey_image_ids(conn, DB_TYPE, batch_size=batch_size):
+            if mapping:
+                mapping.write(f"{old_id},{new_id}\n")
+            nicknames.add(nickname)
+            renamed += 1
+    for nickname in nicknames:
+        invalidate_nickname(nickname)
+    click.echo(f"Rekeyed {renamed} images across {len(nicknames)} nicknames.")
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,170 @@
+import argparse
+import io
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+import psycopg2
+
+from ids import uuid7
+
+ID_GENERATORS = {"uuid4": uuid.uuid4, "uuid7": uuid7}
+
+
+def _rows(make_id, count):
+    # Same shape as an images row; only the id differs between runs
+    for _ in range(count):
+        yield (str(make_id()), f"user{int.from_bytes(os.urandom(2), 'big') % 1000}", "image/jpeg",
+               int.from_bytes(os.urandom(3), "big"), os.urandom(32).hex())
+
+
+class PostgresTarget:
+    """Loads rows with COPY, one transaction per batch, as the importer does."""
+
+    def __init__(self, dsn):
+        self.conn = psycopg2.connect(dsn)
+
+    def create(self, table):
+        cur = self.conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(f"""
+            CREATE TABLE {table} (
+                image_id UUID PRIMARY KEY,
+                nickname TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                byte_size BIGINT NOT NULL,
+                content_hash TEXT NOT NULL,
+                created_at TIMESTAMPTZ DEFAULT now()
+            )
+        """)
+        self.conn.commit()
+        try:
+            # Start each run right after a checkpoint so both pay the same full-page writes
+            cur.execute("CHECKPOINT")
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logging.warning(f"Could not checkpoint before the run: {e}")
+        cur.execute("SELECT pg_current_wal_lsn()")
+        self._wal_start = cur.fetchone()[0]
+        cur.close()
+
+    def insert(self, table, rows):
+        buf = io.StringIO("".join("\t".join(map(str, row)) + "\n" for row in rows))
+        cur = self.conn.cursor()
+        cur.copy_expert(f"COPY {table} (image_id, nickname, mime_type, byte_size, content_hash) FROM STDIN", buf)
+        self.conn.commit()
+        cur.close()
+
+    def measure(self, table):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT pg_relation_size(%s), pg_wal_lsn_diff(pg_current_wal_lsn(), %s)",
+            (f"{table}_pkey", self._wal_start)
+        )
+        index_bytes, wal_bytes = cur.fetchone()
+        cur.close()
+        return {"index_bytes": index_bytes, "wal_bytes": int(wal_bytes)}
+
+    def drop(self, table):
+        cur = self.conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        self.conn.commit()
+        cur.close()
+
+
+class SQLiteTarget:
+    """Loads rows with executemany, one transaction per batch."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+
+    def create(self, table):
+        self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self.conn.execute(f"""
+            CREATE TABLE {table} (
+                id TEXT PRIMARY KEY,
+                nickname TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                byte_size INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.conn.commit()
+
+    def insert(self, table, rows):
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {table} (id, nickname, mime_type, byte_size, content_hash) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def measure(self, table):
+        try:
+            index_bytes = self.conn.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (f"sqlite_autoindex_{table}_1",)
+            ).fetchone()[0]
+        except sqlite3.OperationalError:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+            index_bytes = None
+        return {"index_bytes": index_bytes}
+
+    def drop(self, table):
+        self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self.conn.commit()
+
+
+def run(target, id_kind, rows, batch_size, report_every, keep=False):
+    """Insert ``rows`` rows keyed by ``id_kind`` ids and return throughput and index size."""
+    table = f"bench_ids_{id_kind}"
+    make_id = ID_GENERATORS[id_kind]
+    target.create(table)
+    elapsed = 0.0
+    done = 0
+    interval_start, interval_elapsed = 0, 0.0
+    while done < rows:
+        # Generate outside the timed section so only the database work is measured
+        batch = list(_rows(make_id, min(batch_size, rows - done)))
+        started = time.perf_counter()
+        target.insert(table, batch)
+        took = time.perf_counter() - started
+        elapsed += took
+        interval_elapsed += took
+        done += len(batch)
+        if done - interval_start >= report_every or done == rows:
+            logging.info(f"{id_kind}: {done} rows, {(done - interval_start) / interval_elapsed:,.0f} rows/s over the last {done - interval_start}.")
+            interval_start, interval_elapsed = done, 0.0
+    result = {"ids": id_kind, "rows": rows, "seconds": round(elapsed, 2), "rows_per_second": round(rows / elapsed)}
+    result.update(target.measure(table))
+    if not keep:
+        target.drop(table)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare uuid4 and UUIDv7 primary keys for the images table.")
+    parser.add_argument("--db", choices=["postgres", "sqlite"], default=os.getenv("DB_TYPE", "postgres"))
+    parser.add_argument("--dsn", default="dbname=photo_db user=postgres host=localhost",
+                        help="libpq connection string for --db postgres")
+    parser.add_argument("--path", default="/tmp/bench_ids.db", help="Database file for --db sqlite")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--report-every", type=int, default=1_000_000)
+    parser.add_argument("--ids", default="uuid4,uuid7", help="Comma-separated id kinds to run, in order")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark tables afterwards")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    target = PostgresTarget(args.dsn) if args.db == "postgres" else SQLiteTarget(args.path)
+    results = [
+        run(target, id_kind, args.rows, args.batch_size, args.report_every, keep=args.keep)
+        for id_kind in args.ids.split(",")
+    ]
+    columns = list(results[0])
+    print("  ".join(f"{column:>15s}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result.get(column)):>15s}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
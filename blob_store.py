@@ -0,0 +1,131 @@
+import logging
+import os
+import tempfile
+import time
+
+FSYNC_POLICIES = ("always", "file", "never")
+
+
+class InlineBlobStore:
+    """Keeps image bytes in the database, in the ``data`` column of the blobs table."""
+
+    external = False
+    serves_files = False
+    name = "inline"
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class FileBlobStore:
+    """Content-addressed image store on the local filesystem.
+
+    Each image lives at ``<root>/<ab>/<cd>/<sha256>``, where ``ab`` and ``cd`` are
+    the first two byte pairs of its SHA-256, so no directory grows past 65536
+    entries. Writes go to a temporary file under ``<root>/tmp`` and are renamed
+    into place, so readers never see a partial image. ``fsync`` controls
+    durability: ``always`` syncs the file and its directory, ``file`` only the
+    file, and ``never`` leaves flushing to the OS.
+    """
+
+    external = True
+    serves_files = True
+    name = "filesystem"
+
+    def __init__(self, root, fsync="always"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy {fsync!r}; expected one of {', '.join(FSYNC_POLICIES)}")
+        self.root = os.path.abspath(root)
+        self.fsync = fsync
+        self._tmp = os.path.join(self.root, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+
+    def relative_path(self, content_hash):
+        if len(content_hash) != 64 or not all(c in "0123456789abcdef" for c in content_hash):
+            raise ValueError(f"Not a SHA-256 hex digest: {content_hash!r}")
+        return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+    def path(self, content_hash):
+        return os.path.join(self.root, self.relative_path(content_hash))
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def write(self, upload):
+        """Stream ``upload`` (an UploadStream) into the store and return its content hash."""
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp, prefix="upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in upload.chunks():
+                    f.write(chunk)
+                if self.fsync != "never":
+                    f.flush()
+                    os.fsync(f.fileno())
+            content_hash = upload.content_hash
+            path = self.path(content_hash)
+            directory = os.path.dirname(path)
+            new_shard = not os.path.isdir(directory)
+            if new_shard:
+                os.makedirs(directory, exist_ok=True)
+            # Identical content maps to the same name, so replacing an existing file is harmless
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if self.fsync == "always":
+            self._fsync_dir(directory)
+            if new_shard:
+                # The shard directories themselves must survive a crash too
+                self._fsync_dir(os.path.dirname(directory))
+                self._fsync_dir(self.root)
+        return content_hash
+
+    def read(self, content_hash):
+        with open(self.path(content_hash), "rb") as f:
+            return f.read()
+
+    def read_range(self, content_hash, start, length):
+        with open(self.path(content_hash), "rb") as f:
+            f.seek(start)
+            return f.read(length)
+
+    def delete(self, content_hash, older_than=None):
+        """Remove a blob; with ``older_than``, only if it was written at least that many seconds ago."""
+        path = self.path(content_hash)
+        try:
+            if older_than is not None and time.time() - os.stat(path).st_mtime < older_than:
+                return False
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def iter_hashes(self, older_than=0):
+        """Hashes of stored blobs written at least ``older_than`` seconds ago."""
+        cutoff = time.time() - older_than
+        for first in sorted(os.listdir(self.root)):
+            if len(first) != 2 or first == "tmp":
+                continue
+            for second in sorted(os.listdir(os.path.join(self.root, first))):
+                with os.scandir(os.path.join(self.root, first, second)) as entries:
+                    for entry in entries:
+                        if len(entry.name) == 64 and entry.stat().st_mtime <= cutoff:
+                            yield entry.name
+
+    def stats(self):
+        return {"backend": self.name, "root": self.root, "fsync": self.fsync}
+
+    @staticmethod
+    def _fsync_dir(directory):
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError as e:
+            logging.warning(f"Could not open {directory} to fsync it: {e}")
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,566 @@
+import logging
+import os
+import queue
+import secrets
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+from redis.commands.core import Script
+
+CachedImage = namedtuple("CachedImage", ["image_id", "mime_type", "image_data"])
+
+# Entry layout: header (magic, format version, fresh-until epoch time, image count)
+# followed by every image as three length-prefixed fields. Length prefixes mean
+# image bytes can contain anything, and an unknown magic or version is a miss.
+_MAGIC = b"PIMG"
+_VERSION = 2
+_HEADER = struct.Struct(">4sBdI")
+_LENGTH = struct.Struct(">I")
+
+
+def encode_entry(images, fresh_until=0.0):
+    parts = [_HEADER.pack(_MAGIC, _VERSION, fresh_until, len(images))]
+    for image in images:
+        for field in (image.image_id.encode("utf-8"), image.mime_type.encode("utf-8"), image.image_data):
+            parts.append(_LENGTH.pack(len(field)))
+            parts.append(field)
+    return b"".join(parts)
+
+
+def entry_size(images):
+    return _HEADER.size + sum(
+        3 * _LENGTH.size + len(image.image_id.encode("utf-8")) + len(image.mime_type.encode("utf-8")) + len(image.image_data)
+        for image in images
+    )
+
+
+def decode_entry(blob):
+    """Return ``(images, fresh_until)``, or None if ``blob`` is not a valid entry."""
+    if blob is None or len(blob) < _HEADER.size:
+        return None
+    magic, version, fresh_until, count = _HEADER.unpack_from(blob)
+    if magic != _MAGIC or version != _VERSION:
+        return None
+    view = memoryview(blob)
+    offset = _HEADER.size
+    images = []
+    try:
+        for _ in range(count):
+            fields = []
+            for _ in range(3):
+                (length,) = _LENGTH.unpack_from(view, offset)
+                offset += _LENGTH.size
+                if offset + length > len(view):
+                    return None
+                fields.append(view[offset:offset + length])
+                offset += length
+            image_id, mime_type, image_data = fields
+            # Image bytes stay a zero-copy view into the Redis reply
+            images.append(CachedImage(str(image_id, "utf-8"), str(mime_type, "utf-8"), image_data))
+    except struct.error:
+        return None
+    return images, fresh_until
+
+
+# Store only if the nickname's generation is unchanged since the reader started, so
+# a slow reader can never overwrite the invalidation done by a concurrent upload.
+_SET_IF_GENERATION = """
+local current = redis.call('GET', KEYS[2])
+if (current or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Release a fill lock only if it still belongs to the caller.
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ImageCache:
+    """Redis cache of the complete image list for each nickname.
+
+    Entries are fresh for ``ttl`` seconds and then kept for another ``stale_ttl``
+    seconds so they can still be served while revalidating or when loading fails.
+    Entries are stored through ``writer`` when given: a client whose socket
+    timeout allows for sending ``max_entry_bytes``.
+    """
+
+    def __init__(self, redis_client, ttl=3600, negative_ttl=60, stale_ttl=0, max_entry_bytes=32 * 1024 * 1024,
+                 prefix="photo_app:images:v1", writer=None):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.prefix = prefix
+        self._set_if_generation = (writer or redis_client).register_script(_SET_IF_GENERATION)
+        self._release_lock = redis_client.register_script(_RELEASE_LOCK)
+        self._lock = threading.Lock()
+        self._counters = {"fill_locks_acquired": 0, "fill_waits": 0, "fill_wait_hits": 0, "fill_wait_timeouts": 0}
+
+    def _key(self, nickname):
+        return f"{self.prefix}:nickname:{nickname}"
+
+    def _generation_key(self, nickname):
+        return f"{self.prefix}:generation:{nickname}"
+
+    def _lock_key(self, nickname):
+        return f"{self.prefix}:fill-lock:{nickname}"
+
+    def get(self, nickname):
+        """Fresh cached images for ``nickname`` (an empty list for a cached miss), or None."""
+        entry = self.get_entry(nickname)
+        if entry is None or entry[1] > 0:
+            return None
+        return entry[0]
+
+    def get_entry(self, nickname):
+        """``(images, seconds_stale)`` for ``nickname``, including stale entries, or None."""
+        entry = decode_entry(self.redis.get(self._key(nickname)))
+        if entry is None:
+            return None
+        images, fresh_until = entry
+        return images, max(0.0, time.time() - fresh_until)
+
+    def generation(self, nickname):
+        # Read before loading from the database and pass to set()
+        value = self.redis.get(self._generation_key(nickname))
+        return value.decode("ascii") if value else "0"
+
+    def set(self, nickname, images, generation):
+        size = entry_size(images)
+        if size > self.max_entry_bytes:
+            logging.info(f"Not caching nickname '{nickname}': {size} bytes exceeds the entry limit.")
+            return False
+        ttl = self.ttl if images else self.negative_ttl
+        entry = encode_entry(images, time.time() + ttl)
+        stored = self._set_if_generation(
+            keys=[self._key(nickname), self._generation_key(nickname)],
+            args=[generation, entry, int(ttl + self.stale_ttl)],
+        )
+        return bool(stored)
+
+    def fill(self, nickname, generation, load, lock_ttl=10, wait_timeout=5, poll_interval=0.05, wait=True):
+        """Load ``nickname`` with at most one loader across all processes sharing Redis.
+
+        The process holding the fill lock runs ``load`` and stores the result; the
+        others poll the cache for it. If nothing shows up within ``wait_timeout``,
+        the waiter stops deferring and loads it itself. With ``wait=False`` a
+        caller that does not get the lock returns None straight away.
+        """
+        deadline = time.monotonic() + wait_timeout
+        waited = False
+        while True:
+            token = secrets.token_hex(8)
+            if self.redis.set(self._lock_key(nickname), token, nx=True, px=int(lock_ttl * 1000)):
+                self._count("fill_locks_acquired")
+                try:
+                    images = load()
+                    self.set(nickname, images, generation)
+                    return images
+                finally:
+                    self._release_lock(keys=[self._lock_key(nickname)], args=[token])
+            if not wait:
+                return None
+            if not waited:
+                self._count("fill_waits")
+                waited = True
+            # Someone else is loading; wait for their entry or for the lock to go away
+            while self.redis.exists(self._lock_key(nickname)):
+                if time.monotonic() >= deadline:
+                    self._count("fill_wait_timeouts")
+                    logging.warning(f"Timed out waiting for another process to load nickname '{nickname}'.")
+                    return load()
+                time.sleep(poll_interval)
+                images = self.get(nickname)
+                if images is not None:
+                    self._count("fill_wait_hits")
+                    return images
+            images = self.get(nickname)
+            if images is not None:
+                self._count("fill_wait_hits")
+                return images
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def invalidate(self, nickname):
+        pipe = self.redis.pipeline()
+        pipe.incr(self._generation_key(nickname))
+        pipe.expire(self._generation_key(nickname), int(max(self.ttl, self.negative_ttl) + self.stale_ttl) * 2)
+        pipe.delete(self._key(nickname))
+        pipe.execute()
+
+
+class LocalCache:
+    """In-process LRU cache bounded by the total size of its values in bytes.
+
+    Entries are fresh for ``ttl`` seconds and, if set with a ``stale_ttl``, kept
+    for that much longer for stale serving. Values larger than ``max_object_bytes``
+    are never admitted so one huge result set cannot flush everything else.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=10, max_object_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, fresh_until, expires_at)
+        self._bytes = 0
+        self._version = 0
+        self._counters = {
+            "hits": 0, "stale_hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expirations": 0, "rejections": 0,
+        }
+
+    def get(self, key):
+        """The fresh value for ``key``, or None."""
+        entry = self.get_entry(key, count_stale=False)
+        if entry is None or entry[1] > 0:
+            return None
+        return entry[0]
+
+    def get_entry(self, key, count_stale=True):
+        """``(value, seconds_stale)`` for ``key``, including stale entries, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            value, size, fresh_until, expires_at = entry
+            if expires_at <= now:
+                self._remove(key)
+                self._counters["expirations"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            stale_for = max(0.0, now - fresh_until)
+            if not stale_for:
+                self._counters["hits"] += 1
+            elif count_stale:
+                self._counters["stale_hits"] += 1
+            else:
+                self._counters["misses"] += 1
+            return value, stale_for
+
+    def version(self):
+        # Taken before loading a value and passed to set(), which refuses the value
+        # if anything was invalidated in between.
+        with self._lock:
+            return self._version
+
+    def set(self, key, value, size, ttl=None, stale_ttl=0, version=None):
+        if size > self.max_object_bytes:
+            with self._lock:
+                self._counters["rejections"] += 1
+            return False
+        fresh_until = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if version is not None and version != self._version:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, fresh_until, fresh_until + stale_ttl)
+            self._bytes += size
+            self._counters["sets"] += 1
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._counters["evictions"] += 1
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        size = self._entries.pop(key)[1]
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_object_bytes": self.max_object_bytes,
+                **self._counters,
+            }
+
+
+class BackgroundRefresher:
+    """Runs at most one background refresh per key at a time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = set()
+        self._counters = {"started": 0, "skipped": 0, "failed": 0}
+
+    def submit(self, key, fn):
+        with self._lock:
+            if key in self._running:
+                self._counters["skipped"] += 1
+                return False
+            self._running.add(key)
+            self._counters["started"] += 1
+        threading.Thread(target=self._run, args=(key, fn), name=f"refresh-{key}", daemon=True).start()
+        return True
+
+    def _run(self, key, fn):
+        try:
+            fn()
+        except Exception as e:
+            logging.warning(f"Background refresh of '{key}' failed: {e}")
+            with self._lock:
+                self._counters["failed"] += 1
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {"running": len(self._running), **self._counters}
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key within a process.
+
+    The first caller runs the function; callers arriving while it runs wait up to
+    ``timeout`` seconds and receive its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {"leaders": 0, "coalesced": 0, "timeouts": 0}
+
+    def do(self, key, fn, timeout=5):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters["leaders"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if leader:
+            try:
+                call.result = fn()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if not call.done.wait(timeout):
+            with self._lock:
+                self._counters["timeouts"] += 1
+            raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for '{key}' to load")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), **self._counters}
+
+
+class CircuitOpenError(redis.ConnectionError):
+    pass
+
+
+class PoolExhaustedError(redis.ConnectionError):
+    pass
+
+
+class PoolQueue(queue.LifoQueue):
+    """``queue_class`` for redis.BlockingConnectionPool that raises PoolExhaustedError.
+
+    The pool otherwise reports "no free connection" as a plain ConnectionError,
+    which cannot be told apart from Redis being unreachable.
+    """
+
+    def get(self, block=True, timeout=None):
+        try:
+            return super().get(block, timeout)
+        except queue.Empty:
+            raise PoolExhaustedError(f"No Redis connection became free within {timeout}s")
+
+
+class CircuitBreaker:
+    """Stops calling Redis after ``failure_threshold`` consecutive connection errors.
+
+    While open every call fails immediately with CircuitOpenError; a background
+    thread runs ``probe`` every ``probe_interval`` seconds and closes the circuit
+    as soon as one succeeds. PoolExhaustedError means Redis is busy, not down, so
+    it is counted separately and never trips the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, probe, failure_threshold=5, probe_interval=1.0, name="redis"):
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_thread = None
+        self._probe_pid = None
+        self._counters = {
+            "calls": 0, "failures": 0, "pool_exhausted": 0, "trips": 0, "short_circuited": 0, "probes": 0,
+            "recoveries": 0,
+        }
+
+    def call(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._state == self.OPEN:
+                self._counters["short_circuited"] += 1
+                self._ensure_probe()
+                raise CircuitOpenError(f"Circuit to {self.name} is open")
+            self._counters["calls"] += 1
+        try:
+            result = fn(*args, **kwargs)
+        except PoolExhaustedError:
+            with self._lock:
+                self._counters["pool_exhausted"] += 1
+            raise
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._record_failure()
+            raise
+        with self._lock:
+            self._consecutive_failures = 0
+        return result
+
+    def _record_failure(self):
+        with self._lock:
+            self._counters["failures"] += 1
+            self._consecutive_failures += 1
+            if self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._counters["trips"] += 1
+                logging.warning(
+                    f"{self.name} failed {self._consecutive_failures} times in a row; "
+                    f"opening the circuit and probing every {self.probe_interval}s."
+                )
+                self._ensure_probe()
+
+    def _ensure_probe(self):
+        # Called with the lock held. Threads do not survive a fork, hence the pid check.
+        alive = self._probe_thread is not None and self._probe_thread.is_alive()
+        if alive and self._probe_pid == os.getpid():
+            return
+        self._probe_pid = os.getpid()
+        self._probe_thread = threading.Thread(target=self._probe_loop, name=f"{self.name}-probe", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                if self._state != self.OPEN:
+                    return
+                self._counters["probes"] += 1
+            try:
+                self.probe()
+            except redis.RedisError:
+                continue
+            with self._lock:
+                self._state = self.CLOSED
+                self._consecutive_failures = 0
+                self._counters["recoveries"] += 1
+                down_for = time.monotonic() - self._opened_at
+            logging.info(f"{self.name} is reachable again after {down_for:.1f}s; closing the circuit.")
+            return
+
+    @property
+    def state(self):
+        return self._state
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "open_for": round(time.monotonic() - self._opened_at, 3) if self._state == self.OPEN else 0,
+                **self._counters,
+            }
+
+
+class ResilientRedis:
+    """Redis client proxy that routes every network call through a CircuitBreaker."""
+
+    # Methods that never touch the network
+    _LOCAL = {"get_encoder", "get_connection_kwargs"}
+
+    def __init__(self, client, breaker):
+        self._client = client
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in self._LOCAL:
+            return attr
+
+        def guarded(*args, **kwargs):
+            return self.breaker.call(attr, *args, **kwargs)
+        return guarded
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def pipeline(self, *args, **kwargs):
+        return _GuardedPipeline(self._client.pipeline(*args, **kwargs), self.breaker)
+
+
+class _GuardedPipeline:
+    def __init__(self, pipeline, breaker):
+        self._pipeline = pipeline
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipeline, name)
+        if not callable(attr):
+            return attr
+
+        def queued(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # Keep chained calls (pipe.incr(...).expire(...)) on the guarded wrapper
+            return self if result is self._pipeline else result
+        return queued
+
+    def execute(self, *args, **kwargs):
+        return self._breaker.call(self._pipeline.execute, *args, **kwargs)
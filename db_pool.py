@@ -0,0 +1,487 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# Connections inherited across a fork are parked here instead of being closed or
+# garbage collected: finalizing a libpq connection in the child would send a
+# Terminate message down the socket the parent is still using.
+_orphaned_connections = []
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of DB-API connections with a min/max size.
+
+    Idle connections above ``minsize`` are reaped after ``max_idle`` seconds, and a
+    connection that has been idle longer than ``ping_after`` seconds is health
+    checked before it is handed out.
+    """
+
+    def __init__(self, connect, minsize=1, maxsize=10, max_idle=300, timeout=30,
+                 ping_after=10, name="db"):
+        if minsize < 0 or maxsize < 1 or minsize > maxsize:
+            raise ValueError(f"Invalid pool size: min={minsize}, max={maxsize}")
+        self._connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.name = name
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._fill()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (conn, last_used)
+        self._owned = set()
+        self._size = 0
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "closed": 0,
+            "reaped": 0,
+            "failed_health_checks": 0,
+        }
+
+    def _after_fork(self):
+        _orphaned_connections.extend(self._owned)
+        self._reset()
+        logging.info(f"Re-created {self.name} connection pool after fork (pid {self._pid}).")
+
+    def _fill(self):
+        for _ in range(self.minsize):
+            with self._cond:
+                self._size += 1
+            conn = self._new_connection()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+
+    def _new_connection(self):
+        # The caller has already reserved a slot by bumping _size under the lock.
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._owned.add(conn)
+            self._counters["created"] += 1
+        return conn
+
+    def _discard(self, conn, counter="closed"):
+        try:
+            conn.close()
+        except Exception as e:
+            logging.warning(f"Error closing {self.name} connection: {e}")
+        with self._cond:
+            self._owned.discard(conn)
+            self._size -= 1
+            self._counters[counter] += 1
+            self._cond.notify()
+
+    def _reap_idle(self):
+        # Called with the lock held; returns connections the caller must close.
+        expired = []
+        now = time.monotonic()
+        while self._size - len(expired) > self.minsize and self._idle and now - self._idle[0][1] > self.max_idle:
+            expired.append(self._idle.popleft()[0])
+        return expired
+
+    def _is_healthy(self, conn, idle_for):
+        if getattr(conn, "closed", False):
+            return False
+        if idle_for < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.warning(f"Discarding broken {self.name} connection: {e}")
+            return False
+
+    def getconn(self, readonly=False):
+        # Every connection can write; readonly only matters to SQLiteWALPool
+        if os.getpid() != self._pid:
+            self._after_fork()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                expired = self._reap_idle()
+                conn = last_used = None
+                if self._idle:
+                    # Most recently used first, so surplus connections age out.
+                    conn, last_used = self._idle.pop()
+                elif self._size < self.maxsize:
+                    self._size += 1
+                else:
+                    self._counters["waits"] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a {self.name} connection")
+                    continue
+            for stale in expired:
+                self._discard(stale, "reaped")
+            if conn is None:
+                conn = self._new_connection()
+            elif not self._is_healthy(conn, time.monotonic() - last_used):
+                self._discard(conn, "failed_health_checks")
+                continue
+            with self._cond:
+                self._counters["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn, broken=False):
+        if os.getpid() != self._pid:
+            self._after_fork()
+        if conn not in self._owned:
+            # Checked out before a fork; the parent still owns the session.
+            _orphaned_connections.append(conn)
+            return
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken or getattr(conn, "closed", False):
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            expired = self._reap_idle()
+            self._cond.notify()
+        for stale in expired:
+            self._discard(stale, "reaped")
+
+    @contextmanager
+    def connection(self, readonly=False):
+        conn = self.getconn(readonly)
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = _is_connection_error(e)
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "backend": self.name,
+                "pid": self._pid,
+                "min": self.minsize,
+                "max": self.maxsize,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._counters,
+            }
+
+
+class SQLiteThreadPool:
+    """Hands each thread its own reusable SQLite connection.
+
+    Connections belonging to threads that have exited, or that sat idle longer
+    than ``max_idle`` seconds, are closed on the next checkout from any thread.
+    """
+
+    def __init__(self, path, max_idle=300, name="sqlite"):
+        self.path = path
+        self.max_idle = max_idle
+        self.name = name
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        _orphaned_connections.extend(slot["conn"] for slot in self._slots.values() if slot["conn"] is not None)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = {}  # thread ident -> {"thread", "conn", "last_used", "in_use"}
+        self._counters = {"checkouts": 0, "created": 0, "closed": 0, "reaped": 0, "failed_health_checks": 0}
+
+    def _connect(self):
+        # check_same_thread is off only so the reaper can close connections of
+        # idle or exited threads; a connection is never used by two threads at once.
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def _reap(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for ident, slot in list(self._slots.items()):
+                if slot["in_use"] or slot["conn"] is None:
+                    continue
+                if not slot["thread"].is_alive():
+                    expired.append(slot["conn"])
+                    del self._slots[ident]
+                elif now - slot["last_used"] > self.max_idle:
+                    # The owning thread reconnects lazily on its next checkout.
+                    expired.append(slot["conn"])
+                    slot["conn"] = None
+            self._counters["reaped"] += len(expired)
+        for conn in expired:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.warning(f"Error closing {self.name} connection: {e}")
+
+    def getconn(self, readonly=False):
+        if os.getpid() != self._pid:
+            self._after_fork()
+        self._reap()
+        with self._lock:
+            slot = self._slots.setdefault(threading.get_ident(), {
+                "thread": threading.current_thread(), "conn": None, "last_used": 0, "in_use": False,
+            })
+            slot["in_use"] = True
+            conn = slot["conn"]
+        if conn is not None:
+            try:
+                conn.execute("SELECT 1").fetchone()
+            except sqlite3.Error as e:
+                logging.warning(f"Discarding broken {self.name} connection: {e}")
+                self._close(slot, "failed_health_checks")
+                conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                slot["in_use"] = False
+                raise
+            with self._lock:
+                slot["conn"] = conn
+                self._counters["created"] += 1
+        with self._lock:
+            self._counters["checkouts"] += 1
+        return conn
+
+    def _close(self, slot, counter="closed"):
+        try:
+            slot["conn"].close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            slot["conn"] = None
+            self._counters[counter] += 1
+
+    def putconn(self, conn, broken=False):
+        with self._lock:
+            slot = self._slots.get(threading.get_ident())
+        if slot is None or slot["conn"] is not conn:
+            conn.close()
+            return
+        if broken:
+            self._close(slot)
+        elif conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            slot["last_used"] = time.monotonic()
+            slot["in_use"] = False
+
+    @contextmanager
+    def connection(self, readonly=False):
+        conn = self.getconn(readonly)
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = _is_connection_error(e)
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        with self._lock:
+            slots = [slot for slot in self._slots.values() if slot["conn"] is not None and not slot["in_use"]]
+        for slot in slots:
+            self._close(slot)
+
+    def stats(self):
+        with self._lock:
+            open_conns = sum(1 for slot in self._slots.values() if slot["conn"] is not None)
+            in_use = sum(1 for slot in self._slots.values() if slot["in_use"])
+            return {"backend": self.name, "pid": self._pid, "size": open_conns, "in_use": in_use, **self._counters}
+
+
+SQLITE_SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+SQLITE_CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+
+class SQLiteWALPool:
+    """SQLite in WAL mode: a pool of read-only connections plus one writer.
+
+    Readers never block the writer or each other, and the single writer
+    connection serializes this process's writes instead of letting them fail
+    with ``database is locked``; ``busy_timeout`` covers other processes.
+    ``getconn(readonly=True)`` hands out a reader. When ``checkpoint_interval``
+    is set, a background thread checkpoints the WAL so commits never pay for it.
+    """
+
+    def __init__(self, path, readers=8, min_readers=1, max_idle=300, timeout=30, ping_after=10,
+                 synchronous="NORMAL", mmap_size=256 * 1024 * 1024, cache_size=-64 * 1024,
+                 busy_timeout_ms=5000, checkpoint_interval=1.0, checkpoint_mode="PASSIVE", name="sqlite-wal"):
+        if synchronous.upper() not in SQLITE_SYNCHRONOUS:
+            raise ValueError(f"Unsupported synchronous setting {synchronous!r}; expected one of {', '.join(SQLITE_SYNCHRONOUS)}")
+        if checkpoint_mode.upper() not in SQLITE_CHECKPOINT_MODES:
+            raise ValueError(f"Unsupported checkpoint mode {checkpoint_mode!r}; expected one of {', '.join(SQLITE_CHECKPOINT_MODES)}")
+        self.path = path
+        self.synchronous = synchronous.upper()
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_mode = checkpoint_mode.upper()
+        self.name = name
+        # The writer comes first: it switches the file to WAL, which readers cannot do
+        self._writer = ConnectionPool(self._connect_writer, minsize=1, maxsize=1, max_idle=max_idle,
+                                      timeout=timeout, ping_after=ping_after, name=f"{name}-writer")
+        self._readers = ConnectionPool(self._connect_reader, minsize=min(min_readers, readers), maxsize=readers,
+                                       max_idle=max_idle, timeout=timeout, ping_after=ping_after,
+                                       name=f"{name}-reader")
+        self._checkpointer_pid = None
+        self._checkpointer_stop = threading.Event()
+        self._checkpoint_counters = {"runs": 0, "busy": 0, "failed": 0, "wal_frames": 0, "checkpointed_frames": 0}
+
+    def _configure(self, conn):
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    def _connect_writer(self):
+        conn = self._configure(sqlite3.connect(self.path, check_same_thread=False))
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            logging.warning(f"SQLite database {self.path} stayed in {mode} journal mode instead of WAL.")
+        # NORMAL only syncs at checkpoints: a power loss may drop the last commits but never corrupts
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        if self.checkpoint_interval > 0:
+            conn.execute("PRAGMA wal_autocheckpoint = 0")
+        # Shrink the WAL file back after a burst once it has been checkpointed and reused
+        conn.execute(f"PRAGMA journal_size_limit = {64 * 1024 * 1024}")
+        return conn
+
+    def _connect_reader(self):
+        # Connections are shared across threads one at a time, as with SQLiteThreadPool
+        uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return self._configure(conn)
+
+    def _ensure_checkpointer(self):
+        if self.checkpoint_interval <= 0 or self._checkpointer_pid == os.getpid():
+            return
+        # First use, or first use in a forked worker that did not inherit the thread
+        self._checkpointer_pid = os.getpid()
+        self._checkpointer_stop = threading.Event()
+        threading.Thread(target=self._checkpoint_loop, args=(self._checkpointer_stop,),
+                         name=f"{self.name}-checkpointer", daemon=True).start()
+
+    def _checkpoint_loop(self, stop):
+        conn = None
+        while not stop.wait(self.checkpoint_interval):
+            try:
+                if conn is None:
+                    conn = self._configure(sqlite3.connect(self.path))
+                busy, wal_frames, checkpointed = conn.execute(
+                    f"PRAGMA wal_checkpoint({self.checkpoint_mode})"
+                ).fetchone()
+                self._checkpoint_counters["runs"] += 1
+                self._checkpoint_counters["busy"] += busy
+                self._checkpoint_counters["wal_frames"] = wal_frames
+                self._checkpoint_counters["checkpointed_frames"] = checkpointed
+            except sqlite3.Error as e:
+                self._checkpoint_counters["failed"] += 1
+                logging.warning(f"Checkpoint of {self.path} failed: {e}")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+    def checkpoint(self, mode=None):
+        """Checkpoint now through the writer; returns (busy, WAL frames, frames checkpointed)."""
+        with self._writer.connection() as conn:
+            return conn.execute(f"PRAGMA wal_checkpoint({(mode or self.checkpoint_mode).upper()})").fetchone()
+
+    def getconn(self, readonly=False):
+        self._ensure_checkpointer()
+        return self._readers.getconn() if readonly else self._writer.getconn()
+
+    def putconn(self, conn, broken=False):
+        if conn in self._writer._owned:
+            self._writer.putconn(conn, broken=broken)
+        else:
+            self._readers.putconn(conn, broken=broken)
+
+    @contextmanager
+    def connection(self, readonly=False):
+        conn = self.getconn(readonly)
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = _is_connection_error(e)
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        self._checkpointer_stop.set()
+        self._readers.closeall()
+        self._writer.closeall()
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "pid": os.getpid(),
+            "readers": self._readers.stats(),
+            "writer": self._writer.stats(),
+            "checkpoints": {
+                "interval": self.checkpoint_interval,
+                "mode": self.checkpoint_mode,
+                **self._checkpoint_counters,
+            },
+        }
+
+
+def _is_connection_error(exc):
+    if psycopg2 and isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return True
+    return isinstance(exc, sqlite3.OperationalError) and "unable to open" in str(exc)
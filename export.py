@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import mimetypes
+import re
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from storage import begin_read_snapshot, iter_image_chunks, iter_images
+
+ARCHIVE_FORMATS = ("tar", "zip")
+MANIFEST_NAME = "manifest.jsonl"
+# Manifest lines stay in memory up to this size, then spill to a temporary file
+MANIFEST_SPOOL_BYTES = 1024 * 1024
+_UNSAFE_PATH_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+# Earliest timestamp a zip entry can carry
+_ZIP_EPOCH = 315532800
+
+
+def archive_format_for(filename):
+    """The archive format implied by ``filename``'s extension, or None."""
+    for archive_format in ARCHIVE_FORMATS:
+        if filename.lower().endswith(f".{archive_format}"):
+            return archive_format
+    return None
+
+
+def archive_path(image):
+    """Where ``image`` is stored in the archive: images/<nickname>/<id><extension>."""
+    nickname = _UNSAFE_PATH_CHARS.sub("_", image.nickname or "")
+    if nickname.strip(".") == "":
+        nickname = f"_{nickname}"
+    extension = mimetypes.guess_extension(image.mime_type or "") or ".bin"
+    return f"images/{nickname}/{image.image_id}{extension}"
+
+
+class _Buffer:
+    # Write-only file object whose contents are handed out as soon as they are written
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class _TarArchive:
+    """Writes POSIX (pax) tar members straight to the output, one header and body at a time."""
+
+    def entry(self, name, size, mtime, chunks):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            yield chunk
+        if written != size:
+            raise LookupError(f"{name} is {written} bytes, expected {size}")
+        if size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+    def close(self):
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+class _ZipArchive:
+    """Writes stored (uncompressed) zip members with data descriptors, so no seeking is needed.
+
+    The central directory is written at the end, so zipfile keeps one small
+    record per member in memory until then.
+    """
+
+    def __init__(self):
+        self._buffer = _Buffer()
+        self._zip = zipfile.ZipFile(self._buffer, "w", zipfile.ZIP_STORED)
+
+    def entry(self, name, size, mtime, chunks):
+        info = zipfile.ZipInfo(name, date_time=time.gmtime(max(mtime, _ZIP_EPOCH))[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0o644 << 16
+        # Known up front so zipfile switches to zip64 for large members
+        info.file_size = size
+        with self._zip.open(info, "w") as member:
+            yield self._buffer.drain()
+            for chunk in chunks:
+                member.write(chunk)
+                yield self._buffer.drain()
+        yield self._buffer.drain()
+
+    def close(self):
+        self._zip.close()
+        yield self._buffer.drain()
+
+
+def export_archive(conn, db_type, archive_format="tar", nickname=None, since=None, until=None,
+                   blobs=None, chunk_size=1024 * 1024, batch_size=500):
+    """Yield a tar or zip archive of the matching images as a stream of bytes.
+
+    Images are read from one snapshot, in ``created_at`` order, through
+    ``iter_images`` and ``iter_image_chunks``, so memory use does not grow with
+    the number or size of images. Every image is hashed as it is written; the
+    last member, ``manifest.jsonl``, lists each one's path, id, nickname, MIME
+    type, size, SHA-256 and creation time.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+    archive = _TarArchive() if archive_format == "tar" else _ZipArchive()
+    begin_read_snapshot(conn, db_type)
+    started = time.monotonic()
+    count = total_bytes = mismatched = 0
+    with tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_BYTES) as manifest:
+        for image in iter_images(conn, db_type, nickname, since, until, blobs, batch_size):
+            path = archive_path(image)
+            digest = hashlib.sha256()
+
+            def hashed_chunks():
+                for chunk in iter_image_chunks(conn, db_type, image, chunk_size):
+                    digest.update(chunk)
+                    yield chunk
+
+            mtime = image.created_at.timestamp() if image.created_at else 0
+            yield from archive.entry(path, image.size, mtime, hashed_chunks())
+            sha256 = digest.hexdigest()
+            if sha256 != image.content_hash:
+                mismatched += 1
+                logging.error(f"Image {image.image_id} hashes to {sha256}, but {image.content_hash} was stored.")
+            manifest.write(json.dumps({
+                "path": path,
+                "id": image.image_id,
+                "nickname": image.nickname,
+                "mime_type": image.mime_type,
+                "size": image.size,
+                "sha256": sha256,
+                "created_at": image.created_at.isoformat() if image.created_at else None,
+            }).encode("utf-8") + b"\n")
+            count += 1
+            total_bytes += image.size
+        size = manifest.tell()
+        manifest.seek(0)
+        yield from archive.entry(MANIFEST_NAME, size, time.time(), iter(lambda: manifest.read(chunk_size), b""))
+    yield from archive.close()
+    logging.info(
+        f"Exported {count} images ({total_bytes / 1e6:.1f} MB) as {archive_format} "
+        f"in {time.monotonic() - started:.1f}s" + (f"; {mismatched} did not match their stored hash." if mismatched else ".")
+    )
@@ -0,0 +1,44 @@
+import os
+import threading
+import time
+import uuid
+
+# Layout (RFC 9562): 48-bit Unix time in milliseconds, version 7, 12 bits of
+# rand_a, the variant, then 62 random bits.
+_VERSION_7 = 0x7 << 76
+_VARIANT = 0x2 << 62
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def uuid7(timestamp_ms=None):
+    """A time-ordered UUIDv7.
+
+    Ids generated in one process are strictly increasing: within a millisecond
+    rand_a acts as a counter, seeded randomly so that concurrent processes
+    rarely collide on it. With ``timestamp_ms`` (e.g. to re-key an existing row
+    from its ``created_at``) the id is sortable by that time instead.
+    """
+    global _last_ms, _counter
+    if timestamp_ms is None:
+        with _lock:
+            now = time.time_ns() // 1_000_000
+            if now > _last_ms:
+                _last_ms = now
+                # Leave headroom so the counter rarely spills into the next millisecond
+                _counter = int.from_bytes(os.urandom(2), "big") & 0x7FF
+            else:
+                _counter += 1
+                if _counter > 0xFFF:
+                    # Clock went backwards or 4096 ids in one millisecond: borrow the next one
+                    _last_ms += 1
+                    _counter = 0
+            timestamp_ms, rand_a = _last_ms, _counter
+    else:
+        rand_a = int.from_bytes(os.urandom(2), "big") & 0xFFF
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80 | _VERSION_7 | rand_a << 64 | _VARIANT | rand_b
+    return uuid.UUID(int=value)
+
@@ -0,0 +1,388 @@
+import concurrent.futures
+import json
+import logging
+import mimetypes
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from collections import Counter, namedtuple
+
+import mime_sniff
+from ids import uuid7
+from storage import CopyStream, UploadStream, copy_binary, to_db_time, utcnow
+
+try:
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+_READ_SIZE = 1024 * 1024
+
+ImportFile = namedtuple("ImportFile", ["name", "source", "content_hash", "size", "mime_type", "nickname", "image_id"])
+
+
+class ImportCheckpoint:
+    """Progress of one import, saved after every committed batch so a rerun resumes after it.
+
+    ``position`` counts source entries (including skipped and failed ones) in
+    the order the source yields them, and ``last`` names the final one, so a
+    resumed import can tell when the source changed underneath it.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.position = 0
+        self.last = None
+        self.counters = {"imported": 0, "duplicates": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        self.complete = False
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state["source"] != self.source:
+                raise ValueError(f"Checkpoint {path} belongs to {state['source']}, not {self.source}")
+            self.position = state["position"]
+            self.last = state["last"]
+            self.counters.update(state["counters"])
+            self.complete = state["complete"]
+
+    def save(self):
+        state = {
+            "source": self.source,
+            "position": self.position,
+            "last": self.last,
+            "counters": self.counters,
+            "complete": self.complete,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def _inspect(name, stream, sink=None):
+    # (content_hash, size, mime_type) of a stream read in chunks through UploadStream, as
+    # uploads are; every chunk is also written to ``sink`` when one is given
+    upload = UploadStream(stream, chunk_size=_READ_SIZE)
+    mime_type = mime_sniff.sniff(upload.header(mime_sniff.HEADER_SIZE)) or mimetypes.guess_type(name)[0]
+    for chunk in upload.chunks():
+        if sink is not None:
+            sink.write(chunk)
+    return upload.content_hash, upload.size, mime_type
+
+
+def inspect_file(entry):
+    """Hash and sniff one ``(name, path)`` entry; runs in a worker process.
+
+    Returns ``(content_hash, size, mime_type, error)``.
+    """
+    name, path = entry
+    try:
+        with open(path, "rb") as stream:
+            return (*_inspect(name, stream), None)
+    except OSError as e:
+        return None, 0, None, str(e)
+
+
+def _directory_entries(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Sorted, so a resumed import sees the entries in the same order
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if not os.path.isfile(path):
+                continue
+            yield os.path.relpath(path, root), os.path.getsize(path), lambda path=path: (path, None)
+
+
+def _tar_entries(path, spool_dir):
+    # "r|*" reads the archive as a stream: no seeking, any compression, constant memory.
+    # A member can only be read when the stream reaches it, so it is hashed and sniffed
+    # while being copied, chunk by chunk, to a spool file it is stored from later.
+    with tarfile.open(path, mode="r|*") as archive:
+        for position, member in enumerate(archive):
+            if member.isfile():
+                spool_path = os.path.join(spool_dir, str(position))
+                yield member.name, member.size, lambda member=member, spool_path=spool_path: (
+                    spool_path, _spool_member(archive, member, spool_path)
+                )
+
+
+def _spool_member(archive, member, spool_path):
+    with open(spool_path, "wb") as sink:
+        return (*_inspect(member.name, archive.extractfile(member), sink), None)
+
+
+def _default_nickname(name, source_path):
+    directory = os.path.basename(os.path.dirname(name))
+    if directory:
+        return directory
+    base = os.path.basename(os.path.normpath(source_path))
+    for suffix in (".tar", ".tgz", ".tar.gz", ".tar.bz2", ".tar.xz"):
+        if base.endswith(suffix):
+            return base[:-len(suffix)]
+    return base
+
+
+def _file_chunks(item):
+    # Exactly item.size bytes, so a file that changed since it was hashed cannot corrupt the COPY stream
+    remaining = item.size
+    with open(item.source, "rb") as stream:
+        while remaining:
+            chunk = stream.read(min(_READ_SIZE, remaining))
+            if not chunk:
+                raise ValueError(f"{item.name} shrank after it was hashed")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _read_all(item):
+    return b"".join(_file_chunks(item))
+
+
+class Importer:
+    """Bulk-loads a directory tree or tar archive of images into the database.
+
+    Worker processes hash and sniff each batch while the previous batch loads.
+    A batch is stored in one transaction: on PostgreSQL with binary
+    ``COPY FROM STDIN`` (blobs through a staging table, so content uploaded
+    concurrently is shared rather than conflicting), on SQLite with
+    ``executemany`` over prepared inserts. Content already stored only gains
+    references, as with regular uploads.
+    """
+
+    def __init__(self, pool, db_type, blobs=None, nickname=None, workers=None, batch_size=500,
+                 batch_bytes=64 * 1024 * 1024, report_interval=5):
+        self.pool = pool
+        self.db_type = db_type
+        self.blobs = blobs
+        self.nickname = nickname
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.report_interval = report_interval
+        self.nicknames = set()
+
+    def run(self, source, checkpoint):
+        """Import ``source`` from where ``checkpoint`` left off; returns the checkpoint counters."""
+        if checkpoint.complete:
+            logging.info(f"Import of {checkpoint.source} already completed; delete {checkpoint.path} to run it again.")
+            return checkpoint.counters
+        if os.path.isdir(source):
+            self._spool_dir = None
+            entries = _directory_entries(source)
+        else:
+            # Holds the spooled members of at most the batch being stored and the one being read
+            self._spool_dir = tempfile.mkdtemp(prefix="photo-import-")
+            entries = _tar_entries(source, self._spool_dir)
+        self._source = source
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self._session_files = 0
+        self._session_bytes = 0
+        if checkpoint.position:
+            logging.info(f"Resuming import of {checkpoint.source} after {checkpoint.position} entries ({checkpoint.last}).")
+        # Spawned workers start clean instead of inheriting the app's pools, locks and threads
+        context = multiprocessing.get_context("spawn")
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+                in_flight = None
+                for batch in self._batches(entries, checkpoint):
+                    # Spooled tar members were already inspected while being read
+                    pending = [(name, source) for name, source, inspected in batch if inspected is None]
+                    inspected = executor.map(
+                        inspect_file, pending, chunksize=max(1, len(pending) // (self.workers * 4))
+                    )
+                    if in_flight:
+                        self._load(*in_flight, checkpoint)
+                    in_flight = (batch, inspected)
+                if in_flight:
+                    self._load(*in_flight, checkpoint)
+        finally:
+            if self._spool_dir:
+                shutil.rmtree(self._spool_dir, ignore_errors=True)
+        checkpoint.complete = True
+        checkpoint.save()
+        self._report(checkpoint, final=True)
+        return checkpoint.counters
+
+    def _batches(self, entries, checkpoint):
+        batch = []
+        size = 0
+        for position, (name, length, load) in enumerate(entries, 1):
+            if position <= checkpoint.position:
+                if position == checkpoint.position and name != checkpoint.last:
+                    raise ValueError(
+                        f"Source changed since the checkpoint: entry {position} is {name}, not {checkpoint.last}"
+                    )
+                continue
+            batch.append((name, *load()))
+            size += length
+            if len(batch) >= self.batch_size or size >= self.batch_bytes:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def _load(self, batch, inspected, checkpoint):
+        files = []
+        inspected = iter(inspected)
+        for name, source, known in batch:
+            content_hash, size, mime_type, error = known or next(inspected)
+            if error:
+                logging.warning(f"Skipping {name}: {error}")
+                checkpoint.counters["failed"] += 1
+            elif not size or not (mime_type or "").startswith("image/"):
+                checkpoint.counters["skipped"] += 1
+            else:
+                nickname = self.nickname or _default_nickname(name, self._source)
+                files.append(ImportFile(name, source, content_hash, size, mime_type, nickname, str(uuid7())))
+        if files:
+            with self.pool.connection() as conn:
+                duplicates = self._store(conn, files)
+                conn.commit()
+            self.nicknames.update(item.nickname for item in files)
+            imported_bytes = sum(item.size for item in files)
+            checkpoint.counters["imported"] += len(files)
+            checkpoint.counters["duplicates"] += duplicates
+            checkpoint.counters["bytes"] += imported_bytes
+            self._session_files += len(files)
+            self._session_bytes += imported_bytes
+        if self._spool_dir:
+            for _, source, _ in batch:
+                os.unlink(source)
+        checkpoint.position += len(batch)
+        checkpoint.last = batch[-1][0]
+        checkpoint.save()
+        if time.monotonic() - self._last_report >= self.report_interval:
+            self._report(checkpoint)
+
+    def _report(self, checkpoint, final=False):
+        now = time.monotonic()
+        self._last_report = now
+        elapsed = max(now - self._started, 1e-9)
+        counters = checkpoint.counters
+        logging.info(
+            f"{'Imported' if final else 'Importing'}: {counters['imported']} images "
+            f"({counters['duplicates']} duplicates, {counters['skipped']} skipped, {counters['failed']} failed), "
+            f"{self._session_files / elapsed:,.0f} files/s, {self._session_bytes / elapsed / 1e6:,.1f} MB/s."
+        )
+
+    def _store(self, conn, files):
+        # Returns how many files referenced content that was already stored
+        refs = Counter(item.content_hash for item in files)
+        external = self.blobs is not None and self.blobs.external
+        cur = conn.cursor()
+        try:
+            if self.db_type == "sqlite":
+                # Take the write lock up front rather than failing halfway through the batch
+                cur.execute("BEGIN IMMEDIATE")
+            existing = self._existing(cur, list(refs))
+            new = {}
+            for item in files:
+                if item.content_hash not in existing and item.content_hash not in new:
+                    new[item.content_hash] = item
+            if external:
+                # Bytes are durable in the store before any row points at them
+                for content_hash, needs_bytes in existing.items():
+                    if needs_bytes and not self.blobs.exists(content_hash):
+                        self._write_external(next(item for item in files if item.content_hash == content_hash))
+                for item in new.values():
+                    self._write_external(item)
+            created_at = utcnow()
+            if self.db_type == "postgres":
+                self._store_postgres(cur, files, new, existing, refs, created_at, external)
+            else:
+                self._store_sqlite(cur, files, new, existing, refs, created_at, external)
+        finally:
+            cur.close()
+        return len(files) - len(new)
+
+    def _existing(self, cur, hashes):
+        # {content_hash: True when the bytes must be in the external store} for hashes already in blobs
+        existing = {}
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            if self.db_type == "postgres":
+                # Locked so garbage collection cannot remove them before the batch commits
+                cur.execute(
+                    "SELECT content_hash, data IS NULL FROM blobs WHERE content_hash = ANY(%s) FOR UPDATE", (chunk,)
+                )
+            else:
+                cur.execute(
+                    f"SELECT content_hash, data IS NULL FROM blobs WHERE content_hash IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                )
+            existing.update((content_hash, bool(data_missing)) for content_hash, data_missing in cur.fetchall())
+        return existing
+
+    def _write_external(self, item):
+        with open(item.source, "rb") as stream:
+            content_hash = self.blobs.write(UploadStream(stream, chunk_size=_READ_SIZE))
+        if content_hash != item.content_hash:
+            raise ValueError(f"{item.name} changed after it was hashed")
+
+    def _store_postgres(self, cur, files, new, existing, refs, created_at, external):
+        if new:
+            cur.execute("""
+                CREATE TEMP TABLE import_blobs (
+                    content_hash TEXT, byte_size BIGINT, ref_count INTEGER, data BYTEA, created_at TIMESTAMPTZ
+                ) ON COMMIT DROP
+            """)
+            # Compressing already-compressed images in the staging table would only burn CPU
+            cur.execute("ALTER TABLE import_blobs ALTER COLUMN data SET STORAGE EXTERNAL")
+            rows = (
+                (item.content_hash, item.size, refs[item.content_hash],
+                 None if external else (item.size, _file_chunks(item)), created_at)
+                for item in new.values()
+            )
+            cur.copy_expert(
+                "COPY import_blobs (content_hash, byte_size, ref_count, data, created_at) FROM STDIN WITH (FORMAT binary)",
+                CopyStream(copy_binary(("text", "int8", "int4", "bytea", "timestamptz"), rows)), size=_READ_SIZE
+            )
+            # Content another writer stored meanwhile just gains this batch's references
+            cur.execute("""
+                INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at)
+                SELECT content_hash, byte_size, ref_count, data, created_at FROM import_blobs
+                ON CONFLICT (content_hash) DO UPDATE SET ref_count = blobs.ref_count + EXCLUDED.ref_count
+            """)
+        if existing:
+            psycopg2.extras.execute_values(
+                cur,
+                "UPDATE blobs SET ref_count = blobs.ref_count + v.refs FROM (VALUES %s) AS v (content_hash, refs) "
+                "WHERE blobs.content_hash = v.content_hash",
+                [(content_hash, refs[content_hash]) for content_hash in existing]
+            )
+        rows = (
+            (item.image_id, item.nickname, item.mime_type, item.content_hash, item.size, created_at)
+            for item in files
+        )
+        cur.copy_expert(
+            "COPY images (image_id, nickname, mime_type, content_hash, byte_size, created_at) FROM STDIN WITH (FORMAT binary)",
+            CopyStream(copy_binary(("uuid", "text", "text", "text", "int8", "timestamptz"), rows)), size=_READ_SIZE
+        )
+
+    def _store_sqlite(self, cur, files, new, existing, refs, created_at, external):
+        created_at = to_db_time("sqlite", created_at)
+        # Generators keep a single file's bytes in memory at a time
+        cur.executemany(
+            "INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (content_hash) DO UPDATE SET ref_count = ref_count + excluded.ref_count",
+            (
+                (item.content_hash, item.size, refs[item.content_hash], None if external else _read_all(item), created_at)
+                for item in new.values()
+            )
+        )
+        cur.executemany(
+            "UPDATE blobs SET ref_count = ref_count + ? WHERE content_hash = ?",
+            [(refs[content_hash], content_hash) for content_hash in existing]
+        )
+        cur.executemany(
+            "INSERT INTO images (id, nickname, mime_type, content_hash, byte_size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            ((item.image_id, item.nickname, item.mime_type, item.content_hash, item.size, created_at) for item in files)
+        )
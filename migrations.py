@@ -0,0 +1,457 @@
+import hashlib
+import logging
+import time
+
+from storage import utcnow, to_db_time
+
+VERSIONS_TABLE = "schema_migrations"
+
+# Arbitrary key for the PostgreSQL advisory lock serializing concurrent migrators
+_PG_LOCK_KEY = 0x70686f746f
+_PG_LOCK_POLL_INTERVAL = 0.2  # Seconds between attempts to take the advisory lock
+
+
+class Migration:
+    """One schema change, written once per dialect.
+
+    ``sqlite`` and ``postgres`` are callables taking a cursor. Atomic migrations
+    run in a single transaction together with the row recording them; the
+    others (e.g. ``CREATE INDEX CONCURRENTLY``) run in autocommit mode and must
+    be safe to re-run after a failure.
+    """
+
+    def __init__(self, version, name, sqlite=None, postgres=None, atomic=True):
+        self.version = version
+        self.name = name
+        self.steps = {"sqlite": sqlite, "postgres": postgres}
+        self.atomic = atomic
+
+    def run(self, cur, db_type):
+        step = self.steps[db_type]
+        if step is not None:
+            step(cur)
+
+
+# -- 1: baseline ------------------------------------------------------------
+# Brings any table created by earlier versions of the app, which had no
+# versions table, up to the same shape as a fresh install.
+
+# image_data is only set on rows stored before deduplication; newer rows reference
+# the blobs table (or the external blob store) through content_hash
+SQLITE_IMAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id TEXT PRIMARY KEY,
+        image_data BLOB,
+        nickname TEXT NOT NULL,
+        mime_type TEXT NOT NULL,
+        content_hash TEXT,
+        byte_size INTEGER,
+        created_at TEXT
+    )
+"""
+
+_BACKFILL_BLOBS = """
+    INSERT INTO blobs (content_hash, byte_size, ref_count, created_at)
+    SELECT content_hash, MAX(byte_size), COUNT(*), MIN(created_at) FROM images
+    WHERE image_data IS NULL AND content_hash IS NOT NULL
+    AND content_hash NOT IN (SELECT content_hash FROM blobs)
+    GROUP BY content_hash
+"""
+
+
+def _baseline_sqlite(cur):
+    cur.execute(SQLITE_IMAGES_TABLE.format(name="images"))
+    # Tables created before content hashes, sizes and timestamps were recorded
+    cur.execute("PRAGMA table_info(images)")
+    columns = {row[1]: row for row in cur.fetchall()}
+    for column, column_type in (("content_hash", "TEXT"), ("created_at", "TEXT"), ("byte_size", "INTEGER")):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE images ADD COLUMN {column} {column_type}")
+    if columns["image_data"][3]:
+        # SQLite cannot drop a NOT NULL constraint in place, so copy into a new table
+        logging.info("Rebuilding the SQLite images table to allow images stored outside it.")
+        cur.execute(SQLITE_IMAGES_TABLE.format(name="images_rebuild"))
+        cur.execute("""
+            INSERT INTO images_rebuild (id, image_data, nickname, mime_type, content_hash, byte_size, created_at)
+            SELECT id, image_data, nickname, mime_type, content_hash, byte_size, created_at FROM images
+        """)
+        cur.execute("DROP TABLE images")
+        cur.execute("ALTER TABLE images_rebuild RENAME TO images")
+    # One row per distinct content; data is NULL when the bytes are in the external blob store
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            content_hash TEXT PRIMARY KEY,
+            byte_size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL,
+            data BLOB,
+            created_at TEXT
+        )
+    """)
+    _baseline_indexes(cur)
+    # Images already in an external store get their reference counts
+    cur.execute(_BACKFILL_BLOBS)
+
+
+def _baseline_postgres(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            image_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            image_data BYTEA,
+            nickname TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            content_hash TEXT,
+            byte_size BIGINT,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    # Tables created before content hashes, sizes and timestamps were recorded;
+    # existing rows keep a NULL created_at rather than the migration time
+    cur.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    cur.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS byte_size BIGINT")
+    cur.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ")
+    cur.execute("ALTER TABLE images ALTER COLUMN created_at SET DEFAULT now()")
+    # image_data is NULL for rows whose bytes live in the blobs table or blob store
+    cur.execute("ALTER TABLE images ALTER COLUMN image_data DROP NOT NULL")
+    # One row per distinct content; data is NULL when the bytes are in the external blob store
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            content_hash TEXT PRIMARY KEY,
+            byte_size BIGINT NOT NULL,
+            ref_count INTEGER NOT NULL,
+            data BYTEA,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    _baseline_indexes(cur)
+    cur.execute(_BACKFILL_BLOBS)
+
+
+def _baseline_indexes(cur):
+    # Garbage collection looks up unreferenced blobs and the images pointing at a hash
+    cur.execute("CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (content_hash) WHERE ref_count = 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS images_content_hash ON images (content_hash)")
+
+
+# -- 2: nickname index --------------------------------------------------------
+
+def _nickname_index_sqlite(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS images_nickname ON images (nickname)")
+
+
+def _nickname_index_postgres(cur):
+    # Built without blocking uploads; a build interrupted earlier leaves an invalid index behind
+    cur.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'images_nickname' AND NOT i.indisvalid
+    """)
+    if cur.fetchone():
+        cur.execute("DROP INDEX CONCURRENTLY images_nickname")
+    cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS images_nickname ON images (nickname)")
+
+
+# -- 3: no TOAST compression for image bytes ----------------------------------
+
+def _external_storage_postgres(cur):
+    # JPEG, PNG, WebP and friends are already compressed, so pglz only burns CPU
+    # before giving up. EXTERNAL still moves large values out of line (keeping
+    # substring() range reads cheap) but skips compression. Only new values are
+    # affected; existing rows keep the form they were written in.
+    cur.execute("ALTER TABLE images ALTER COLUMN image_data SET STORAGE EXTERNAL")
+    cur.execute("ALTER TABLE blobs ALTER COLUMN data SET STORAGE EXTERNAL")
+
+
+# -- 4: metadata-only images table -----------------------------------------------
+# Rows written before deduplication still carry their bytes in images.image_data.
+# Move those into blobs (sharing rows with identical content) so that images
+# holds nothing but metadata and scanning it never touches blob pages.
+
+SQLITE_METADATA_TABLE = """
+    CREATE TABLE {name} (
+        id TEXT PRIMARY KEY,
+        nickname TEXT NOT NULL,
+        mime_type TEXT NOT NULL,
+        byte_size INTEGER NOT NULL,
+        content_hash TEXT NOT NULL REFERENCES blobs (content_hash),
+        created_at TEXT
+    )
+"""
+
+
+def _split_images_sqlite(cur):
+    # SQLite has no SHA-256 function, so hash rows that predate content hashing here
+    cur.execute("SELECT rowid FROM images WHERE image_data IS NOT NULL AND content_hash IS NULL")
+    for (rowid,) in cur.fetchall():
+        cur.execute("SELECT image_data FROM images WHERE rowid = ?", (rowid,))
+        content_hash = hashlib.sha256(cur.fetchone()[0]).hexdigest()
+        cur.execute("UPDATE images SET content_hash = ? WHERE rowid = ?", (content_hash, rowid))
+    cur.execute("UPDATE images SET byte_size = length(image_data) WHERE image_data IS NOT NULL AND byte_size IS NULL")
+    cur.execute("""
+        INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at)
+        SELECT content_hash, MAX(byte_size), 0, image_data, MIN(created_at) FROM images
+        WHERE image_data IS NOT NULL GROUP BY content_hash
+        ON CONFLICT (content_hash) DO NOTHING
+    """)
+    cur.execute("""
+        UPDATE blobs SET ref_count = ref_count + (
+            SELECT COUNT(*) FROM images WHERE images.content_hash = blobs.content_hash AND images.image_data IS NOT NULL
+        )
+        WHERE content_hash IN (SELECT content_hash FROM images WHERE image_data IS NOT NULL)
+    """)
+    cur.execute(SQLITE_METADATA_TABLE.format(name="images_metadata"))
+    cur.execute("""
+        INSERT INTO images_metadata (id, nickname, mime_type, byte_size, content_hash, created_at)
+        SELECT id, nickname, mime_type, byte_size, content_hash, created_at FROM images
+    """)
+    cur.execute("DROP TABLE images")
+    cur.execute("ALTER TABLE images_metadata RENAME TO images")
+    cur.execute("CREATE INDEX images_content_hash ON images (content_hash)")
+    cur.execute("CREATE INDEX images_nickname ON images (nickname)")
+
+
+def _split_images_postgres(cur):
+    cur.execute("""
+        UPDATE images SET content_hash = encode(sha256(image_data), 'hex')
+        WHERE image_data IS NOT NULL AND content_hash IS NULL
+    """)
+    cur.execute("""
+        UPDATE images SET byte_size = octet_length(image_data) WHERE image_data IS NOT NULL AND byte_size IS NULL
+    """)
+    cur.execute("""
+        INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at)
+        SELECT DISTINCT ON (content_hash) content_hash, byte_size, 0, image_data, created_at FROM images
+        WHERE image_data IS NOT NULL ORDER BY content_hash, created_at
+        ON CONFLICT (content_hash) DO NOTHING
+    """)
+    cur.execute("""
+        UPDATE blobs SET ref_count = blobs.ref_count + legacy.refs
+        FROM (
+            SELECT content_hash, COUNT(*) AS refs FROM images WHERE image_data IS NOT NULL GROUP BY content_hash
+        ) legacy
+        WHERE blobs.content_hash = legacy.content_hash
+    """)
+    cur.execute("ALTER TABLE images DROP COLUMN image_data")
+    cur.execute("ALTER TABLE images ALTER COLUMN byte_size SET NOT NULL")
+    cur.execute("ALTER TABLE images ALTER COLUMN content_hash SET NOT NULL")
+    cur.execute("""
+        ALTER TABLE images ADD CONSTRAINT images_content_hash_fkey
+        FOREIGN KEY (content_hash) REFERENCES blobs (content_hash) NOT VALID
+    """)
+    cur.execute("ALTER TABLE images VALIDATE CONSTRAINT images_content_hash_fkey")
+
+
+# -- 5: covering listing index ----------------------------------------------------
+# Nickname listings need only metadata; with every column they read in the index,
+# they become index-only scans. Supersedes the plain nickname index.
+
+def _listing_index_sqlite(cur):
+    # SQLite has no INCLUDE; trailing key columns make the index covering all the same
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS images_nickname_listing
+        ON images (nickname, created_at, id, mime_type, byte_size, content_hash)
+    """)
+    cur.execute("DROP INDEX IF EXISTS images_nickname")
+
+
+def _listing_index_postgres(cur):
+    cur.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'images_nickname_listing' AND NOT i.indisvalid
+    """)
+    if cur.fetchone():
+        cur.execute("DROP INDEX CONCURRENTLY images_nickname_listing")
+    cur.execute("""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS images_nickname_listing
+        ON images (nickname, created_at) INCLUDE (image_id, mime_type, byte_size, content_hash)
+    """)
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS images_nickname")
+
+
+# -- 6: time-ordered id default ---------------------------------------------------
+# The app assigns UUIDv7 ids itself (ids.uuid7); rows inserted without one, e.g.
+# from psql, should not fall back to random uuid4 keys scattered across the
+# primary-key B-tree. PostgreSQL 18's built-in uuidv7() is not assumed.
+
+def _uuid7_default_postgres(cur):
+    # Overlay the millisecond timestamp on a random uuid and flip the version
+    # nibble from 4 (0100) to 7 (0111); set_bit counts bits from the low end of each byte
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION uuid_generate_v7() RETURNS uuid AS $$
+            SELECT encode(
+                set_bit(set_bit(
+                    overlay(uuid_send(gen_random_uuid())
+                            PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint) FROM 3)
+                            FROM 1 FOR 6),
+                    52, 1), 53, 1),
+                'hex')::uuid
+        $$ LANGUAGE sql VOLATILE
+    """)
+    cur.execute("ALTER TABLE images ALTER COLUMN image_id SET DEFAULT uuid_generate_v7()")
+
+
+# -- 7: keyset pagination indexes -------------------------------------------------
+# Listings page by (created_at, id), optionally within one nickname, with NULL
+# created_at (rows older than migration 4's timestamps) first on both backends.
+# SQLite sorts NULLs first already and images_nickname_listing has the right key
+# order; PostgreSQL needs NULLS FIRST and image_id as a key column, not INCLUDEd.
+
+def _keyset_indexes_sqlite(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS images_created_keyset ON images (created_at, id)")
+
+
+def _keyset_indexes_postgres(cur):
+    for name, definition in (
+        ("images_created_keyset", "(created_at NULLS FIRST, image_id)"),
+        ("images_nickname_keyset",
+         "(nickname, created_at NULLS FIRST, image_id) INCLUDE (mime_type, byte_size, content_hash)"),
+    ):
+        cur.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cur.fetchone():
+            cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON images {definition}")
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS images_nickname_listing")
+
+
+MIGRATIONS = [
+    Migration(1, "baseline", sqlite=_baseline_sqlite, postgres=_baseline_postgres),
+    Migration(2, "images_nickname_index", sqlite=_nickname_index_sqlite, postgres=_nickname_index_postgres,
+              atomic=False),
+    Migration(3, "image_storage_external", postgres=_external_storage_postgres),
+    Migration(4, "split_image_metadata", sqlite=_split_images_sqlite, postgres=_split_images_postgres),
+    Migration(5, "images_nickname_listing_index", sqlite=_listing_index_sqlite, postgres=_listing_index_postgres,
+              atomic=False),
+    Migration(6, "uuid7_id_default", postgres=_uuid7_default_postgres),
+    Migration(7, "keyset_pagination_indexes", sqlite=_keyset_indexes_sqlite, postgres=_keyset_indexes_postgres,
+              atomic=False),
+]
+
+
+def _ensure_versions_table(conn, db_type):
+    cur = conn.cursor()
+    try:
+        applied_at_type = "TIMESTAMPTZ" if db_type == "postgres" else "TEXT"
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at {applied_at_type} NOT NULL,
+                duration_ms INTEGER
+            )
+        """)
+        conn.commit()
+    finally:
+        cur.close()
+
+
+def applied_versions(conn, db_type):
+    """Versions already applied, oldest first."""
+    _ensure_versions_table(conn, db_type)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT version FROM {VERSIONS_TABLE} ORDER BY version")
+        versions = [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+    conn.rollback()
+    return versions
+
+
+def pending_migrations(conn, db_type, target=None):
+    applied = set(applied_versions(conn, db_type))
+    return [
+        migration for migration in MIGRATIONS
+        if migration.version not in applied and (target is None or migration.version <= target)
+    ]
+
+
+def _record(cur, db_type, migration, started):
+    param = "%s" if db_type == "postgres" else "?"
+    cur.execute(
+        f"INSERT INTO {VERSIONS_TABLE} (version, name, applied_at, duration_ms) VALUES ({param}, {param}, {param}, {param})",
+        (migration.version, migration.name, to_db_time(db_type, utcnow()), int((time.monotonic() - started) * 1000))
+    )
+
+
+def _apply_one(conn, db_type, migration):
+    # False if another process applied the migration first
+    started = time.monotonic()
+    cur = conn.cursor()
+    try:
+        if db_type == "postgres" and not migration.atomic:
+            # CREATE INDEX CONCURRENTLY waits for every open transaction, this session's included
+            conn.rollback()
+            conn.autocommit = True
+            try:
+                migration.run(cur, db_type)
+            finally:
+                conn.autocommit = False
+        else:
+            if db_type == "sqlite":
+                # Python's sqlite3 would otherwise run DDL outside any transaction
+                cur.execute("BEGIN IMMEDIATE")
+                # The pending list was read before the write lock; another process may have won the race
+                cur.execute(f"SELECT 1 FROM {VERSIONS_TABLE} WHERE version = ?", (migration.version,))
+                if cur.fetchone():
+                    conn.rollback()
+                    return False
+            migration.run(cur, db_type)
+        _record(cur, db_type, migration, started)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    logging.info(f"Applied migration {migration.version} ({migration.name}) in {time.monotonic() - started:.2f}s.")
+    return True
+
+
+def _take_migration_lock(conn):
+    # Polled in autocommit mode: a waiter blocked inside a transaction would hold a
+    # snapshot that the lock holder's CREATE INDEX CONCURRENTLY has to wait for
+    conn.commit()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        waiting = False
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (_PG_LOCK_KEY,))
+            if cur.fetchone()[0]:
+                return
+            if not waiting:
+                logging.info("Waiting for another process to finish applying migrations.")
+                waiting = True
+            time.sleep(_PG_LOCK_POLL_INTERVAL)
+    finally:
+        cur.close()
+        conn.autocommit = False
+
+
+def apply_migrations(conn, db_type, target=None):
+    """Apply every pending migration up to ``target`` (all by default) in order; returns those applied.
+
+    On PostgreSQL a session-level advisory lock keeps processes starting at the
+    same time from racing; on SQLite each migration holds the write lock while it
+    runs, and is skipped if it turns out to be recorded once the lock is taken.
+    """
+    if db_type == "postgres":
+        _take_migration_lock(conn)
+    try:
+        applied = []
+        # Re-read after taking the lock: another process may have just finished
+        for migration in pending_migrations(conn, db_type, target):
+            if _apply_one(conn, db_type, migration):
+                applied.append(migration)
+        return applied
+    finally:
+        if db_type == "postgres":
+            conn.rollback()
+            conn.autocommit = True
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_PG_LOCK_KEY,))
+            finally:
+                cur.close()
+                conn.autocommit = False
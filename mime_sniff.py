@@ -0,0 +1,60 @@
+import re
+import struct
+
+# Enough for every signature below, including an ftyp box with a long list of
+# compatible brands.
+HEADER_SIZE = 512
+
+# Fixed-offset signatures, matched in a single pass by one compiled alternation.
+_SIGNATURES = [
+    ("image/jpeg", rb"\xff\xd8\xff"),
+    ("image/png", rb"\x89PNG\r\n\x1a\n"),
+    ("image/gif", rb"GIF8[79]a"),
+    ("image/webp", rb"RIFF.{4}WEBP"),
+    ("image/tiff", rb"II\*\x00|MM\x00\*"),
+    ("image/bmp", rb"BM.{4}\x00\x00\x00\x00"),
+    ("image/vnd.microsoft.icon", rb"\x00\x00\x01\x00[^\x00]"),
+]
+_SIGNATURE_RE = re.compile(
+    b"|".join(b"(?P<g%d>%s)" % (i, pattern) for i, (_, pattern) in enumerate(_SIGNATURES)),
+    re.DOTALL,
+)
+_GROUP_MIME = {f"g{i}": mime for i, (mime, _) in enumerate(_SIGNATURES)}
+
+# ISO-BMFF brands (major or compatible) identifying still-image HEIF variants.
+_FTYP_BRANDS = {
+    b"avif": "image/avif",
+    b"avis": "image/avif",
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"heim": "image/heic",
+    b"heis": "image/heic",
+    b"hevc": "image/heic-sequence",
+    b"hevx": "image/heic-sequence",
+    b"mif1": "image/heif",
+    b"msf1": "image/heif-sequence",
+}
+# When several brands match, the most specific one wins.
+_FTYP_PRIORITY = ["image/avif", "image/heic", "image/heic-sequence", "image/heif", "image/heif-sequence"]
+
+
+def _sniff_ftyp(header):
+    if len(header) < 16 or header[4:8] != b"ftyp":
+        return None
+    box_size = struct.unpack(">I", header[:4])[0]
+    end = min(box_size if box_size >= 16 else len(header), len(header))
+    # Major brand at 8..12, minor version at 12..16, compatible brands after that.
+    brands = [header[8:12]] + [header[i:i + 4] for i in range(16, end - 3, 4)]
+    found = {_FTYP_BRANDS[brand] for brand in brands if brand in _FTYP_BRANDS}
+    for mime in _FTYP_PRIORITY:
+        if mime in found:
+            return mime
+    return None
+
+
+def sniff(header):
+    """Return the image MIME type identified by the leading bytes, or None."""
+    match = _SIGNATURE_RE.match(header)
+    if match:
+        return _GROUP_MIME[match.lastgroup]
+    return _sniff_ftyp(header)
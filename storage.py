@@ -0,0 +1,783 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import uuid
+from datetime import datetime, timezone
+
+try:
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+from ids import uuid7
+
+
+class UploadStream:
+    """Read-only wrapper around an upload that hashes and counts bytes as they pass.
+
+    Nothing beyond the sniffed header and one chunk is held in memory, so the
+    storage layer can copy arbitrarily large uploads in constant space.
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self._stream = stream
+        self.chunk_size = chunk_size
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self.size = 0
+        self.prehashed = None
+        self.prehashed_size = None
+
+    def header(self, n):
+        # Read ahead without consuming, so sniffing never costs a second pass.
+        while len(self._head) < n:
+            data = self._stream.read(n - len(self._head))
+            if not data:
+                break
+            self._head += data
+        return self._head[:n]
+
+    def length(self):
+        # Total payload size, or None when the stream cannot tell without reading it.
+        try:
+            pos = self._stream.tell()
+            end = self._stream.seek(0, os.SEEK_END)
+            self._stream.seek(pos)
+        except (AttributeError, OSError, ValueError):
+            return None
+        return end - pos + len(self._head)
+
+    def prehash(self):
+        """Hash the whole upload ahead of storing it, then rewind; None if the stream cannot rewind."""
+        try:
+            pos = self._stream.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        hasher = hashlib.sha256(self._head)
+        size = len(self._head)
+        while True:
+            data = self._stream.read(self.chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+            size += len(data)
+        self._stream.seek(pos)
+        self.prehashed, self.prehashed_size = hasher.hexdigest(), size
+        return self.prehashed
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = self._head + self._stream.read()
+            self._head = b""
+        elif self._head:
+            data, self._head = self._head[:n], self._head[n:]
+        else:
+            data = self._stream.read(n)
+        if self.prehashed is None:
+            self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def chunks(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    @property
+    def content_hash(self):
+        return self.prehashed or self._hash.hexdigest()
+
+
+class CopyStream:
+    """File-like object over a generator of byte strings, for psycopg2's ``copy_expert``.
+
+    ``copy_expert`` pulls from it in ``size`` reads, so rows produced by
+    ``copy_text_row`` or ``copy_binary`` reach Postgres without the whole COPY
+    payload, or any one image, being assembled in memory.
+    """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            part = next(self._parts, None)
+            if part is None:
+                break
+            self._buffer += part
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def copy_text_row(leading, upload, trailing):
+    """One COPY text-format row with the upload as a hex bytea column, in pieces.
+
+    ``trailing`` is a callable so columns derived from the bytes, such as the
+    content hash, can follow them in the same row.
+    """
+    yield b"\t".join(_copy_escape(value) for value in leading) + b"\t\\\\x"
+    for chunk in upload.chunks():
+        yield chunk.hex().encode("ascii")
+    yield b"\t" + b"\t".join(_copy_escape(value) for value in trailing()) + b"\n"
+
+
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def _pg_timestamptz(value):
+    # Microseconds since 2000-01-01 UTC
+    delta = value - _PG_EPOCH
+    return struct.pack(">q", (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds)
+
+
+_BINARY_ENCODERS = {
+    "text": lambda value: value.encode("utf-8"),
+    "int4": lambda value: struct.pack(">i", value),
+    "int8": lambda value: struct.pack(">q", value),
+    "uuid": lambda value: uuid.UUID(value).bytes,
+    "timestamptz": _pg_timestamptz,
+    "bytea": bytes,
+}
+
+
+def copy_binary(types, rows):
+    """``COPY ... FROM STDIN WITH (FORMAT binary)`` data for ``rows``, in pieces.
+
+    ``types`` names each column's type (a key of ``_BINARY_ENCODERS``). A bytea
+    value may be a ``(length, chunks)`` pair, which is streamed instead of being
+    held in memory.
+    """
+    encoders = [_BINARY_ENCODERS[column_type] for column_type in types]
+    yield _COPY_SIGNATURE
+    for row in rows:
+        yield struct.pack(">h", len(row))
+        for encode, value in zip(encoders, row):
+            if value is None:
+                yield struct.pack(">i", -1)
+            elif isinstance(value, tuple):
+                length, chunks = value
+                yield struct.pack(">i", length)
+                yield from chunks
+            else:
+                data = encode(value)
+                yield struct.pack(">i", len(data)) + data
+    yield struct.pack(">h", -1)
+
+
+def _copy_escape(value):
+    if value is None:
+        return b"\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .encode("utf-8")
+    )
+
+
+def _dialect(db_type):
+    # (primary key column, parameter placeholder) for each backend's images table
+    if db_type == "postgres":
+        return "image_id", "%s"
+    elif db_type == "sqlite":
+        return "id", "?"
+    raise ValueError("Unsupported DB_TYPE specified")
+
+
+def _oldest_first(db_type, alias=""):
+    # ORDER BY for (created_at, id) with NULL created_at first, matching the keyset indexes;
+    # SQLite already sorts NULLs first
+    id_column, _ = _dialect(db_type)
+    nulls = " NULLS FIRST" if db_type == "postgres" else ""
+    return f"{alias}created_at{nulls}, {alias}{id_column}"
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def to_db_time(db_type, value):
+    # SQLite has no timestamp type; store fixed-width UTC text so it sorts correctly.
+    if db_type == "sqlite":
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+    return value
+
+
+def from_db_time(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _acquire_blob(cur, db_type, upload, blobs):
+    # Take a reference on an already stored blob; False when its bytes must be written
+    content_hash = upload.prehashed
+    _, param = _dialect(db_type)
+    cur.execute(f"UPDATE blobs SET ref_count = ref_count + 1 WHERE content_hash = {param}", (content_hash,))
+    if cur.rowcount == 0:
+        return False
+    if blobs is not None and blobs.external:
+        cur.execute(f"SELECT data IS NULL FROM blobs WHERE content_hash = {param}", (content_hash,))
+        # An interrupted garbage collection can leave a row whose file is already gone
+        if cur.fetchone()[0] and not blobs.exists(content_hash):
+            blobs.write(upload)
+    return True
+
+
+def _write_blob(conn, cur, db_type, upload, created_at, blobs):
+    """Store the bytes of a blob not seen before and add its row with one reference."""
+    if blobs is not None and blobs.external:
+        # The bytes are durable in the store before the row that points at them exists
+        blobs.write(upload)
+        _, param = _dialect(db_type)
+        cur.execute(
+            f"INSERT INTO blobs (content_hash, byte_size, ref_count, created_at) VALUES ({param}, {param}, 1, {param}) "
+            "ON CONFLICT (content_hash) DO UPDATE SET ref_count = blobs.ref_count + 1",
+            (upload.content_hash, upload.size, created_at)
+        )
+    elif db_type == "postgres":
+        row = CopyStream(copy_text_row([created_at.isoformat(), 1], upload, lambda: [upload.content_hash, upload.size]))
+        # COPY cannot upsert; a concurrent upload of the same bytes surfaces as a unique violation
+        cur.execute("SAVEPOINT write_blob")
+        try:
+            cur.copy_expert(
+                "COPY blobs (created_at, ref_count, data, content_hash, byte_size) FROM STDIN", row, size=upload.chunk_size
+            )
+        except Exception as e:
+            if getattr(e, "pgcode", None) != "23505":
+                raise
+            cur.execute("ROLLBACK TO SAVEPOINT write_blob")
+            cur.execute(
+                "UPDATE blobs SET ref_count = ref_count + 1 WHERE content_hash = %s", (upload.content_hash,)
+            )
+        else:
+            cur.execute("RELEASE SAVEPOINT write_blob")
+    elif db_type == "sqlite":
+        size = upload.length()
+        if size is None or not hasattr(conn, "blobopen") or upload.prehashed is None:
+            # No incremental blob I/O available (Python < 3.11 or unsized stream).
+            data = upload.read()
+            cur.execute(
+                "INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at) VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT (content_hash) DO UPDATE SET ref_count = ref_count + 1",
+                (upload.content_hash, upload.size, sqlite3.Binary(data), created_at)
+            )
+        else:
+            # SQLite serializes writers, so nobody can have inserted this hash since _acquire_blob
+            cur.execute(
+                "INSERT INTO blobs (content_hash, byte_size, ref_count, data, created_at) "
+                "VALUES (?, ?, 1, zeroblob(?), ?)",
+                (upload.prehashed, size, size, created_at)
+            )
+            with conn.blobopen("blobs", "data", cur.lastrowid) as blob:
+                for chunk in upload.chunks():
+                    blob.write(chunk)
+    else:
+        raise ValueError("Unsupported DB_TYPE specified")
+
+
+def _store_blob(conn, cur, db_type, upload, created_at, blobs):
+    # (content_hash, byte_size, duplicate) after taking a reference on the upload's blob
+    content_hash = upload.prehash()
+    if content_hash is not None and _acquire_blob(cur, db_type, upload, blobs):
+        return content_hash, upload.prehashed_size, True
+    _write_blob(conn, cur, db_type, upload, created_at, blobs)
+    return upload.content_hash, upload.size, False
+
+
+def insert_image(conn, db_type, image_id, nickname, mime_type, upload, created_at=None, blobs=None):
+    """Store ``upload`` once per distinct content and add an images row referencing it.
+
+    The upload is hashed first when its stream can be rewound, so bytes already
+    stored cost only a reference count bump and the metadata insert. New bytes
+    are streamed into ``blobs`` (or the blobs table) in ``upload.chunk_size``
+    pieces. Returns True when the upload was a duplicate.
+    """
+    created_at = to_db_time(db_type, created_at or utcnow())
+    id_column, param = _dialect(db_type)
+    cur = conn.cursor()
+    try:
+        content_hash, size, duplicate = _store_blob(conn, cur, db_type, upload, created_at, blobs)
+        cur.execute(
+            f"INSERT INTO images ({id_column}, nickname, mime_type, content_hash, byte_size, created_at) "
+            f"VALUES ({param}, {param}, {param}, {param}, {param}, {param})",
+            (image_id, nickname, mime_type, content_hash, size, created_at)
+        )
+        return duplicate
+    finally:
+        cur.close()
+
+
+def insert_images(conn, db_type, entries, created_at=None, blobs=None):
+    """Store several uploads in the caller's transaction, with one multi-row images insert.
+
+    ``entries`` holds ``(image_id, nickname, mime_type, upload)`` tuples. Each
+    blob is stored under its own savepoint, so a file that fails is rolled back
+    alone. Returns one outcome per entry: ``(content_hash, byte_size, duplicate)``,
+    or the exception that file failed with.
+    """
+    created_at = to_db_time(db_type, created_at or utcnow())
+    id_column, param = _dialect(db_type)
+    outcomes = []
+    rows = []
+    cur = conn.cursor()
+    try:
+        if db_type == "sqlite" and not conn.in_transaction:
+            # A savepoint opened outside a transaction would commit on release
+            cur.execute("BEGIN")
+        for image_id, nickname, mime_type, upload in entries:
+            cur.execute("SAVEPOINT insert_entry")
+            try:
+                content_hash, size, duplicate = _store_blob(conn, cur, db_type, upload, created_at, blobs)
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT insert_entry")
+                outcomes.append(e)
+            else:
+                rows.append((image_id, nickname, mime_type, content_hash, size, created_at))
+                outcomes.append((content_hash, size, duplicate))
+            cur.execute("RELEASE SAVEPOINT insert_entry")
+        columns = f"{id_column}, nickname, mime_type, content_hash, byte_size, created_at"
+        if rows and db_type == "postgres":
+            psycopg2.extras.execute_values(cur, f"INSERT INTO images ({columns}) VALUES %s", rows, page_size=1000)
+        elif rows:
+            cur.executemany(f"INSERT INTO images ({columns}) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return outcomes
+    finally:
+        cur.close()
+
+
+class StoredImage:
+    """One image's metadata plus whichever form of its bytes the store can supply.
+
+    ``blobs`` is the external blob store holding the bytes, or None when they are
+    in the blobs table. ``path`` is set when they live in a file the web server
+    can send directly (``relative_path`` locates it under the store root for
+    X-Accel-Redirect); otherwise ``data`` holds them once loaded with
+    ``read_image_data``.
+    """
+
+    def __init__(self, image_id, mime_type, size, content_hash=None, created_at=None,
+                 data=None, path=None, relative_path=None, blobs=None, nickname=None):
+        self.image_id = image_id
+        self.nickname = nickname
+        self.mime_type = mime_type
+        self.size = size
+        self.content_hash = content_hash
+        self.created_at = created_at
+        self.data = data
+        self.path = path
+        self.relative_path = relative_path
+        self.blobs = blobs
+
+
+def _image_columns(db_type):
+    # Metadata columns plus whether the bytes are in the blobs table, from images i JOIN blobs b
+    id_column, _ = _dialect(db_type)
+    return f"i.{id_column}, i.mime_type, i.byte_size, i.content_hash, i.created_at, b.data IS NOT NULL"
+
+
+_IMAGES_WITH_BLOBS = "images i JOIN blobs b ON b.content_hash = i.content_hash"
+
+
+def _stored_image(blobs, row):
+    image_id, mime_type, size, content_hash, created_at, in_table = row
+    image = StoredImage(str(image_id), mime_type, size, content_hash, from_db_time(created_at))
+    if not in_table:
+        if blobs is None or not blobs.external:
+            raise LookupError(f"Image {image_id} is stored externally but no external blob store is configured")
+        image.blobs = blobs
+        if blobs.serves_files:
+            image.path = blobs.path(content_hash)
+            image.relative_path = blobs.relative_path(content_hash)
+    return image
+
+
+def find_image(conn, db_type, image_id=None, nickname=None, blobs=None):
+    """Look up one image's metadata by id, or the oldest image stored under ``nickname``.
+
+    The blob itself is not read, so callers can answer conditional requests first.
+    """
+    id_column, param = _dialect(db_type)
+    column, key = (id_column, image_id) if image_id else ("nickname", nickname)
+    cur = conn.cursor()
+    try:
+        # Oldest first, as in the listings, so the same image (and its validators) is served every time
+        cur.execute(
+            f"SELECT {_image_columns(db_type)} FROM {_IMAGES_WITH_BLOBS} WHERE i.{column} = {param} "
+            f"ORDER BY {_oldest_first(db_type, 'i.')} LIMIT 1",
+            (key,)
+        )
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if row is None:
+        return None
+    return _stored_image(blobs, row)
+
+
+def read_image_data(conn, db_type, image):
+    """Fill in ``image.data`` from the table or blob store holding it."""
+    if image.blobs is not None:
+        image.data = image.blobs.read(image.content_hash)
+        return image
+    _, param = _dialect(db_type)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT data FROM blobs WHERE content_hash = {param}", (image.content_hash,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if row is None:
+        raise LookupError(f"Image {image.image_id} disappeared while being read")
+    image_data = row[0]
+    image.data = image_data if isinstance(image_data, bytes) else bytes(image_data)
+    return image
+
+
+def fetch_images(conn, db_type, nickname, blobs=None):
+    """Every image stored under ``nickname``, with ``data`` loaded from wherever it lives.
+
+    This holds the whole result set in memory; use ``iter_images`` for nicknames
+    with many or large images.
+    """
+    id_column, param = _dialect(db_type)
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"SELECT {_image_columns(db_type)}, b.data "
+            f"FROM {_IMAGES_WITH_BLOBS} WHERE i.nickname = {param} ORDER BY {_oldest_first(db_type, 'i.')}",
+            (nickname,)
+        )
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+    images = []
+    for row in rows:
+        image = _stored_image(blobs, row[:6])
+        if image.blobs is not None:
+            read_image_data(conn, db_type, image)
+        else:
+            image.data = row[6] if isinstance(row[6], bytes) else bytes(row[6])
+        images.append(image)
+    return images
+
+
+def list_image_sizes(conn, db_type, nickname):
+    """``(id, size)`` of every image stored under ``nickname``, without reading any blob."""
+    id_column, param = _dialect(db_type)
+    cur = conn.cursor()
+    try:
+        # Oldest first, in the order of the nickname listing index
+        cur.execute(
+            f"SELECT {id_column}, byte_size FROM images WHERE nickname = {param} ORDER BY {_oldest_first(db_type)}",
+            (nickname,)
+        )
+        return [(str(image_id), size) for image_id, size in cur.fetchall()]
+    finally:
+        cur.close()
+
+
+def list_images_page(conn, db_type, nickname=None, after=None, limit=50):
+    """One page of image metadata, oldest first, and the key of its last row (None on the last page).
+
+    ``after`` is a key returned for the previous page: ``(created_at, id)`` as
+    strings, with ``created_at`` exactly as stored. Each page is a seek on the
+    keyset indexes rather than an OFFSET, so page N costs the same as page 1.
+    Rows without a ``created_at`` come first. Bytes are never read.
+    """
+    id_column, param = _dialect(db_type)
+    scope, scope_params = ([f"nickname = {param}"], [nickname]) if nickname is not None else ([], [])
+    if after is None:
+        segments = [([], [])]
+    elif after[0] is None:
+        # NULLs cannot be compared, so finish the NULL run first, then start on the timestamps
+        segments = [(["created_at IS NULL", f"{id_column} > {param}"], [after[1]]), (["created_at IS NOT NULL"], [])]
+    else:
+        segments = [([f"created_at >= {param}", f"(created_at > {param} OR {id_column} > {param})"],
+                     [after[0], after[0], after[1]])]
+    rows = []
+    cur = conn.cursor()
+    try:
+        for conditions, params in segments:
+            if len(rows) > limit:
+                break
+            where = " AND ".join(scope + conditions)
+            cur.execute(
+                f"SELECT {id_column}, nickname, mime_type, byte_size, content_hash, created_at FROM images "
+                f"{'WHERE ' + where + ' ' if where else ''}ORDER BY {_oldest_first(db_type)} LIMIT {param}",
+                scope_params + params + [limit + 1 - len(rows)]
+            )
+            rows.extend(cur.fetchall())
+    finally:
+        cur.close()
+    # One row more than a page tells whether another page follows
+    images = [
+        StoredImage(str(image_id), mime_type, size, content_hash, from_db_time(created_at), nickname=row_nickname)
+        for image_id, row_nickname, mime_type, size, content_hash, created_at in rows[:limit]
+    ]
+    if len(rows) <= limit:
+        return images, None
+    last_created_at = rows[limit - 1][5]
+    if last_created_at is not None and not isinstance(last_created_at, str):
+        last_created_at = last_created_at.isoformat()
+    return images, (last_created_at, images[-1].image_id)
+
+
+def list_nicknames_page(conn, db_type, after=None, limit=50):
+    """One page of ``(nickname, image count)`` in nickname order, after the nickname ``after``.
+
+    Returns the page and the nickname to continue after, or None on the last page.
+    """
+    _, param = _dialect(db_type)
+    where, params = (f"WHERE nickname > {param} ", [after]) if after is not None else ("", [])
+    cur = conn.cursor()
+    try:
+        # Walks the nickname listing index in order and stops after limit + 1 groups
+        cur.execute(
+            f"SELECT nickname, COUNT(*) FROM images {where}GROUP BY nickname ORDER BY nickname LIMIT {param}",
+            params + [limit + 1]
+        )
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], rows[limit - 1][0]
+
+
+def begin_read_snapshot(conn, db_type):
+    """Start a read-only transaction in which every query sees the same snapshot.
+
+    On PostgreSQL this never blocks writers. SQLite only reads a snapshot in WAL
+    mode; with a rollback journal the transaction holds off writers until it ends.
+    """
+    cur = conn.cursor()
+    try:
+        if db_type == "postgres":
+            conn.rollback()
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        elif not conn.in_transaction:
+            cur.execute("BEGIN")
+    finally:
+        cur.close()
+
+
+def iter_images(conn, db_type, nickname=None, since=None, until=None, blobs=None, batch_size=500):
+    """Metadata of matching images, oldest first, fetched ``batch_size`` rows at a time.
+
+    PostgreSQL uses a named (server-side) cursor and SQLite steps through its
+    cursor with fetchmany, so only one batch is ever held in memory. Bytes are
+    not loaded; stream them with ``iter_image_chunks``.
+    """
+    id_column, param = _dialect(db_type)
+    conditions = []
+    params = []
+    for condition, value in (
+        (f"i.nickname = {param}", nickname),
+        (f"i.created_at >= {param}", since and to_db_time(db_type, since)),
+        (f"i.created_at < {param}", until and to_db_time(db_type, until)),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    query = (
+        f"SELECT {_image_columns(db_type)}, i.nickname FROM {_IMAGES_WITH_BLOBS} "
+        f"{where}ORDER BY {_oldest_first(db_type, 'i.')}"
+    )
+    if db_type == "postgres":
+        # Named cursors live until the end of the transaction, so each needs a fresh name
+        cur = conn.cursor(name=f"iter_images_{os.urandom(4).hex()}")
+        cur.itersize = batch_size
+    else:
+        cur = conn.cursor()
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                image = _stored_image(blobs, row[:6])
+                image.nickname = row[6]
+                yield image
+    finally:
+        cur.close()
+
+
+def iter_image_chunks(conn, db_type, image, chunk_size=1024 * 1024):
+    """Yield an image's bytes in ``chunk_size`` pieces, never holding more than one."""
+    if image.data is not None:
+        for start in range(0, len(image.data), chunk_size):
+            yield image.data[start:start + chunk_size]
+        return
+    position = 0
+    while position < image.size:
+        chunk = read_image_range(conn, db_type, image, position, min(chunk_size, image.size - position))
+        if not chunk:
+            raise LookupError(f"Image {image.image_id} ended early at byte {position}")
+        yield chunk
+        position += len(chunk)
+
+
+def read_image_range(conn, db_type, image, start, length):
+    """Read ``length`` bytes at offset ``start`` without loading the whole image."""
+    if image.data is not None:
+        return image.data[start:start + length]
+    if image.blobs is not None:
+        return image.blobs.read_range(image.content_hash, start, length)
+    cur = conn.cursor()
+    try:
+        if db_type == "postgres":
+            # Only the TOAST chunks covering the range are fetched for uncompressed values
+            cur.execute(
+                "SELECT substring(data FROM %s FOR %s) FROM blobs WHERE content_hash = %s",
+                (start + 1, length, image.content_hash)
+            )
+            row = cur.fetchone()
+            return bytes(row[0]) if row else b""
+        if hasattr(conn, "blobopen"):
+            cur.execute("SELECT rowid FROM blobs WHERE content_hash = ?", (image.content_hash,))
+            row = cur.fetchone()
+            if row is None:
+                return b""
+            with conn.blobopen("blobs", "data", row[0], readonly=True) as blob:
+                blob.seek(start)
+                return blob.read(length)
+        cur.execute(
+            "SELECT substr(data, ?, ?) FROM blobs WHERE content_hash = ?",
+            (start + 1, length, image.content_hash)
+        )
+        row = cur.fetchone()
+        return bytes(row[0]) if row else b""
+    finally:
+        cur.close()
+
+
+def delete_image(conn, db_type, image_id):
+    """Delete one image and release its reference on the shared blob; returns its nickname or None."""
+    id_column, param = _dialect(db_type)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT nickname, content_hash FROM images WHERE {id_column} = {param}", (image_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        nickname, content_hash = row
+        cur.execute(f"DELETE FROM images WHERE {id_column} = {param}", (image_id,))
+        # Blobs left without references are reclaimed by collect_garbage
+        cur.execute(
+            f"UPDATE blobs SET ref_count = ref_count - 1 WHERE content_hash = {param} AND ref_count > 0",
+            (content_hash,)
+        )
+        return nickname
+    finally:
+        cur.close()
+
+
+def rekey_image_ids(conn, db_type, batch_size=1000):
+    """Replace every id that is not a UUIDv7 with one derived from the row's ``created_at``.
+
+    Yields ``(old_id, new_id, nickname)`` for each row once its batch is
+    committed. Rows without ``created_at`` get an id for the current time.
+    """
+    id_column, param = _dialect(db_type)
+    while True:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                f"SELECT {id_column}, nickname, created_at FROM images "
+                f"WHERE substr(CAST({id_column} AS TEXT), 15, 1) <> '7' LIMIT {param}",
+                (batch_size,)
+            )
+            rows = cur.fetchall()
+            renamed = []
+            for old_id, nickname, created_at in rows:
+                created_at = from_db_time(created_at)
+                new_id = str(uuid7(int(created_at.timestamp() * 1000) if created_at else None))
+                cur.execute(f"UPDATE images SET {id_column} = {param} WHERE {id_column} = {param}", (new_id, old_id))
+                renamed.append((str(old_id), new_id, nickname))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        if not renamed:
+            return
+        yield from renamed
+
+
+def collect_garbage(conn, db_type, blobs=None, grace_seconds=3600, batch_size=1000):
+    """Reclaim blobs nothing references any more; returns (blob rows, store entries) removed.
+
+    Each batch of unreferenced rows stays locked until its bytes are gone, so an
+    upload of the same content either waits and writes them afresh or took its
+    reference first. Entries in an external store with no row at all (left by
+    uploads that failed before committing) are removed once they are older than
+    ``grace_seconds``.
+    """
+    _, param = _dialect(db_type)
+    removed_rows = removed_entries = 0
+    cur = conn.cursor()
+    try:
+        while True:
+            if db_type == "sqlite":
+                # Take the write lock up front so no upload can re-reference a batch mid-way
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute(
+                    "SELECT content_hash, data IS NULL FROM blobs WHERE ref_count = 0 LIMIT ?", (batch_size,)
+                )
+            else:
+                cur.execute(
+                    "SELECT content_hash, data IS NULL FROM blobs WHERE ref_count = 0 "
+                    "LIMIT %s FOR UPDATE SKIP LOCKED",
+                    (batch_size,)
+                )
+            rows = cur.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+            for content_hash, external in rows:
+                if external and blobs is not None and blobs.external:
+                    blobs.delete(content_hash)
+            cur.executemany(
+                f"DELETE FROM blobs WHERE content_hash = {param} AND ref_count = 0",
+                [(content_hash,) for content_hash, _ in rows]
+            )
+            conn.commit()
+            removed_rows += len(rows)
+
+        if blobs is not None and blobs.external:
+            candidates = list(blobs.iter_hashes(older_than=grace_seconds))
+            for i in range(0, len(candidates), batch_size):
+                batch = candidates[i:i + batch_size]
+                placeholders = ", ".join([param] * len(batch))
+                cur.execute(
+                    f"SELECT content_hash FROM blobs WHERE content_hash IN ({placeholders}) "
+                    f"UNION SELECT content_hash FROM images WHERE content_hash IN ({placeholders})",
+                    batch + batch
+                )
+                referenced = {row[0] for row in cur.fetchall()}
+                conn.rollback()
+                for content_hash in batch:
+                    # Re-checking the age skips anything an upload has rewritten since the listing
+                    if content_hash not in referenced and blobs.delete(content_hash, older_than=grace_seconds):
+                        removed_entries += 1
+    finally:
+        cur.close()
+    return removed_rows, removed_entries
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# app.py reads its configuration when it is imported: point it at a throwaway SQLite
+# database, with Redis and the local cache turned off
+os.environ.setdefault("DB_TYPE", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="photo-app-tests-"), "photos.db"))
+os.environ.setdefault("BLOB_STORE", "inline")
+os.environ.setdefault("REDIS_ENABLED", "0")
+os.environ.setdefault("L1_CACHE_BYTES", "0")
@@ -0,0 +1,346 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+import zipfile
+
+import app
+from cache import CachedImage, LocalCache, entry_size
+from write_queue import GroupCommitQueue
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+def _upload(client, nickname, data=b"GIF89a" + b"\x00" * 32):
+    return client.post("/", data={"nickname": nickname, "image_data": (io.BytesIO(data), "a.gif", "image/gif")})
+
+
+def _upload_id(client, nickname, data):
+    response = _upload(client, nickname, data)
+    assert response.status_code == 200
+    return re.search(r"ID: <a href='/images/id/([0-9a-f-]+)/raw'>", response.get_data(as_text=True)).group(1)
+
+
+def test_foreground_load_does_not_share_a_background_refresh(monkeypatch):
+    client = app.app.test_client()
+    assert _upload(client, "refreshed").status_code == 200
+    load = app.load_nickname_images
+    refreshing = threading.Event()
+    release = threading.Event()
+
+    def load_nickname_images(nickname, generation, wait=True):
+        if not wait:
+            # A refresh that finds another process holding the fill lock
+            refreshing.set()
+            release.wait(5)
+            return None
+        return load(nickname, generation, wait)
+
+    monkeypatch.setattr(app, "load_nickname_images", load_nickname_images)
+    refresh = threading.Thread(target=app.refresh_nickname_images, args=("refreshed", None))
+    refresh.start()
+    try:
+        assert refreshing.wait(5)
+        threading.Timer(0.2, release.set).start()
+        response = client.get("/images/refreshed", headers={"Accept": "application/json"})
+    finally:
+        release.set()
+        refresh.join()
+
+    assert response.status_code == 200
+    assert [image["mime_type"] for image in response.get_json()] == ["image/gif"]
+
+
+def _slow_write_queue(monkeypatch, delay):
+    queue = GroupCommitQueue(app.db_pool, app.DB_TYPE)
+    insert_image = app.insert_image
+
+    def slow_insert_image(*args, **kwargs):
+        time.sleep(delay)
+        return insert_image(*args, **kwargs)
+
+    monkeypatch.setattr(app, "write_queue", queue)
+    monkeypatch.setattr(app, "insert_image", slow_insert_image)
+    monkeypatch.setattr(app, "WRITE_QUEUE_COMMIT_TIMEOUT", 0.1)
+    return queue
+
+
+def _count_images(nickname):
+    with app.db_pool.connection(readonly=True) as conn:
+        return len(app.list_image_sizes(conn, app.DB_TYPE, nickname))
+
+
+def test_queued_upload_waits_for_a_write_already_running(monkeypatch):
+    queue = _slow_write_queue(monkeypatch, 0.3)
+    try:
+        response = _upload(app.app.test_client(), "slow-write")
+    finally:
+        queue.close()
+
+    assert response.status_code == 200
+    assert _count_images("slow-write") == 1
+
+
+def test_queued_upload_not_yet_started_is_dropped_with_503(monkeypatch):
+    queue = _slow_write_queue(monkeypatch, 0.5)
+    first = threading.Thread(target=_upload, args=(app.app.test_client(), "busy-writer"))
+    first.start()
+    try:
+        time.sleep(0.1)
+        # The writer is busy with the first upload, so this one is still queued at the timeout
+        response = _upload(app.app.test_client(), "queued-write")
+    finally:
+        first.join()
+        queue.close()
+
+    assert response.status_code == 503
+    assert _count_images("busy-writer") == 1
+    assert _count_images("queued-write") == 0
+
+
+def test_raw_image_is_served_with_its_sniffed_type():
+    client = app.app.test_client()
+    data = PNG + os.urandom(5000)
+    image_id = _upload_id(client, "raw", data)
+
+    response = client.get(f"/images/id/{image_id}/raw")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.data == data
+    assert client.get("/images/id/00000000-0000-7000-8000-000000000000/raw").status_code == 404
+
+
+def test_raw_image_by_nickname_is_the_oldest():
+    client = app.app.test_client()
+    first = PNG + b"first"
+    _upload_id(client, "raw-oldest", first)
+    _upload_id(client, "raw-oldest", PNG + b"second")
+
+    response = client.get("/images/raw-oldest", headers={"Accept": "image/*"})
+
+    assert response.status_code == 200
+    assert response.data == first
+
+
+def test_raw_image_revalidates_with_etag_and_is_cached_forever():
+    client = app.app.test_client()
+    image_id = _upload_id(client, "etag", PNG + os.urandom(100))
+
+    response = client.get(f"/images/id/{image_id}/raw")
+    assert response.headers["Cache-Control"] == app.IMMUTABLE_CACHE_CONTROL
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+
+    revalidated = client.get(f"/images/id/{image_id}/raw", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+    assert client.get(f"/images/id/{image_id}/raw", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_nickname_listing_etag_changes_when_an_image_is_added():
+    client = app.app.test_client()
+    _upload_id(client, "etag-list", PNG + b"one")
+    json_headers = {"Accept": "application/json"}
+    response = client.get("/images/etag-list", headers=json_headers)
+    assert response.headers["Cache-Control"] == app.REVALIDATE_CACHE_CONTROL
+    etag = response.headers["ETag"]
+
+    assert client.get("/images/etag-list", headers={**json_headers, "If-None-Match": etag}).status_code == 304
+    _upload_id(client, "etag-list", PNG + b"two")
+    response = client.get("/images/etag-list", headers={**json_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
+
+
+def test_range_requests_return_partial_content():
+    client = app.app.test_client()
+    data = PNG + os.urandom(10_000)
+    image_id = _upload_id(client, "ranges", data)
+    url = f"/images/id/{image_id}/raw"
+
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(data)}"
+    assert response.data == data[100:200]
+
+    assert client.get(url, headers={"Range": "bytes=-50"}).data == data[-50:]
+
+    response = client.get(url, headers={"Range": "bytes=0-9,20-29"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert data[:10] in response.data and data[20:30] in response.data
+    assert int(response.headers["Content-Length"]) == len(response.data)
+
+    response = client.get(url, headers={"Range": f"bytes={len(data)}-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(data)}"
+
+
+def test_stale_if_range_sends_the_whole_image():
+    client = app.app.test_client()
+    data = PNG + os.urandom(1000)
+    image_id = _upload_id(client, "if-range", data)
+
+    response = client.get(f"/images/id/{image_id}/raw", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+
+    assert response.status_code == 200
+    assert response.data == data
+
+
+def test_uploads_invalidate_the_cached_nickname(monkeypatch):
+    invalidated = []
+
+    class RecordingCache:
+        def invalidate(self, nickname):
+            invalidated.append(nickname)
+
+    monkeypatch.setattr(app, "image_cache", RecordingCache())
+    _upload_id(app.app.test_client(), "invalidated", PNG + b"data")
+
+    assert invalidated == ["invalidated"]
+
+
+def _stale_local_cache(monkeypatch, nickname, stale_for):
+    cache = LocalCache(1024 * 1024, ttl=60)
+    images = [CachedImage("00000000-0000-7000-8000-0000000000aa", "image/png", PNG + b"cached")]
+    cache.set(nickname, images, entry_size(images), ttl=-stale_for, stale_ttl=stale_for + 3600)
+    monkeypatch.setattr(app, "local_cache", cache)
+
+
+def test_recently_stale_entries_are_served_while_revalidating(monkeypatch):
+    _stale_local_cache(monkeypatch, "stale", 1)
+    refreshes = []
+    monkeypatch.setattr(app.stale_refreshes, "submit", lambda key, fn: refreshes.append(key))
+
+    response = app.app.test_client().get("/images/stale", headers={"Accept": "application/json"})
+
+    assert response.status_code == 200
+    assert response.headers["Warning"] == '110 - "Response is Stale"'
+    assert refreshes == ["stale"]
+
+
+def test_stale_entries_are_served_when_loading_fails(monkeypatch):
+    _stale_local_cache(monkeypatch, "stale-error", app.CACHE_STALE_WHILE_REVALIDATE + 60)
+
+    def fail(nickname):
+        raise RuntimeError("database down")
+
+    monkeypatch.setattr(app, "open_nickname_stream", fail)
+
+    response = app.app.test_client().get("/images/stale-error", headers={"Accept": "application/json"})
+
+    assert response.status_code == 200
+    assert response.headers["Warning"] == '111 - "Revalidation Failed"'
+    assert len(response.get_json()) == 1
+
+
+def test_batch_upload_reports_each_file():
+    client = app.app.test_client()
+    png = PNG + os.urandom(100)
+    files = [(io.BytesIO(png), "a.png"), (io.BytesIO(b""), "empty.png"), (io.BytesIO(png), "copy.png")]
+
+    response = client.post("/images/batch", data={"nickname": "batch", "image_data": files})
+
+    assert response.status_code == 207
+    body = response.get_json()
+    assert (body["stored"], body["duplicate"], body["failed"]) == (1, 1, 1)
+    assert [result["status"] for result in body["files"]] == ["stored", "failed", "duplicate"]
+    assert body["files"][0]["mime_type"] == "image/png"
+    assert "id" not in body["files"][1]
+    assert _count_images("batch") == 2
+
+
+def test_export_archives_match_their_manifest():
+    client = app.app.test_client()
+    data = [PNG + os.urandom(3000) for _ in range(2)]
+    ids = [_upload_id(client, "export", content) for content in data]
+
+    response = client.get("/export?nickname=export")
+    assert response.headers["Cache-Control"] == "no-store"
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        names = archive.getnames()
+        manifest = [json.loads(line) for line in archive.extractfile("manifest.jsonl")]
+        members = {name: archive.extractfile(name).read() for name in names[:-1]}
+
+    assert names[-1] == "manifest.jsonl"
+    assert [entry["id"] for entry in manifest] == ids
+    assert [members[entry["path"]] for entry in manifest] == data
+    assert all(entry["sha256"] == hashlib.sha256(members[entry["path"]]).hexdigest() for entry in manifest)
+
+    zipped = client.get("/export?nickname=export&format=zip")
+    with zipfile.ZipFile(io.BytesIO(zipped.data)) as archive:
+        assert [archive.read(entry["path"]) for entry in manifest] == data
+    assert client.get("/export?format=rar").status_code == 400
+
+
+def test_large_nicknames_stream_the_same_json(monkeypatch):
+    client = app.app.test_client()
+    for _ in range(2):
+        _upload_id(client, "streamed", PNG + os.urandom(4000))
+    loaded = client.get("/images/streamed", headers={"Accept": "application/json"})
+
+    monkeypatch.setattr(app, "local_cache", None)
+    monkeypatch.setattr(app, "NICKNAME_STREAM_BYTES", 0)
+    streamed = client.get("/images/streamed", headers={"Accept": "application/json"})
+
+    assert streamed.status_code == loaded.status_code == 200
+    # Only a list built in memory knows its length up front
+    assert loaded.content_length == len(loaded.data)
+    assert "Content-Length" not in streamed.headers
+    assert streamed.data == loaded.data
+    assert streamed.headers["ETag"] == loaded.headers["ETag"]
+
+
+def test_images_json_is_written_in_chunks_with_an_exact_length(monkeypatch):
+    monkeypatch.setattr(app, "BASE64_CHUNK_SIZE", 3 * 4)
+    images = [
+        CachedImage("1", "image/png", os.urandom(100)),
+        CachedImage("2", "image/gif", memoryview(os.urandom(12))),
+        CachedImage("3", None, b""),
+    ]
+    expected = json.dumps([
+        {"image_data": base64.b64encode(bytes(image.image_data)).decode("ascii"), "mime_type": image.mime_type}
+        for image in images
+    ], separators=(",", ":"))
+
+    body = b"".join(app.iter_images_json(images))
+
+    assert body == expected.encode("ascii") + b"\n"
+    assert app.images_json_length(images) == len(body)
+    assert app.images_json_length([]) == len(b"".join(app.iter_images_json([]))) == 3
+
+
+def test_listings_page_through_every_image_once():
+    client = app.app.test_client()
+    ids = [_upload_id(client, "paged", PNG + os.urandom(50)) for _ in range(5)]
+
+    seen = []
+    url = "/images?nickname=paged&limit=2"
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_json()
+        seen.extend(image["id"] for image in page["images"])
+        url = page["next"]
+        if url:
+            assert response.headers["Link"] == f'<{url}>; rel="next"'
+    assert seen == ids
+
+    nicknames = []
+    url = "/nicknames?limit=3"
+    while url:
+        page = client.get(url).get_json()
+        nicknames.extend(page["nicknames"])
+        url = page["next"]
+    assert [item["nickname"] for item in nicknames] == sorted({item["nickname"] for item in nicknames})
+    assert {"nickname": "paged", "image_count": 5} in [
+        {key: item[key] for key in ("nickname", "image_count")} for item in nicknames
+    ]
+    assert client.get("/images?limit=0").status_code == 400
+    assert client.get("/images?cursor=bogus").status_code == 400
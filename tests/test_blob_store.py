@@ -0,0 +1,33 @@
+import hashlib
+import io
+import os
+
+from blob_store import FileBlobStore
+from storage import UploadStream
+
+
+def test_blobs_are_stored_under_their_content_hash(tmp_path):
+    store = FileBlobStore(str(tmp_path), fsync="never")
+    data = os.urandom(3000)
+
+    content_hash = store.write(UploadStream(io.BytesIO(data), chunk_size=1000))
+
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    assert store.path(content_hash) == os.path.join(
+        str(tmp_path), content_hash[:2], content_hash[2:4], content_hash
+    )
+    assert store.read(content_hash) == data
+    assert store.read_range(content_hash, 100, 50) == data[100:150]
+    assert list(store.iter_hashes()) == [content_hash]
+    assert os.listdir(tmp_path / "tmp") == []
+
+
+def test_delete_respects_the_grace_period(tmp_path):
+    store = FileBlobStore(str(tmp_path), fsync="never")
+    content_hash = store.write(UploadStream(io.BytesIO(b"image")))
+
+    assert not store.delete(content_hash, older_than=3600)
+    assert store.exists(content_hash)
+    assert store.delete(content_hash)
+    assert not store.exists(content_hash)
+    assert not store.delete(content_hash)
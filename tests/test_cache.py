@@ -0,0 +1,174 @@
+import threading
+import time
+
+import pytest
+import redis
+
+from cache import (
+    CachedImage, CircuitBreaker, CircuitOpenError, LocalCache, PoolExhaustedError, PoolQueue, ResilientRedis,
+    SingleFlight, SingleFlightTimeout, decode_entry, encode_entry, entry_size,
+)
+
+
+def test_cache_entries_round_trip_every_image():
+    images = [
+        CachedImage("00000000-0000-7000-8000-000000000001", "image/png", b"\x89PNG" + bytes(range(256))),
+        CachedImage("00000000-0000-7000-8000-000000000002", "image/gif", b""),
+    ]
+    entry = encode_entry(images, fresh_until=123.5)
+
+    assert len(entry) == entry_size(images)
+    decoded, fresh_until = decode_entry(entry)
+    assert fresh_until == 123.5
+    assert [(image.image_id, image.mime_type, bytes(image.image_data)) for image in decoded] == images
+    assert decode_entry(encode_entry([], 1.0)) == ([], 1.0)
+
+
+def test_damaged_or_foreign_cache_entries_are_misses():
+    entry = encode_entry([CachedImage("id", "image/png", b"data")])
+    assert decode_entry(None) is None
+    assert decode_entry(entry[:-1]) is None
+    assert decode_entry(b"XXXX" + entry[4:]) is None
+
+
+def test_pool_exhaustion_does_not_trip_the_breaker():
+    pool = redis.BlockingConnectionPool(port=1, max_connections=1, timeout=0.01, queue_class=PoolQueue)
+    # Take the only slot without connecting anywhere, so the pool is busy but nothing has failed
+    pool.pool.get()
+    breaker = CircuitBreaker(lambda: None, failure_threshold=2)
+    client = ResilientRedis(redis.Redis(connection_pool=pool), breaker)
+    for _ in range(3):
+        with pytest.raises(PoolExhaustedError):
+            client.get("key")
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["pool_exhausted"] == 3
+    assert breaker.stats()["failures"] == 0
+
+
+def test_unreachable_redis_trips_the_breaker():
+    pool = redis.BlockingConnectionPool(port=1, max_connections=1, timeout=0.01, queue_class=PoolQueue)
+    breaker = CircuitBreaker(lambda: None, failure_threshold=2, probe_interval=60)
+    client = ResilientRedis(redis.Redis(connection_pool=pool), breaker)
+    for _ in range(2):
+        with pytest.raises(redis.ConnectionError) as raised:
+            client.get("key")
+        assert not isinstance(raised.value, PoolExhaustedError)
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_local_cache_evicts_least_recently_used_entries_to_stay_in_budget():
+    cache = LocalCache(max_bytes=100, ttl=60, max_object_bytes=60)
+    cache.set("a", "A", 40)
+    cache.set("b", "B", 40)
+    assert cache.get("a") == "A"
+    cache.set("c", "C", 40)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.stats()["bytes"] == 80
+    assert cache.stats()["evictions"] == 1
+
+
+def test_local_cache_rejects_objects_over_the_size_limit():
+    cache = LocalCache(max_bytes=100, ttl=60, max_object_bytes=60)
+    assert not cache.set("big", "B", 61)
+    assert cache.get("big") is None
+    assert cache.stats()["rejections"] == 1
+
+
+def test_local_cache_refuses_values_loaded_before_an_invalidation():
+    cache = LocalCache(max_bytes=100, ttl=60)
+    version = cache.version()
+    cache.invalidate("a")
+    assert not cache.set("a", "old", 1, version=version)
+    assert cache.get("a") is None
+
+
+def test_single_flight_runs_concurrent_calls_once():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "images"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("nick", load)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("nick", load))) for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    while flight.stats()["coalesced"] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ["images"] * 5
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_shares_errors_and_times_out_waiters():
+    flight = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("database down")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("nick", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    assert started.wait(5)
+    with pytest.raises(SingleFlightTimeout):
+        flight.do("nick", fail, timeout=0.05)
+    follower = threading.Thread(target=call)
+    follower.start()
+    while flight.stats()["coalesced"] < 2:
+        time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_open_circuit_fails_fast_until_a_probe_succeeds():
+    healthy = threading.Event()
+
+    def probe():
+        if not healthy.is_set():
+            raise redis.ConnectionError("still down")
+
+    def down():
+        raise redis.ConnectionError("refused")
+
+    breaker = CircuitBreaker(probe, failure_threshold=1, probe_interval=0.01)
+    with pytest.raises(redis.ConnectionError):
+        breaker.call(down)
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "never called")
+
+    healthy.set()
+    deadline = time.monotonic() + 5
+    while breaker.state != CircuitBreaker.CLOSED and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.stats()["recoveries"] == 1
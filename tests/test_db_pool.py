@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout, SQLiteThreadPool, SQLiteWALPool
+
+
+def _sqlite_pool(tmp_path, **kwargs):
+    return ConnectionPool(lambda: sqlite3.connect(str(tmp_path / "pool.db"), check_same_thread=False), **kwargs)
+
+
+def test_connections_are_reused(tmp_path):
+    pool = _sqlite_pool(tmp_path, minsize=1, maxsize=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert pool.stats()["created"] == 1
+
+
+def test_checkout_times_out_when_every_connection_is_in_use(tmp_path):
+    pool = _sqlite_pool(tmp_path, minsize=0, maxsize=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            pool.getconn()
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_broken_connections_are_replaced(tmp_path):
+    pool = _sqlite_pool(tmp_path, minsize=1, maxsize=1)
+    conn = pool.getconn()
+    pool.putconn(conn, broken=True)
+    with pool.connection() as replacement:
+        assert replacement is not conn
+        replacement.execute("SELECT 1")
+
+
+def test_forked_child_gets_its_own_connections(tmp_path):
+    pool = _sqlite_pool(tmp_path, minsize=1, maxsize=1)
+    with pool.connection() as parent_conn:
+        pass
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            with pool.connection() as child_conn:
+                child_conn.execute("SELECT 1")
+                status = 0 if child_conn is not parent_conn else 2
+        finally:
+            os._exit(status)
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+    with pool.connection() as conn:
+        assert conn is parent_conn
+
+
+def test_sqlite_threads_each_get_their_own_connection(tmp_path):
+    pool = SQLiteThreadPool(str(tmp_path / "threads.db"))
+    seen = []
+
+    def checkout():
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        seen.append((first, second))
+
+    threads = [threading.Thread(target=checkout) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(first is second for first, second in seen)
+    assert seen[0][0] is not seen[1][0]
+
+
+def test_wal_pool_reads_never_wait_for_the_writer(tmp_path):
+    pool = SQLiteWALPool(str(tmp_path / "wal.db"), readers=2, checkpoint_interval=0)
+    with pool.connection() as writer:
+        assert writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        writer.execute("CREATE TABLE t (x INTEGER)")
+        writer.execute("INSERT INTO t VALUES (1)")
+        writer.commit()
+        # An uncommitted write holds the write lock, yet readers still see the last commit
+        writer.execute("INSERT INTO t VALUES (2)")
+        with pool.connection(readonly=True) as reader:
+            assert reader.execute("SELECT count(*) FROM t").fetchone()[0] == 1
+            with pytest.raises(sqlite3.OperationalError):
+                reader.execute("INSERT INTO t VALUES (3)")
+        writer.commit()
+    assert pool.checkpoint("TRUNCATE")[0] == 0
+    pool.closeall()
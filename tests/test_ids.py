@@ -0,0 +1,26 @@
+import time
+import uuid
+
+from ids import uuid7
+
+
+def test_uuid7_layout_and_timestamp():
+    before = time.time_ns() // 1_000_000
+    value = uuid7()
+    after = time.time_ns() // 1_000_000
+
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert before <= value.int >> 80 <= after + 1
+
+
+def test_uuid7_ids_from_one_process_strictly_increase():
+    ids = [uuid7() for _ in range(20_000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_uuid7_from_a_given_timestamp_sorts_by_it():
+    older, newer = uuid7(1_600_000_000_000), uuid7(1_600_000_000_001)
+    assert older.int >> 80 == 1_600_000_000_000
+    assert str(older) < str(newer)
@@ -0,0 +1,71 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from db_pool import SQLiteThreadPool
+from importer import ImportCheckpoint, Importer
+from migrations import apply_migrations
+from storage import fetch_images
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = SQLiteThreadPool(str(tmp_path / "photos.db"))
+    with pool.connection() as conn:
+        apply_migrations(conn, "sqlite")
+    yield pool
+    pool.closeall()
+
+
+def _images(pool, nickname):
+    with pool.connection() as conn:
+        return sorted(image.data for image in fetch_images(conn, "sqlite", nickname))
+
+
+def test_directory_import_names_images_after_their_directory_and_resumes(tmp_path, pool):
+    source = tmp_path / "photos"
+    (source / "cats").mkdir(parents=True)
+    (source / "dogs").mkdir()
+    cats = [PNG + os.urandom(100) for _ in range(3)]
+    for i, data in enumerate(cats):
+        (source / "cats" / f"{i}.png").write_bytes(data)
+    (source / "dogs" / "rex.png").write_bytes(cats[0])
+    (source / "dogs" / "notes.txt").write_text("not an image")
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    counters = Importer(pool, "sqlite", workers=1, batch_size=2).run(
+        str(source), ImportCheckpoint(checkpoint_path, str(source))
+    )
+
+    assert (counters["imported"], counters["duplicates"], counters["skipped"], counters["failed"]) == (4, 1, 1, 0)
+    assert _images(pool, "cats") == sorted(cats)
+    assert _images(pool, "dogs") == [cats[0]]
+    # A completed checkpoint makes a rerun a no-op
+    Importer(pool, "sqlite", workers=1).run(str(source), ImportCheckpoint(checkpoint_path, str(source)))
+    assert len(_images(pool, "cats")) == 3
+
+
+def test_tar_import_cleans_up_its_spool(tmp_path, pool, monkeypatch):
+    data = [PNG + os.urandom(1000) for _ in range(3)]
+    archive_path = str(tmp_path / "holiday.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as archive:
+        for i, content in enumerate(data):
+            member = tarfile.TarInfo(f"{i}.png")
+            member.size = len(content)
+            archive.addfile(member, io.BytesIO(content))
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    monkeypatch.setenv("TMPDIR", str(spool))
+    monkeypatch.setattr("tempfile.tempdir", None)
+
+    counters = Importer(pool, "sqlite", workers=1, batch_size=2).run(
+        archive_path, ImportCheckpoint(str(tmp_path / "checkpoint.json"), archive_path)
+    )
+
+    assert counters["imported"] == 3
+    assert _images(pool, "holiday") == sorted(data)
+    assert os.listdir(spool) == []
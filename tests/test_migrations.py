@@ -0,0 +1,69 @@
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+
+from migrations import MIGRATIONS, applied_versions, apply_migrations
+from storage import fetch_images, list_image_sizes
+
+
+def test_concurrent_startup_applies_each_migration_once(tmp_path):
+    path = str(tmp_path / "photos.db")
+    workers = 6
+    barrier = multiprocessing.get_context("fork").Barrier(workers)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 255
+            try:
+                conn = sqlite3.connect(path, timeout=30)
+                barrier.wait()
+                status = len(apply_migrations(conn, "sqlite"))
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    counts = [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids]
+
+    assert 255 not in counts
+    assert sum(counts) == len(MIGRATIONS)
+    conn = sqlite3.connect(path)
+    try:
+        assert applied_versions(conn, "sqlite") == [migration.version for migration in MIGRATIONS]
+    finally:
+        conn.close()
+
+
+def test_legacy_inline_images_move_to_the_blobs_table(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "legacy.db"))
+    apply_migrations(conn, "sqlite", target=3)
+    data = b"\x89PNG\r\n\x1a\n" + b"legacy"
+    conn.execute(
+        "INSERT INTO images (id, image_data, nickname, mime_type) VALUES (?, ?, ?, ?)",
+        ("00000000-0000-4000-8000-000000000001", data, "legacy", "image/png")
+    )
+    conn.commit()
+
+    apply_migrations(conn, "sqlite")
+
+    [image] = fetch_images(conn, "sqlite", "legacy")
+    assert bytes(image.data) == data
+    assert conn.execute("SELECT content_hash, byte_size, ref_count FROM blobs").fetchall() == [
+        (hashlib.sha256(data).hexdigest(), len(data), 1)
+    ]
+    conn.close()
+
+
+def test_nickname_listing_reads_only_the_covering_index(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "plan.db"))
+    apply_migrations(conn, "sqlite")
+    statements = []
+    conn.set_trace_callback(statements.append)
+    list_image_sizes(conn, "sqlite", "anyone")
+    conn.set_trace_callback(None)
+
+    [query] = [statement for statement in statements if statement.lstrip().startswith("SELECT")]
+    plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}"))
+    assert "USING COVERING INDEX images_nickname_listing" in plan
+    assert "TEMP B-TREE" not in plan
+    conn.close()
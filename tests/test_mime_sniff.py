@@ -0,0 +1,33 @@
+import struct
+
+import pytest
+
+import mime_sniff
+
+
+def _ftyp(major, *compatible):
+    brands = major + b"\x00\x00\x00\x00" + b"".join(compatible)
+    return struct.pack(">I", 8 + len(brands)) + b"ftyp" + brands
+
+
+@pytest.mark.parametrize("header, mime_type", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR", "image/png"),
+    (b"GIF87a\x01\x00", "image/gif"),
+    (b"GIF89a\x01\x00", "image/gif"),
+    (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"II*\x00\x08\x00\x00\x00", "image/tiff"),
+    (b"MM\x00*\x00\x00\x00\x08", "image/tiff"),
+    (b"BM\x36\x00\x0c\x00\x00\x00\x00\x00", "image/bmp"),
+    (b"\x00\x00\x01\x00\x01\x00\x10\x10", "image/vnd.microsoft.icon"),
+    (_ftyp(b"avif", b"mif1", b"miaf"), "image/avif"),
+    (_ftyp(b"mif1", b"heic"), "image/heic"),
+    (_ftyp(b"msf1", b"hevc"), "image/heic-sequence"),
+])
+def test_sniffs_known_signatures(header, mime_type):
+    assert mime_sniff.sniff(header) == mime_type
+
+
+@pytest.mark.parametrize("header", [b"", b"\xff\xd8", b"%PDF-1.7", b"RIFF\x24\x00\x00\x00WAVEfmt ", _ftyp(b"isom", b"mp41")])
+def test_unknown_or_truncated_headers_are_not_images(header):
+    assert mime_sniff.sniff(header) is None
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+import sqlite3
+
+import pytest
+
+from migrations import apply_migrations
+from storage import UploadStream, collect_garbage, delete_image, fetch_images, insert_image
+
+
+class _RecordingStream(io.BytesIO):
+    # Seekable, like the spooled upload the app passes in; remembers how much each read asked for
+    def __init__(self, data):
+        super().__init__(data)
+        self.requested = []
+
+    def read(self, n=-1):
+        self.requested.append(n)
+        return super().read(n)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "photos.db"))
+    apply_migrations(conn, "sqlite")
+    yield conn
+    conn.close()
+
+
+def test_upload_stream_hashes_in_chunks_after_peeking_the_header():
+    data = os.urandom(10_000)
+    stream = _RecordingStream(data)
+    upload = UploadStream(stream, chunk_size=1024)
+
+    assert upload.header(16) == data[:16]
+    assert b"".join(upload.chunks()) == data
+    assert upload.size == len(data)
+    assert upload.content_hash == hashlib.sha256(data).hexdigest()
+    assert all(0 <= n <= 1024 for n in stream.requested)
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "blobopen"), reason="SQLite blob I/O needs Python 3.11")
+def test_upload_is_stored_without_reading_it_whole(conn):
+    data = os.urandom(200_000)
+    stream = _RecordingStream(data)
+    upload = UploadStream(stream, chunk_size=4096)
+    upload.header(16)
+
+    insert_image(conn, "sqlite", "00000000-0000-7000-8000-000000000001", "streamed", "image/png", upload)
+    conn.commit()
+
+    assert all(0 <= n <= 4096 for n in stream.requested)
+    [image] = fetch_images(conn, "sqlite", "streamed")
+    assert bytes(image.data) == data
+
+
+def _blob_rows(conn):
+    return conn.execute("SELECT content_hash, ref_count FROM blobs ORDER BY content_hash").fetchall()
+
+
+def test_identical_uploads_share_one_reference_counted_blob(conn):
+    data = os.urandom(1000)
+    duplicates = [
+        insert_image(conn, "sqlite", image_id, nickname, "image/png", UploadStream(io.BytesIO(data)))
+        for image_id, nickname in [("00000000-0000-7000-8000-000000000001", "a"), ("00000000-0000-7000-8000-000000000002", "b")]
+    ]
+    conn.commit()
+
+    assert duplicates == [False, True]
+    assert _blob_rows(conn) == [(hashlib.sha256(data).hexdigest(), 2)]
+
+
+def test_blobs_are_collected_once_their_last_image_is_deleted(conn):
+    data = os.urandom(1000)
+    for image_id in ("00000000-0000-7000-8000-000000000001", "00000000-0000-7000-8000-000000000002"):
+        insert_image(conn, "sqlite", image_id, "shared", "image/png", UploadStream(io.BytesIO(data)))
+    conn.commit()
+
+    assert delete_image(conn, "sqlite", "00000000-0000-7000-8000-000000000001") == "shared"
+    conn.commit()
+    assert collect_garbage(conn, "sqlite") == (0, 0)
+    [image] = fetch_images(conn, "sqlite", "shared")
+    assert bytes(image.data) == data
+
+    delete_image(conn, "sqlite", "00000000-0000-7000-8000-000000000002")
+    conn.commit()
+    assert collect_garbage(conn, "sqlite") == (1, 0)
+    assert _blob_rows(conn) == []
@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+
+from storage import UploadStream
+from volume_store import VolumeBlobStore, compact
+
+
+def _store_blobs(root, count):
+    store = VolumeBlobStore(root, volume_size=4096, fsync="never")
+    hashes = [store.write(UploadStream(io.BytesIO(os.urandom(1000)))) for _ in range(count)]
+    return store, hashes
+
+
+def test_compact_keeps_tombstones_for_puts_in_skipped_volumes(tmp_path):
+    store, hashes = _store_blobs(str(tmp_path), 6)
+    assert len(store._volumes) == 2
+    # Volume 0 ends up mostly live and is skipped; volume 1 is all garbage and rewritten
+    for content_hash in [hashes[0]] + hashes[3:]:
+        store.delete(content_hash)
+    store.close()
+
+    compact(str(tmp_path), min_garbage=0.5)
+
+    store = VolumeBlobStore(str(tmp_path), fsync="never")
+    try:
+        assert not store.exists(hashes[0])
+        assert all(store.exists(content_hash) for content_hash in hashes[1:3])
+        assert not any(store.exists(content_hash) for content_hash in hashes[3:])
+    finally:
+        store.close()
+
+
+def test_compact_reports_only_dead_record_bytes(tmp_path):
+    store, hashes = _store_blobs(str(tmp_path), 3)
+    store.delete(hashes[1])
+    dead_bytes = store.stats()["dead_bytes"]
+    store.close()
+
+    reclaimed = compact(str(tmp_path))
+
+    assert reclaimed == dead_bytes
+    store = VolumeBlobStore(str(tmp_path), fsync="never")
+    try:
+        assert store.exists(hashes[0]) and store.exists(hashes[2])
+        assert not store.exists(hashes[1])
+    finally:
+        store.close()
+
+
+def test_appends_from_forked_processes_do_not_overlap(tmp_path):
+    # The store is opened before forking, as with gunicorn --preload
+    store = VolumeBlobStore(str(tmp_path), volume_size=64 * 1024, fsync="never")
+    blobs = [f"{worker}-{i}".encode() * 50 for worker in range(4) for i in range(100)]
+    pids = []
+    for worker in range(4):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                for data in blobs[worker * 100:(worker + 1) * 100]:
+                    store.write(UploadStream(io.BytesIO(data)))
+                store.close()
+                status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    assert all(os.waitpid(pid, 0)[1] == 0 for pid in pids)
+    store.close()
+
+    store = VolumeBlobStore(str(tmp_path), fsync="never")
+    try:
+        for data in blobs:
+            assert store.read(hashlib.sha256(data).hexdigest()) == data
+    finally:
+        store.close()
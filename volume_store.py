@@ -0,0 +1,550 @@
+import argparse
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from blob_store import FSYNC_POLICIES
+
+# Needle header: magic, flags, key (raw SHA-256), data length, data CRC32, header CRC32.
+# Records are padded to 8 bytes so every header starts aligned.
+_NEEDLE = struct.Struct(">4sB32sQI")
+_NEEDLE_MAGIC = b"NDL1"
+NEEDLE_HEADER_SIZE = _NEEDLE.size + 4
+_ALIGNMENT = 8
+FLAG_PUT = 0
+FLAG_TOMBSTONE = 1
+
+# Checkpoint: magic, version, volume count, entry count; then per volume
+# (number, end offset, dead bytes) and per entry (key, volume, offset, length, crc).
+_CHECKPOINT = struct.Struct(">4sBII")
+_CHECKPOINT_MAGIC = b"HIDX"
+_CHECKPOINT_VERSION = 1
+_CHECKPOINT_VOLUME = struct.Struct(">IQQ")
+_CHECKPOINT_ENTRY = struct.Struct(">32sIQQI")
+CHECKPOINT_NAME = "index.ckpt"
+
+_VOLUME_RE = re.compile(r"volume-(\d{6})\.dat$")
+
+
+class VolumeStoreBusy(Exception):
+    pass
+
+
+def _padded(length):
+    return (length + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _pack_header(flags, key, length, crc):
+    header = _NEEDLE.pack(_NEEDLE_MAGIC, flags, key, length, crc)
+    return header + struct.pack(">I", zlib.crc32(header))
+
+
+def _unpack_header(buf):
+    # (flags, key, length, crc), or None where no intact needle starts
+    if len(buf) < NEEDLE_HEADER_SIZE:
+        return None
+    header = bytes(buf[:_NEEDLE.size])
+    if header[:4] != _NEEDLE_MAGIC:
+        return None
+    if struct.unpack(">I", buf[_NEEDLE.size:NEEDLE_HEADER_SIZE])[0] != zlib.crc32(header):
+        return None
+    _, flags, key, length, crc = _NEEDLE.unpack(header)
+    return flags, key, length, crc
+
+
+class _Volume:
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self._open()
+        self.end = 0  # First byte after the last intact needle
+        self.dead_bytes = 0
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ) if self.size else None
+
+    def reopen(self):
+        self.close()
+        self._open()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+class VolumeBlobStore:
+    """Haystack-style store packing many images into large append-only volume files.
+
+    Images are appended as needles to preallocated ``volume-NNNNNN.dat`` files and
+    located through an in-memory index of SHA-256 -> (volume, offset, length,
+    CRC32), so a read is one dictionary lookup plus a slice of an mmap. Deletes
+    append a tombstone; the space is reclaimed offline by ``compact``.
+
+    The index is checkpointed to ``index.ckpt`` every ``checkpoint_interval``
+    seconds and on close; at startup only needles written after the checkpoint
+    are scanned. Several processes may share a store: appends are serialized with
+    a lock file, and each process scans the tail for needles written by others
+    when it finds one past its own end, or on a miss. A store opened before a
+    fork (e.g. gunicorn ``--preload``) reopens its files in the child.
+    """
+
+    external = True
+    serves_files = False
+    name = "volume"
+
+    def __init__(self, root, volume_size=1024 ** 3, fsync="always", checkpoint_interval=300):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy {fsync!r}; expected one of {', '.join(FSYNC_POLICIES)}")
+        self.root = os.path.abspath(root)
+        self.volume_size = volume_size
+        self.fsync = fsync
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.RLock()
+        self._open_locks()
+        self._volumes = {}
+        self._index = {}
+        self._writes_since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        self._counters = {"reads": 0, "writes": 0, "deletes": 0, "tail_scans": 0, "checksum_failures": 0}
+        started = time.monotonic()
+        loaded = self._load_checkpoint()
+        scanned = self._catch_up()
+        logging.info(
+            f"Opened volume store {self.root}: {len(self._volumes)} volumes, {len(self._index)} images "
+            f"({'checkpoint plus ' if loaded else ''}{scanned} scanned needles) in {time.monotonic() - started:.2f}s."
+        )
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open_locks(self):
+        # Held shared for the store's lifetime so offline compaction can tell it is in use
+        self._open_lock = open(os.path.join(self.root, ".open.lock"), "a+b")
+        try:
+            fcntl.flock(self._open_lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._open_lock.close()
+            raise VolumeStoreBusy(f"{self.root} is being compacted")
+        self._append_lock = open(os.path.join(self.root, ".append.lock"), "a+b")
+
+    def _after_fork(self):
+        # flock locks belong to the open file description, which a forked child shares
+        # with its parent, so every process needs descriptors of its own. Closing the
+        # inherited ones leaves the parent's locks and maps untouched.
+        if self._append_lock.closed:
+            return
+        self._lock = threading.RLock()
+        self._append_lock.close()
+        self._open_lock.close()
+        self._open_locks()
+        for volume in self._volumes.values():
+            volume.reopen()
+        logging.info(f"Reopened volume store {self.root} after fork (pid {os.getpid()}).")
+
+    # -- index maintenance --------------------------------------------------
+
+    def _volume_paths(self):
+        paths = {}
+        for path in glob.glob(os.path.join(self.root, "volume-*.dat")):
+            match = _VOLUME_RE.search(path)
+            if match:
+                paths[int(match.group(1))] = path
+        return paths
+
+    def _open_new_volumes(self):
+        for number, path in sorted(self._volume_paths().items()):
+            if number not in self._volumes:
+                self._volumes[number] = _Volume(number, path)
+
+    def _apply(self, volume, offset, flags, key, length, crc):
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._volumes[previous[0]].dead_bytes += NEEDLE_HEADER_SIZE + _padded(previous[2])
+        if flags == FLAG_TOMBSTONE:
+            volume.dead_bytes += NEEDLE_HEADER_SIZE
+        else:
+            self._index[key] = (volume.number, offset + NEEDLE_HEADER_SIZE, length, crc)
+
+    def _catch_up(self):
+        # Scan every volume past the last needle this process knows about
+        with self._lock:
+            self._open_new_volumes()
+            scanned = 0
+            for number in sorted(self._volumes):
+                volume = self._volumes[number]
+                while volume.map is not None:
+                    parsed = _unpack_header(volume.map[volume.end:volume.end + NEEDLE_HEADER_SIZE])
+                    if parsed is None:
+                        break
+                    flags, key, length, crc = parsed
+                    if volume.end + NEEDLE_HEADER_SIZE + length > volume.size:
+                        break
+                    self._apply(volume, volume.end, flags, key, length, crc)
+                    volume.end += NEEDLE_HEADER_SIZE + _padded(length)
+                    scanned += 1
+            self._counters["tail_scans"] += 1
+            return scanned
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.root, CHECKPOINT_NAME)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        try:
+            magic, version, volume_count, entry_count = _CHECKPOINT.unpack_from(data, 0)
+            if magic != _CHECKPOINT_MAGIC or version != _CHECKPOINT_VERSION:
+                raise ValueError("unrecognised header")
+            pos = _CHECKPOINT.size
+            self._open_new_volumes()
+            for _ in range(volume_count):
+                number, end, dead_bytes = _CHECKPOINT_VOLUME.unpack_from(data, pos)
+                pos += _CHECKPOINT_VOLUME.size
+                volume = self._volumes.get(number)
+                if volume is None or end > volume.size:
+                    raise ValueError(f"volume {number} does not match the checkpoint")
+                volume.end, volume.dead_bytes = end, dead_bytes
+            for _ in range(entry_count):
+                key, number, offset, length, crc = _CHECKPOINT_ENTRY.unpack_from(data, pos)
+                pos += _CHECKPOINT_ENTRY.size
+                self._index[key] = (number, offset, length, crc)
+            if pos + 4 != len(data) or struct.unpack_from(">I", data, pos)[0] != zlib.crc32(data[:pos]):
+                raise ValueError("checksum mismatch")
+        except (struct.error, ValueError) as e:
+            logging.warning(f"Ignoring volume store checkpoint {path} ({e}); rebuilding the index from the volumes.")
+            self._index.clear()
+            for volume in self._volumes.values():
+                volume.end = volume.dead_bytes = 0
+            return False
+        return True
+
+    def checkpoint(self):
+        """Write the index to ``index.ckpt`` atomically."""
+        with self._lock:
+            volumes = sorted(self._volumes.values(), key=lambda v: v.number)
+            parts = [_CHECKPOINT.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, len(volumes), len(self._index))]
+            parts.extend(_CHECKPOINT_VOLUME.pack(v.number, v.end, v.dead_bytes) for v in volumes)
+            parts.extend(_CHECKPOINT_ENTRY.pack(key, *entry) for key, entry in self._index.items())
+            self._writes_since_checkpoint = 0
+            self._last_checkpoint = time.monotonic()
+        data = b"".join(parts)
+        data += struct.pack(">I", zlib.crc32(data))
+        path = os.path.join(self.root, CHECKPOINT_NAME)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # -- blob store interface -----------------------------------------------
+
+    def _key(self, content_hash):
+        key = bytes.fromhex(content_hash)
+        if len(key) != 32:
+            raise ValueError(f"Not a SHA-256 hex digest: {content_hash!r}")
+        return key
+
+    def _active_volume(self, needed):
+        # Called with both locks held
+        if self._volumes:
+            volume = self._volumes[max(self._volumes)]
+            if volume.end + needed <= volume.size:
+                return volume
+        number = max(self._volumes, default=-1) + 1
+        path = os.path.join(self.root, f"volume-{number:06d}.dat")
+        # Allocated under a temporary name so other processes never map a volume before it has its full size
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = max(self.volume_size, needed)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+            if self.fsync == "always":
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+        if self.fsync == "always":
+            dir_fd = os.open(self.root, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        volume = self._volumes[number] = _Volume(number, path)
+        return volume
+
+    def _append(self, flags, chunks, length, key):
+        # ``key`` is a callable: for uploads the hash is only known once the bytes have passed
+        with self._lock:
+            fcntl.flock(self._append_lock, fcntl.LOCK_EX)
+            try:
+                self._catch_up()
+                needed = NEEDLE_HEADER_SIZE + _padded(length)
+                volume = self._active_volume(needed)
+                offset = volume.end
+                position = offset + NEEDLE_HEADER_SIZE
+                crc = 0
+                for chunk in chunks:
+                    if position + len(chunk) > offset + needed:
+                        raise ValueError(f"Upload grew past its declared length of {length} bytes")
+                    os.pwrite(volume.fd, chunk, position)
+                    crc = zlib.crc32(chunk, crc)
+                    position += len(chunk)
+                if position != offset + NEEDLE_HEADER_SIZE + length:
+                    raise ValueError(f"Expected {length} bytes but received {position - offset - NEEDLE_HEADER_SIZE}")
+                key = key()
+                # The header goes last: until it is written, scans still end before this needle
+                os.pwrite(volume.fd, _pack_header(flags, key, length, crc), offset)
+                if self.fsync != "never":
+                    os.fdatasync(volume.fd)
+                volume.end = offset + needed
+                self._apply(volume, offset, flags, key, length, crc)
+            finally:
+                fcntl.flock(self._append_lock, fcntl.LOCK_UN)
+            self._writes_since_checkpoint += 1
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+        if due:
+            self.checkpoint()
+
+    def write(self, upload):
+        """Append ``upload`` (an UploadStream) as a needle and return its content hash."""
+        length = upload.length()
+        if length is None:
+            chunks = [upload.read()]
+            length = len(chunks[0])
+        else:
+            chunks = upload.chunks()
+        self._append(FLAG_PUT, chunks, length, lambda: self._key(upload.content_hash))
+        self._counters["writes"] += 1
+        return upload.content_hash
+
+    def delete(self, content_hash, older_than=None):
+        """Append a tombstone for ``content_hash``; returns False if it was not stored.
+
+        With ``older_than``, the blob is only deleted if its volume has not been
+        written to for that many seconds, i.e. no upload can still be adding it.
+        """
+        key = self._key(content_hash)
+        entry = self._find(key)
+        if entry is None:
+            return False
+        if older_than is not None and self._volume_age(self._volumes[entry[0]]) < older_than:
+            return False
+        self._append(FLAG_TOMBSTONE, [], 0, lambda: key)
+        self._counters["deletes"] += 1
+        return True
+
+    def _tail_moved(self):
+        # Cheap check for needles (including tombstones) appended by other processes
+        if not self._volumes:
+            return False
+        volume = self._volumes[max(self._volumes)]
+        return volume.map is not None and _unpack_header(
+            volume.map[volume.end:volume.end + NEEDLE_HEADER_SIZE]
+        ) is not None
+
+    def _find(self, key):
+        with self._lock:
+            if self._tail_moved():
+                self._catch_up()
+            entry = self._index.get(key)
+            if entry is None:
+                # Possibly written by another process to a volume we have not opened yet
+                self._catch_up()
+                entry = self._index.get(key)
+            return entry
+
+    def _volume_age(self, volume):
+        return time.time() - os.stat(volume.path).st_mtime
+
+    def iter_hashes(self, older_than=0):
+        """Hashes stored in volumes that have not been written to for ``older_than`` seconds."""
+        with self._lock:
+            self._catch_up()
+            settled = {number for number, volume in self._volumes.items() if self._volume_age(volume) >= older_than}
+            keys = [key for key, entry in self._index.items() if entry[0] in settled]
+        for key in keys:
+            yield key.hex()
+
+    def exists(self, content_hash):
+        return self._find(self._key(content_hash)) is not None
+
+    def read(self, content_hash):
+        entry = self._find(self._key(content_hash))
+        if entry is None:
+            raise LookupError(f"Blob {content_hash} is not in the volume store")
+        number, offset, length, crc = entry
+        data = self._volumes[number].map[offset:offset + length]
+        if zlib.crc32(data) != crc:
+            self._counters["checksum_failures"] += 1
+            raise IOError(f"Checksum mismatch for blob {content_hash} in volume {number} at offset {offset}")
+        self._counters["reads"] += 1
+        return data
+
+    def read_range(self, content_hash, start, length):
+        entry = self._find(self._key(content_hash))
+        if entry is None:
+            raise LookupError(f"Blob {content_hash} is not in the volume store")
+        number, offset, size, _ = entry
+        start = min(start, size)
+        stop = min(start + length, size)
+        self._counters["reads"] += 1
+        return self._volumes[number].map[offset + start:offset + stop]
+
+    def close(self):
+        self.checkpoint()
+        with self._lock:
+            for volume in self._volumes.values():
+                volume.close()
+            self._volumes.clear()
+        self._append_lock.close()
+        self._open_lock.close()
+
+    def stats(self):
+        with self._lock:
+            volumes = list(self._volumes.values())
+            live_bytes = sum(length for _, _, length, _ in self._index.values())
+            return {
+                "backend": self.name,
+                "volumes": len(volumes),
+                "images": len(self._index),
+                "live_bytes": live_bytes,
+                "used_bytes": sum(v.end for v in volumes),
+                "dead_bytes": sum(v.dead_bytes for v in volumes),
+                "allocated_bytes": sum(v.size for v in volumes),
+                "writes_since_checkpoint": self._writes_since_checkpoint,
+                **self._counters,
+            }
+
+
+def compact(root, min_garbage=0.0):
+    """Rewrite every volume whose dead fraction is at least ``min_garbage`` without its dead needles.
+
+    Must run while no process has the store open. Volumes are rewritten in order
+    and each replaced atomically. A tombstone is only dropped when every earlier
+    volume holding a put for its key is rewritten in the same run; otherwise the
+    skipped volume's put would come back to life. Returns the bytes of dead
+    needles removed.
+    """
+    root = os.path.abspath(root)
+    with open(os.path.join(root, ".open.lock"), "a+b") as open_lock:
+        try:
+            fcntl.flock(open_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise VolumeStoreBusy(f"{root} is open by a running process; stop it before compacting")
+        try:
+            os.unlink(os.path.join(root, CHECKPOINT_NAME))
+        except FileNotFoundError:
+            pass
+        store = _OfflineStore(root)
+        reclaimed = 0
+        try:
+            rewritten = {
+                number for number, volume in store._volumes.items()
+                if volume.end and volume.dead_bytes / volume.end >= min_garbage
+            }
+            for number in sorted(rewritten):
+                reclaimed += store.rewrite(store._volumes[number], rewritten)
+        finally:
+            store.close_volumes()
+        logging.info(f"Compacted {root}: reclaimed {reclaimed} bytes.")
+        return reclaimed
+
+
+class _OfflineStore(VolumeBlobStore):
+    # Full index without taking the shared open lock compaction holds exclusively
+    def __init__(self, root):
+        self.root = root
+        self.fsync = "always"
+        self._lock = threading.RLock()
+        self._volumes = {}
+        self._index = {}
+        # Every volume holding a put for each key, live or not
+        self._put_volumes = {}
+        self._counters = {"tail_scans": 0}
+        self._catch_up()
+
+    def _apply(self, volume, offset, flags, key, length, crc):
+        if flags == FLAG_PUT:
+            self._put_volumes.setdefault(key, set()).add(volume.number)
+        super()._apply(volume, offset, flags, key, length, crc)
+
+    def _keeps_tombstone(self, volume, key, rewritten):
+        # A put in an earlier volume that keeps its records still needs cancelling
+        return any(number < volume.number and number not in rewritten for number in self._put_volumes.get(key, ()))
+
+    def rewrite(self, volume, rewritten):
+        # Copies live puts and still-needed tombstones in their original order
+        tmp_path = volume.path + ".compact"
+        offset = position = 0
+        with open(tmp_path, "wb") as f:
+            while offset < volume.end:
+                flags, key, length, crc = _unpack_header(volume.map[offset:offset + NEEDLE_HEADER_SIZE])
+                record = NEEDLE_HEADER_SIZE + _padded(length)
+                if flags == FLAG_PUT:
+                    keep = self._index.get(key) == (volume.number, offset + NEEDLE_HEADER_SIZE, length, crc)
+                else:
+                    keep = self._keeps_tombstone(volume, key, rewritten)
+                if keep:
+                    f.write(volume.map[offset:offset + record])
+                    position += record
+                offset += record
+            f.flush()
+            os.fsync(f.fileno())
+        reclaimed = volume.end - position
+        volume.close()
+        if position:
+            os.replace(tmp_path, volume.path)
+        else:
+            os.unlink(tmp_path)
+            os.unlink(volume.path)
+        dir_fd = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        del self._volumes[volume.number]
+        return reclaimed
+
+    def close_volumes(self):
+        for volume in self._volumes.values():
+            volume.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain a photo_app volume store.")
+    parser.add_argument("command", choices=["compact", "stats"])
+    parser.add_argument("--path", default=os.getenv("BLOB_STORE_PATH", "/tmp/photo_blobs"))
+    parser.add_argument(
+        "--min-garbage", type=float, default=0.0,
+        help="Only compact volumes whose dead fraction is at least this (0..1)",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == "compact":
+        compact(args.path, min_garbage=args.min_garbage)
+    else:
+        store = VolumeBlobStore(args.path, fsync="never")
+        try:
+            for name, value in store.stats().items():
+                print(f"{name}: {value}")
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class GroupCommitQueue:
+    """Runs writes from many request threads in shared transactions on one writer thread.
+
+    ``submit(write)`` queues ``write(conn)`` and returns a Future that resolves to
+    its result only once the transaction containing it has committed. A batch
+    closes when it holds ``max_batch`` writes or ``max_delay_ms`` after its first
+    write arrived, so one commit (and one fsync) covers many uploads. Each write
+    runs under its own savepoint: one that fails is rolled back and reported to
+    its caller without affecting the rest of the batch.
+    """
+
+    def __init__(self, pool, db_type, max_batch=64, max_delay_ms=2, max_pending=1024, name="write-queue"):
+        if max_batch < 1:
+            raise ValueError(f"Invalid batch size: {max_batch}")
+        self.pool = pool
+        self.db_type = db_type
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._counters = {
+            "batches": 0,
+            "writes": 0,
+            "failed_writes": 0,
+            "failed_batches": 0,
+            "rejected": 0,
+            "largest_batch": 0,
+        }
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # A forked worker inherits the queue but neither the thread nor its pending writes
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, write, timeout=None):
+        """Queue ``write(conn)``; waits up to ``timeout`` seconds for room, then raises WriteQueueFull."""
+        self._ensure_thread()
+        future = Future()
+        try:
+            self._queue.put((write, future), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise WriteQueueFull(f"{self._queue.maxsize} writes are already waiting for the {self.name}")
+        return future
+
+    def _run(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        batch = [(write, future) for write, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    if self.db_type == "sqlite":
+                        # Otherwise the first savepoint would open, and its release commit, the transaction
+                        cur.execute("BEGIN IMMEDIATE")
+                    for write, future in batch:
+                        cur.execute("SAVEPOINT queued_write")
+                        try:
+                            outcomes.append((future, write(conn), None))
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO SAVEPOINT queued_write")
+                            outcomes.append((future, None, e))
+                        cur.execute("RELEASE SAVEPOINT queued_write")
+                    conn.commit()
+                finally:
+                    cur.close()
+        except Exception as e:
+            # Nothing in the batch is durable, so every caller sees the failure
+            logging.error(f"Group commit of {len(batch)} writes failed: {e}")
+            with self._lock:
+                self._counters["failed_batches"] += 1
+                self._counters["failed_writes"] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self._counters["batches"] += 1
+            self._counters["writes"] += len(batch)
+            self._counters["failed_writes"] += sum(1 for _, _, error in outcomes if error is not None)
+            self._counters["largest_batch"] = max(self._counters["largest_batch"], len(batch))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self, timeout=None):
+        """Commit everything already queued, then stop the writer thread."""
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        batches = counters["batches"]
+        return {
+            "backend": self.name,
+            "pending": self._queue.qsize(),
+            "max_batch": self.max_batch,
+            "max_delay_ms": self.max_delay * 1000,
+            "average_batch": round(counters["writes"] / batches, 2) if batches else 0,
+            **counters,
+        }